@@ -0,0 +1,95 @@
+"""
+Benchmark of the major bucket classification of the filler.
+
+Compares the original float_in scan, the per-job lookup (fill_majors_bucket)
+and the batch numpy pass (fill_majors_buckets) on a synthetic batch of
+normalized jobs, and checks all three give the same buckets.
+
+    python benchmarks/bench_majors_bucket.py [n_jobs] [majors_per_job]
+"""
+import os
+import sys
+import copy
+import time
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'workers'))
+
+import majors_bucket as mb
+
+
+SCORES = [80, 55, 50, 45, 40, 37, 35, 18, 10, 6, 3, 0.2, 1, 0.02]
+
+
+def legacy_fill(job_data, norm_rsp):
+    major = norm_rsp.get('major')
+    if major:
+        bucket_1, bucket_2, bucket_3 = [], [], []
+        for k, v in major.items():
+            if mb.float_in(v, mb.MAJOR_BUCKET_1_CHOICES):
+                bucket_1.append(k)
+            elif mb.float_in(v, mb.MAJOR_BUCKET_3_CHOICES):
+                bucket_3.append(k)
+            else:
+                bucket_2.append(k)
+        job_data.update({
+            'majorPriority': major,
+            'majors': list(major.keys()),
+            'majorsBucket1': bucket_1,
+            'majorsBucket2': bucket_2,
+            'majorsBucket3': bucket_3,
+        })
+    else:
+        job_data['majorPriority'] = {}
+
+
+def build_batch(n_jobs, majors_per_job):
+    rnd = random.Random(42)
+    norm_rsps = []
+    for i in range(n_jobs):
+        major = {}
+        for j in range(rnd.randint(0, majors_per_job * 2)):
+            # scores are sums of the weights, with float noise around them
+            score = sum(rnd.sample(SCORES, rnd.randint(1, 2))) + rnd.choice((0, 0, 1e-4, -1e-4, 2e-3))
+            major['major_%d' % rnd.randint(0, 500)] = score
+        norm_rsps.append({'major': major})
+    return norm_rsps
+
+
+def timeit(fn, norm_rsps, repeat=5):
+    best = None
+    for _ in range(repeat):
+        jobs = [{} for _ in norm_rsps]
+        start = time.time()
+        fn(jobs, norm_rsps)
+        cost = time.time() - start
+        best = cost if best is None else min(best, cost)
+    return best, jobs
+
+
+def main():
+    n_jobs = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    majors_per_job = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    norm_rsps = build_batch(n_jobs, majors_per_job)
+    n_scores = sum(len(r['major']) for r in norm_rsps)
+
+    def per_job(fill):
+        def run(jobs, rsps):
+            for job, rsp in zip(jobs, rsps):
+                fill(job, copy.copy(rsp))
+        return run
+
+    legacy_cost, expected = timeit(per_job(legacy_fill), norm_rsps)
+    lookup_cost, lookup_jobs = timeit(per_job(mb.fill_majors_bucket), norm_rsps)
+    batch_cost, batch_jobs = timeit(mb.fill_majors_buckets, norm_rsps)
+
+    assert lookup_jobs == expected, 'lookup output differs'
+    assert batch_jobs == expected, 'batch output differs'
+
+    print('%d jobs, %d scores, numpy: %s' % (n_jobs, n_scores, mb.np is not None))
+    for name, cost in (('float_in', legacy_cost), ('lookup', lookup_cost), ('batch', batch_cost)):
+        print('%-10s %8.2f ms  %6.2fx' % (name, cost * 1000, legacy_cost / cost))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,349 @@
+"""
+End-to-end benchmark of the downloader -> parser -> cleaner -> normalizer ->
+filler -> sinker chain, on synthetic feeds and local service stand-ins.
+
+Each stage runs its worker without kafka: the worker class is built with a
+BaseWorker that only sets the logger, every message of the stage before is
+handed to `process` and the stage ends with the flush master asks for.
+What the worker produces is the input of the next stage.
+* download: FeedDownloader from a local http server
+* parse: ParserWorker, iter_file_parallel with --parse-processes > 1
+* clean: CleanerWorker, its MicroBatcher and dedup lookup thread pool (or
+  the dedup index with --dedup-index)
+* normalize: NormalizerWorker, batches in flight against a local norm api
+* fill: FillerWorker, reference lookups against an in-memory Mongo stand-in
+* sink: SinkerWorker, parallel_bulk to a local ES stand-in
+
+Redis is an in-memory stand-in, nothing reaches a configured service.
+Reports records/sec over the stage wall time, latency percentiles (per
+record for download and parse, per batch after) and the max RSS of the
+process when the stage ends. All stages run in one process, so that is a
+cumulative peak: a stage shows the highest of itself and the stages before.
+Needs the deployment environment (settings, utils, lxml, ...) on PYTHONPATH.
+
+    python benchmarks/bench_pipeline.py --records 5000 --feeds JUJU,DIRECT_EMPLOYERS
+"""
+import os
+import sys
+import json
+import time
+import atexit
+import shutil
+import logging
+import argparse
+import resource
+import tempfile
+import threading
+import contextlib
+from unittest import mock
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT, 'workers'))
+sys.path.insert(0, ROOT)
+
+import settings
+import settings._redis
+
+from synthetic_feeds import feed_names, write_feed, reference_values
+from standins import StubServer, MemoryRedis, MemoryMongo, MemoryCollection
+
+# the workers and utils bind redis from settings when they are imported
+settings.r_db = settings._redis.r_db = MemoryRedis()
+
+PROCESS_SEQ = 'bench'
+
+
+class Topic(object):
+    """placeholder of the kafka topics the workers are built with"""
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def max_rss_mb():
+    # peak of the whole process so far, not of the current stage.
+    # ru_maxrss is in KB on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+class StageStats(object):
+
+    def __init__(self, name, unit):
+        self.name = name
+        self.unit = unit
+        # messages handed to the stage
+        self.records = 0
+        # messages handed to the next stage
+        self.out = 0
+        # wall time of the stage
+        self.seconds = 0.0
+        self.latencies = []
+        # max rss of the process when the stage ends
+        self.max_rss = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, seconds):
+        # batches are timed from the worker threads
+        with self._lock:
+            self.latencies.append(seconds)
+
+    def as_dict(self):
+        return {
+            'stage': self.name,
+            'unit': self.unit,
+            'records': self.records,
+            'out': self.out,
+            'seconds': round(self.seconds, 3),
+            'records_per_sec': round(self.records / self.seconds, 1) if self.seconds else 0.0,
+            'p50': percentile(self.latencies, 0.5),
+            'p90': percentile(self.latencies, 0.9),
+            'p99': percentile(self.latencies, 0.99),
+            'max_rss_mb': round(self.max_rss, 1),
+        }
+
+
+@contextlib.contextmanager
+def stage(stats, name, unit):
+    s = StageStats(name, unit)
+    start_time = time.perf_counter()
+    yield s
+    s.seconds = time.perf_counter() - start_time
+    s.max_rss = max_rss_mb()
+    stats.append(s)
+
+
+def build_worker(worker_class, *topics):
+    """
+    `worker_class(*topics)` without kafka: BaseWorker only sets the logger,
+    the messages the worker produces are collected in `worker.produced`,
+    as the keyword arguments of the next stage's `process`
+    """
+    from framework.base_worker import BaseWorker
+
+    def init(self, name, PreTopic, NextTopic):
+        self.logger = logging.getLogger(name)
+
+    with mock.patch.object(BaseWorker, '__init__', init):
+        worker = worker_class(*topics)
+    worker.produced = []
+    # the cleaner passes the old job topic first
+    worker.produce_msg = lambda *topic, **kwargs: worker.produced.append(kwargs)
+    return worker
+
+
+def time_calls(obj, name, s):
+    """record every call of the method `name` of `obj` as a latency of `s`"""
+    method = getattr(obj, name)
+
+    def timed(*args, **kwargs):
+        start_time = time.perf_counter()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            s.add(time.perf_counter() - start_time)
+
+    setattr(obj, name, timed)
+
+
+def run_stage(stats, name, worker, msgs, timed_obj, timed_name, flush):
+    """hand `msgs` to `worker.process`, then `flush()`, returns what the worker produced"""
+    with stage(stats, name, 'batch') as s:
+        time_calls(timed_obj, timed_name, s)
+        for msg in msgs:
+            worker.process(**msg)
+        flush()
+        s.records = len(msgs)
+        s.out = len(worker.produced)
+    return worker.produced
+
+
+def run_download(stats, feeds, stub, xml_dir, n_records):
+    from downloader import FeedDownloader, feed_filename
+
+    with stage(stats, 'download', 'feed') as s:
+        downloader = FeedDownloader()
+        for name in feeds:
+            stat = downloader.fetch(name, '%s/feeds/%s.xml' % (stub.url, name.lower()), feed_filename(name, xml_dir))
+            if stat is None:
+                raise RuntimeError('download of %s from the stand-in failed' % name)
+            s.add(stat['timecost'])
+            s.records += n_records
+            s.out += n_records
+        downloader.close()
+
+
+def run_parse(stats, feeds, xml_dir):
+    from downloader import feed_filename
+    from parser import ParserWorker
+
+    worker = build_worker(ParserWorker, Topic, Topic)
+    with stage(stats, 'parse', 'record') as s:
+        last = [0.0]
+
+        def produce(**kwargs):
+            # time to read and extract each record, as timed_iter('parse') does
+            now = time.perf_counter()
+            s.add(now - last[0])
+            last[0] = now
+            worker.produced.append(kwargs)
+
+        worker.produce_msg = produce
+        for order, name in enumerate(feeds):
+            last[0] = time.perf_counter()
+            worker.process(order, name, feed_filename(name, xml_dir))
+        s.records = s.out = len(worker.produced)
+    return worker.produced
+
+
+def run_clean(stats, parsed):
+    from cleaner import CleanerWorker
+
+    worker = build_worker(CleanerWorker, Topic, Topic, Topic)
+    try:
+        return run_stage(stats, 'clean', worker, parsed, worker.batcher, 'flush_fn', worker.batcher.flush)
+    finally:
+        if worker.lookup_executor is not None:
+            worker.lookup_executor.shutdown()
+
+
+def run_normalize(stats, cleaned, stub):
+    from normalizer import NormalizerWorker
+
+    settings.URL_NORM_JOB = stub.url + '/norm'
+    worker = build_worker(NormalizerWorker, Topic, Topic)
+    try:
+        # a norm request, the batches in flight overlap
+        return run_stage(stats, 'normalize', worker, cleaned, worker.pipeline, 'request', worker.flush)
+    finally:
+        worker.session.close()
+
+
+def build_reference_db():
+    values = reference_values()
+    db = MemoryMongo()
+    db['titles'] = MemoryCollection([{'title': t, 'display': t.title()} for t in values['titles']])
+    db['cities'] = MemoryCollection([{'name': c} for c in values['cities']])
+    db['states'] = MemoryCollection([{'name': s} for s in values['states']])
+    return db
+
+
+def run_fill(stats, normed):
+    from filler import FillerWorker
+
+    worker = build_worker(FillerWorker, Topic, Topic)
+    # the reference lookups go to the stand-in, never to the configured mongo
+    worker.validator._db = worker.mongo_enricher._db = build_reference_db()
+    # fill_price prints every job
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        return run_stage(stats, 'fill', worker, normed, worker.batcher, 'flush_fn', worker.flush)
+
+
+def run_sink(stats, filled, stub):
+    from elasticsearch_dsl.connections import connections
+    from sinker import SinkerWorker
+
+    connections.create_connection(hosts=[stub.url])
+    worker = build_worker(SinkerWorker, Topic, Topic)
+    before = stub.bulk_docs
+    run_stage(stats, 'sink', worker, filled, worker.batcher, 'flush_fn', worker.flush)
+    # the sinker produces nothing, what reached the _bulk endpoint is its output
+    stats[-1].out = stub.bulk_docs - before
+
+
+def configure(args, work_dir):
+    """
+    settings of the run, before the workers are imported as they read
+    most settings at import
+    """
+    settings.r_db.set(settings.KEY_PROCESS_SEQ, PROCESS_SEQ)
+    settings.PARALLEL_PARSE_PROCESSES = args.parse_processes
+    settings.PARALLEL_PARSE_MIN_SIZE = 0
+    settings.PARALLEL_PARSE_CHUNK_SIZE = args.parse_chunk_size
+    settings.CLEAN_BATCH_SIZE = args.batch_size
+    settings.DEDUP_LOOKUP_THREADS = args.lookup_threads
+    settings.DEDUP_INDEX_ENABLED = args.dedup_index
+    settings.DEDUP_BLOOM_PATH = os.path.join(work_dir, 'dedup_bloom.bin')
+    settings.NORM_BATCH_SIZE = args.norm_batch_size
+    settings.NORM_CONCURRENCY = args.norm_concurrency
+    settings.FILL_BATCH_SIZE = args.batch_size
+    settings.ES_BATCH_SIZE = args.es_batch_size
+    settings.ES_BULK_CHUNK_SIZE = args.bulk_size
+    settings.ES_BULK_THREADS = args.bulk_threads
+
+
+def print_report(stats):
+    header = '%-10s %-7s %9s %9s %9s %11s %10s %10s %10s %10s' % (
+        'stage', 'unit', 'records', 'out', 'seconds', 'records/s', 'p50', 'p90', 'p99', 'max rss MB')
+    print(header)
+    print('-' * len(header))
+    for s in stats:
+        d = s.as_dict()
+        print('%-10s %-7s %9d %9d %9.2f %11.1f %9.2fms %9.2fms %9.2fms %10.1f' % (
+            d['stage'], d['unit'], d['records'], d['out'], d['seconds'], d['records_per_sec'],
+            d['p50'] * 1000, d['p90'] * 1000, d['p99'] * 1000, d['max_rss_mb']))
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    ap.add_argument('--feeds', help='comma separated feed names, all feeds by default')
+    ap.add_argument('--records', type=int, default=2000, help='records per feed')
+    ap.add_argument('--desc-size', type=int, default=1500, help='characters per description')
+    ap.add_argument('--parse-processes', type=int, default=4, help='iter_file_parallel processes, 1 parses serially')
+    ap.add_argument('--parse-chunk-size', type=int, default=1024 * 1024, help='bytes per parsed range')
+    ap.add_argument('--batch-size', type=int, default=100, help='clean and fill batch size')
+    ap.add_argument('--lookup-threads', type=int, default=8, help='dedup lookup threads of the cleaner')
+    ap.add_argument('--dedup-index', action='store_true', help='dedup through the bloom filter index')
+    ap.add_argument('--norm-batch-size', type=int, default=getattr(settings, 'NORM_BATCH_SIZE', 100))
+    ap.add_argument('--norm-concurrency', type=int, default=4, help='norm batches in flight')
+    ap.add_argument('--norm-latency', type=float, default=0.0, help='seconds the norm stand-in waits per request')
+    ap.add_argument('--es-batch-size', type=int, default=2000, help='documents per sinker batch')
+    ap.add_argument('--bulk-size', type=int, default=500, help='documents per bulk request')
+    ap.add_argument('--bulk-threads', type=int, default=4, help='parallel_bulk threads, 1 uses streaming_bulk')
+    ap.add_argument('--work-dir', help='directory of the generated feeds, a temporary one by default')
+    ap.add_argument('--json', help='also write the report to this file')
+    args = ap.parse_args()
+
+    feeds = args.feeds.upper().split(',') if args.feeds else feed_names()
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='bench_pipeline_')
+    if not args.work_dir:
+        # registered before the workers, so it runs after their exit hooks
+        atexit.register(shutil.rmtree, work_dir, True)
+    src_dir = os.path.join(work_dir, 'src')
+    xml_dir = os.path.join(work_dir, 'xml')
+    for d in (src_dir, xml_dir):
+        if not os.path.isdir(d):
+            os.makedirs(d)
+    configure(args, work_dir)
+
+    total_bytes = 0
+    for name in feeds:
+        total_bytes += write_feed(os.path.join(src_dir, '%s.xml' % name.lower()), name, args.records, args.desc_size)
+    print('%s feeds, %s records each, %.1f MB' % (len(feeds), args.records, total_bytes / 1048576.0))
+
+    stub = StubServer(src_dir, args.norm_latency)
+    stats = []
+    try:
+        run_download(stats, feeds, stub, xml_dir, args.records)
+        parsed = run_parse(stats, feeds, xml_dir)
+        cleaned = run_clean(stats, parsed)
+        del parsed
+        normed = run_normalize(stats, cleaned, stub)
+        del cleaned
+        filled = run_fill(stats, normed)
+        del normed
+        run_sink(stats, filled, stub)
+    finally:
+        stub.close()
+
+    print_report(stats)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump([s.as_dict() for s in stats], f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
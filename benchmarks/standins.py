@@ -0,0 +1,279 @@
+"""
+Local stand-ins for the services of the pipeline, for the benchmarks and tests.
+
+* StubServer: one http server serving the feed files, the norm api and the
+  ES endpoints an index set up and bulk writes go through
+* MemoryRedis: the redis commands and pubsub channels the workers use
+* MemoryMongo: collections answering `find` with {} or {field: {'$in': [...]}}
+"""
+import os
+import json
+import time
+import queue
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# synthetic major scores, sums of the weights in majors_bucket
+MAJOR_SCORES = (80, 55, 50, 45, 40, 37, 35, 18, 10, 6, 3, 0.2, 1, 0.02)
+
+
+def normalize_job(job, i):
+    """a plausible norm api answer for one job"""
+    title = job.get('title') or ''
+    return {
+        'closest_lay_title': [title],
+        'normalized_city': [job.get('city') or ''],
+        'normalized_state_name': job.get('state') or '',
+        'clean_org_name': (job.get('organization') or '').lower(),
+        'display_org_name': job.get('organization') or '',
+        'major_group_string': 'Synthetic',
+        'soc_code': '15-1132.00',
+        'skills': ['communication', 'teamwork'],
+        'major': {'major_%d' % ((i + k) % 50): MAJOR_SCORES[(i + k) % len(MAJOR_SCORES)] for k in range(5)},
+        'jobLevel': 1,
+        'educationDegree': 2,
+        'job_type': ['full_time'],
+        'benefits': ['401k'],
+        'Visa_sponsorship': '',
+    }
+
+
+class StubServer(object):
+    """
+    Threaded http server on a free local port:
+    * GET /feeds/<file>: files of `feed_dir`
+    * POST /norm: norm api, `norm_latency` seconds per request
+    * GET /, HEAD and PUT /<index>: enough of ES for the client and index set up
+    * POST /_bulk: ES bulk api, counts the documents
+    """
+
+    def __init__(self, feed_dir, norm_latency=0.0):
+        self.feed_dir = feed_dir
+        self.norm_latency = norm_latency
+        self.bulk_docs = 0
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def _send(self, body, content_type='application/json', status=200):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                # checked by the elasticsearch client before its first request
+                self.send_header('X-Elastic-Product', 'Elasticsearch')
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_HEAD(self):
+                # no index exists, JobPosting.init() creates it
+                self._send(b'', status=404)
+
+            def do_PUT(self):
+                self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                self._send(json.dumps({'acknowledged': True}).encode('utf-8'))
+
+            def do_GET(self):
+                if self.path == '/':
+                    info = {'version': {'number': '7.17.0', 'build_flavor': 'default'},
+                            'tagline': 'You Know, for Search'}
+                    return self._send(json.dumps(info).encode('utf-8'))
+                path = os.path.join(stub.feed_dir, os.path.basename(self.path))
+                if not self.path.startswith('/feeds/') or not os.path.exists(path):
+                    return self._send(b'{}', status=404)
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/xml')
+                self.send_header('Content-Length', str(os.path.getsize(path)))
+                self.end_headers()
+                with open(path, 'rb') as f:
+                    while True:
+                        chunk = f.read(1024 * 1024)
+                        if not chunk:
+                            break
+                        self.wfile.write(chunk)
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                if self.path.startswith('/norm'):
+                    if stub.norm_latency:
+                        time.sleep(stub.norm_latency)
+                    jobs = json.loads(body.decode('utf-8'))['jobs']
+                    rsp = {'normalized_jobs': [normalize_job(job, i) for i, job in enumerate(jobs)]}
+                    return self._send(json.dumps(rsp).encode('utf-8'))
+                if self.path.endswith('/_bulk'):
+                    # action and source lines alternate
+                    n = body.count(b'\n') // 2
+                    stub.bulk_docs += n
+                    items = [{'index': {'status': 201}} for _ in range(n)]
+                    return self._send(json.dumps({'errors': False, 'items': items}).encode('utf-8'))
+                self._send(b'{}', status=404)
+
+            def log_message(self, *args):
+                pass
+
+        self._httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._httpd.daemon_threads = True
+        self.url = 'http://127.0.0.1:%d' % self._httpd.server_address[1]
+        thread = threading.Thread(target=self._httpd.serve_forever, name='stub-server')
+        thread.daemon = True
+        thread.start()
+
+    def close(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+
+class _MemoryPipeline(object):
+
+    def __init__(self, client):
+        self.client = client
+        self.ops = []
+
+    def __getattr__(self, name):
+        def op(*args, **kwargs):
+            self.ops.append((getattr(self.client, name), args, kwargs))
+            return self
+        return op
+
+    def execute(self):
+        ops, self.ops = self.ops, []
+        return [meth(*args, **kwargs) for meth, args, kwargs in ops]
+
+
+class _MemoryPubSub(object):
+
+    def __init__(self, client):
+        self.client = client
+        self.messages = queue.Queue()
+
+    def subscribe(self, *channels):
+        with self.client.lock:
+            for channel in channels:
+                self.client.channels.setdefault(channel, []).append(self.messages)
+
+    def listen(self):
+        while True:
+            yield self.messages.get()
+
+
+class MemoryRedis(object):
+    """in-process stand-in of the redis commands the benchmarked stages use"""
+
+    def __init__(self):
+        self.data = {}
+        self.channels = {}
+        self.lock = threading.Lock()
+
+    def pubsub(self, ignore_subscribe_messages=False):
+        return _MemoryPubSub(self)
+
+    def publish(self, channel, message):
+        with self.lock:
+            subscribers = list(self.channels.get(channel, ()))
+        for messages in subscribers:
+            messages.put({'type': 'message', 'channel': channel, 'data': message})
+        return len(subscribers)
+
+    def pipeline(self, transaction=False):
+        return _MemoryPipeline(self)
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value):
+        self.data[key] = value
+        return True
+
+    def mget(self, keys):
+        return [self.data.get(k) for k in keys]
+
+    def incr(self, key):
+        self.data[key] = int(self.data.get(key) or 0) + 1
+        return self.data[key]
+
+    def hincrby(self, key, field, amount=1):
+        h = self.data.setdefault(key, {})
+        h[field] = int(h.get(field) or 0) + amount
+        return h[field]
+
+    def hincrbyfloat(self, key, field, amount=1.0):
+        h = self.data.setdefault(key, {})
+        h[field] = float(h.get(field) or 0) + amount
+        return h[field]
+
+    def hgetall(self, key):
+        return dict(self.data.get(key, {}))
+
+    def hdel(self, key, *fields):
+        h = self.data.get(key, {})
+        return sum(1 for f in fields if h.pop(f, None) is not None)
+
+    def sadd(self, key, *values):
+        s = self.data.setdefault(key, set())
+        before = len(s)
+        s.update(values)
+        return len(s) - before
+
+    def smembers(self, key):
+        return set(self.data.get(key, ()))
+
+    def hset(self, key, field=None, value=None, mapping=None):
+        h = self.data.setdefault(key, {})
+        if field is not None:
+            h[field] = value
+        h.update(mapping or {})
+        return 1
+
+    def hsetnx(self, key, field, value):
+        h = self.data.setdefault(key, {})
+        if field in h:
+            return 0
+        h[field] = value
+        return 1
+
+    def hmget(self, key, fields):
+        h = self.data.get(key, {})
+        return [h.get(f) for f in fields]
+
+    def expire(self, key, seconds):
+        return True
+
+
+
+class MemoryCollection(object):
+
+    def __init__(self, docs):
+        self.docs = docs
+        # find calls, the tests count the round trips
+        self.queries = 0
+        # field -> {value: docs}, built on first query of the field
+        self._indexes = {}
+
+    def _index(self, field):
+        index = self._indexes.get(field)
+        if index is None:
+            index = self._indexes[field] = {}
+            for doc in self.docs:
+                index.setdefault(doc.get(field), []).append(doc)
+        return index
+
+    def find(self, query, projection=None, batch_size=None):
+        self.queries += 1
+        if not query:
+            matched = self.docs
+        else:
+            (field, cond), = query.items()
+            index = self._index(field)
+            matched = [d for value in set(cond['$in']) for d in index.get(value, ())]
+        if projection:
+            keep = [k for k, v in projection.items() if v and k != '_id']
+            return [{k: d[k] for k in keep if k in d} for d in matched]
+        return list(matched)
+
+
+class MemoryMongo(dict):
+    """{collection name: MemoryCollection}, indexable like a pymongo database"""
+
+    def __missing__(self, name):
+        collection = self[name] = MemoryCollection([])
+        return collection
@@ -0,0 +1,170 @@
+"""
+Synthetic XML feeds in the shapes handled by workers/record_cleaner.
+
+Flat feeds (JUJU, TopUSAJobs, Appcast, Jobs2Careers, ...) are generated from
+the `fields` their Parser declares, DIRECT_EMPLOYERS in its hr-xml layout
+with the hr / oa namespaces. Record tags come from settings.JOB_SOURCES the
+same way the parser looks them up.
+"""
+import os
+import random
+import pkgutil
+import importlib
+from xml.sax.saxutils import escape
+
+TITLES = ('Software Engineer', 'Registered Nurse', 'Truck Driver', 'Accountant', 'Sales Associate',
+          'Data Analyst', 'Warehouse Worker', 'Customer Service Representative', 'Teacher',
+          'Mechanical Engineer', 'Cashier', 'Project Manager', 'Pharmacist', 'Electrician')
+COMPANIES = ('Acme Corp', 'Globex', 'Initech', 'Umbrella Health', 'Stark Industries', 'Wayne Logistics',
+             'Hooli', 'Vandelay Imports', 'Soylent', 'Wonka Foods')
+LOCATIONS = (('New York', 'NY'), ('San Francisco', 'CA'), ('Austin', 'TX'), ('Chicago', 'IL'),
+             ('Seattle', 'WA'), ('Boston', 'MA'), ('Denver', 'CO'), ('Miami', 'FL'), ('Atlanta', 'GA'))
+CATEGORIES = ('Engineering', 'Healthcare', 'Transportation', 'Finance', 'Retail', 'Education')
+SENTENCES = (
+    'We are looking for a motivated professional to join our growing team.',
+    'You will work closely with <b>cross-functional</b> partners to deliver results.',
+    'Competitive salary, health insurance &amp; 401(k) matching are offered.',
+    '<ul><li>Bachelor degree or equivalent experience</li><li>Strong communication skills</li></ul>',
+    'Candidates must be authorized to work in the United States.',
+    'This is a full-time position with flexible hours and remote options.',
+)
+
+# raw field name -> kind of value, covering the fields of every flat feed
+FIELD_KINDS = {
+    'id': 'id', 'job_reference': 'id', 'referencenumber': 'id', 'JobID': 'id',
+    'title': 'title', 'JobTitle': 'title',
+    'description': 'desc', 'body': 'desc', 'JobDescription': 'desc',
+    'company': 'company', 'employer': 'company', 'JobCompany': 'company',
+    'city': 'city', 'JobCity': 'city',
+    'state': 'state', 'JobState': 'state',
+    'zip': 'zip', 'postalcode': 'zip', 'JobZip': 'zip',
+    'location': 'location',
+    'posted_at': 'date', 'date': 'date', 'postingdate': 'date',
+    'url': 'url', 'joburl': 'url', 'JobUrl': 'url',
+    'category': 'category', 'appcast_category': 'category', 'industry0': 'category',
+    'JobCategory': 'category',
+}
+
+DE_FEED = 'DIRECT_EMPLOYERS'
+DEFAULT_FEED_TAG = 'job'
+
+
+def feed_names():
+    """names of the feeds with a record_cleaner module"""
+    import workers.record_cleaner as package
+    names = []
+    for info in pkgutil.iter_modules(package.__path__):
+        module = importlib.import_module('workers.record_cleaner.%s' % info.name)
+        if hasattr(module, 'Parser') and getattr(module.Parser, 'source_name', None):
+            names.append(info.name.upper())
+    return sorted(names)
+
+
+def feed_tag(feed_name):
+    try:
+        import settings
+        for feed in settings.JOB_SOURCES:
+            if feed['name'].upper() == feed_name.upper():
+                return feed['tag']
+    except (ImportError, AttributeError):
+        pass
+    return DEFAULT_FEED_TAG
+
+
+def build_desc(rnd, size):
+    parts = []
+    length = 0
+    while length < size:
+        sentence = rnd.choice(SENTENCES)
+        parts.append('<p>%s</p>' % sentence)
+        length += len(sentence) + 7
+    return ''.join(parts)
+
+
+def build_values(rnd, i, desc_size):
+    city, state = rnd.choice(LOCATIONS)
+    return {
+        'id': 'job-%08d' % i,
+        'title': rnd.choice(TITLES),
+        # descriptions are html, as escaped text in the xml
+        'desc': build_desc(rnd, desc_size),
+        'company': rnd.choice(COMPANIES),
+        'city': city,
+        'state': state,
+        'zip': '%05d' % rnd.randint(1000, 99999),
+        'location': '%s, %s' % (city, state),
+        'date': '2026-10-%02d' % rnd.randint(1, 28),
+        'url': 'https://jobs.example.com/%d' % i,
+        'category': rnd.choice(CATEGORIES),
+    }
+
+
+def _split_tag(tag):
+    # '{ns}local' -> (ns, local)
+    if tag.startswith('{'):
+        ns, local = tag[1:].split('}', 1)
+        return ns, local
+    return None, tag
+
+
+def flat_record(tag, fields, values):
+    children = ''.join('<%s>%s</%s>' % (f, escape(values[FIELD_KINDS.get(f, 'id')]), f) for f in fields)
+    return '<%s>%s</%s>\n' % (tag, children, tag)
+
+
+def de_record(tag, namespaces, values):
+    ns, local = _split_tag(tag)
+    name = 'hr:%s' % local if ns == namespaces['hr'] else local
+    return (
+        '<{name} xmlns:hr="{hr}" xmlns:oa="{oa}" validFrom="{date}">'
+        '<hr:AlternateDocumentID>{id}</hr:AlternateDocumentID>'
+        '<hr:PositionProfile>'
+        '<hr:PositionTitle>{title}</hr:PositionTitle>'
+        '<hr:PositionOrganization><hr:OrganizationIdentifiers>'
+        '<hr:OrganizationName>{company}</hr:OrganizationName>'
+        '</hr:OrganizationIdentifiers></hr:PositionOrganization>'
+        '<hr:PositionLocation><hr:LocationName>{state}-{city}</hr:LocationName>'
+        '<hr:ReferenceLocation><hr:CountryCode>US</hr:CountryCode>'
+        '<oa:PostalCode>{zip}</oa:PostalCode></hr:ReferenceLocation></hr:PositionLocation>'
+        '<hr:PositionFormattedDescription><hr:Content>{desc}</hr:Content></hr:PositionFormattedDescription>'
+        '<hr:JobCategoryCode>{category}</hr:JobCategoryCode>'
+        '<hr:PostingInstruction><hr:ApplicationMethod><hr:Communication>'
+        '<oa:URI>{url}</oa:URI>'
+        '</hr:Communication></hr:ApplicationMethod></hr:PostingInstruction>'
+        '</hr:PositionProfile>'
+        '</{name}>\n'
+    ).format(name=name, hr=namespaces['hr'], oa=namespaces['oa'],
+             **{k: escape(v) for k, v in values.items()})
+
+
+def write_feed(path, feed_name, n_records, desc_size=1500, seed=0):
+    """
+    write `n_records` synthetic records of `feed_name` to `path`
+    returns the number of bytes written
+    """
+    module = importlib.import_module('workers.record_cleaner.%s' % feed_name.lower())
+    parser_cls = module.Parser
+    tag = feed_tag(feed_name)
+    rnd = random.Random('%s-%s' % (seed, feed_name))
+
+    with open(path, 'w') as f:
+        f.write('<?xml version="1.0" encoding="utf-8"?>\n<source>\n')
+        for i in range(n_records):
+            values = build_values(rnd, i, desc_size)
+            if isinstance(parser_cls.fields, dict):
+                f.write(de_record(tag, parser_cls.namespaces, values))
+            else:
+                f.write(flat_record(tag, parser_cls.fields or ('id', 'title', 'description', 'company',
+                                                               'city', 'state', 'zip', 'url'), values))
+        f.write('</source>\n')
+    return os.path.getsize(path)
+
+
+
+def reference_values():
+    """valid titles, cities and states of the synthetic jobs, for the Mongo stand-in"""
+    return {
+        'titles': list(TITLES),
+        'cities': [city for city, _ in LOCATIONS],
+        'states': [state for _, state in LOCATIONS],
+    }
@@ -0,0 +1,147 @@
+import os
+import re
+import sys
+import types
+import hashlib
+import logging
+import tempfile
+import importlib.util
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# worker modules import each other top-level, as when a worker runs
+sys.path.insert(0, os.path.join(ROOT, 'workers'))
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+sys.path.insert(0, ROOT)
+
+
+# minimal stand-ins of the deployment packages which are not part of this
+# tree (settings, framework, utils, models, topics), only installed when the
+# real ones are not importable, so the suite runs on a bare checkout too
+
+def _module(name, **attrs):
+    module = types.ModuleType(name)
+    module.__dict__.update(attrs)
+    sys.modules[name] = module
+    parent, _, child = name.rpartition('.')
+    if parent:
+        setattr(sys.modules[parent], child, module)
+    return module
+
+
+def _package(name, **attrs):
+    return _module(name, __path__=[], **attrs)
+
+
+def _missing(name):
+    return importlib.util.find_spec(name) is None
+
+
+def _stub_settings():
+    from standins import MemoryRedis
+
+    r_db = MemoryRedis()
+    _package(
+        'settings',
+        r_db=r_db,
+        JOB_SOURCES=[{'name': 'DIRECT_EMPLOYERS', 'tag': 'PositionOpening'},
+                     {'name': 'TOPUSAJOBS', 'tag': 'Job'}],
+        JOB_DESC_MAX_LEN=5000,
+        FAST_MODE=True,
+        JOB_DESC_ALLOWED_TAGS=[],
+        JOB_DESC_ALLOWED_ATTRS={},
+        MAX_JOBS_PER_FEED=0,
+        KEY_PROCESS_SEQ='process_seq',
+        KEY_WORKER_READY='worker:ready:%s',
+        LOCATION_EDIT_DISTANCE=2,
+        NORM_BATCH_SIZE=100,
+        URL_NORM_JOB=None,
+        ES_BATCH_SIZE=500,
+        r_batch_num_key='norm:batch',
+        XML_PATH=os.path.join(tempfile.gettempdir(), 'tests_xml_%s' % os.getpid()),
+        FAKE_DOWNLOAD=False,
+        MASTER_INTERVAL=1,
+        KAFKA_WAIT_TIME=0,
+        TOPIC_COUNT_MAX_IDLE_TIME=600,
+    )
+    _module('settings._redis', r_db=r_db)
+
+
+def _stub_framework():
+
+    class BaseWorker(object):
+
+        def __init__(self, name, PreTopic=None, NextTopic=None):
+            self.logger = logging.getLogger(name)
+            self.produced = []
+
+        def produce_msg(self, *topic, **kwargs):
+            self.produced.append(kwargs)
+
+    _package('framework')
+    _module('framework.base_worker', BaseWorker=BaseWorker)
+    _module('framework.reports', incr=lambda *args: None, incr_by=lambda *args: None)
+
+
+def _sha1(*values):
+    return hashlib.sha1('|'.join(map(str, values)).encode('utf-8')).hexdigest()
+
+
+def _stub_utils():
+
+    class UnsupportedFeed(Exception):
+        pass
+
+    def build_desc_cleaner(max_len, *args):
+        tag = re.compile(r'<[^>]+>')
+        # plain text comes back unchanged, as from the real cleaner
+        return lambda raw: tag.sub(' ', raw)[:max_len]
+
+    def get_or_build_job_id(**data):
+        return _sha1(data.get('source'), data.get('id')), True
+
+    _package('utils')
+    _module('utils.cache', init_redis=lambda: None)
+    _module('utils.clean_es', clean_es=lambda process_seq: (True, 0.0))
+    _module('utils.exceptions', UnsupportedFeed=UnsupportedFeed)
+    _module('utils.text', build_desc_cleaner=build_desc_cleaner)
+    _module('utils.dup_detect', build_listing_hash=_sha1, build_unique_id=_sha1,
+            get_or_build_job_id=get_or_build_job_id)
+    _module('utils.pay_price', calc_pay_price=lambda posting_date, price: price)
+
+
+def _stub_models():
+    if _missing('elasticsearch_dsl'):
+        return
+    from elasticsearch_dsl import Document, Date, Float, Integer, Keyword, Object, Text
+
+    class JobPosting(Document):
+        title = Text()
+        postingDate = Date()
+        price = Float()
+        jobLevel = Integer()
+        majorPriority = Object()
+        skillsets = Keyword(multi=True)
+
+        class Index:
+            name = 'jobs'
+
+    _package('models')
+    _module('models.joblisting', JobPosting=JobPosting)
+
+
+def _stub_topics():
+
+    class Topic(object):
+        topic_name = None
+
+    _package('topics')
+    _module('topics.job_source', JobSourceTopic=type('JobSourceTopic', (Topic, ), {'topic_name': 'job_source'}))
+    _module('topics.downloaded_xml',
+            DownloadedXmlTopic=type('DownloadedXmlTopic', (Topic, ), {'topic_name': 'downloaded_xml'}))
+
+
+for _name, _stub in (('settings', _stub_settings), ('framework', _stub_framework), ('utils', _stub_utils),
+                     ('models', _stub_models), ('topics', _stub_topics)):
+    if _missing(_name):
+        _stub()
@@ -0,0 +1,115 @@
+"""
+MicroBatcher flushes on size, bytes and latency, and never drops a batch
+its flush function failed on.
+"""
+import time
+import threading
+
+import pytest
+
+from batching import MicroBatcher
+
+
+class Flushes(object):
+    """flush function recording its batches, failing while `fail` is set"""
+
+    def __init__(self):
+        self.batches = []
+        self.fail = False
+        self.flushed = threading.Event()
+
+    def __call__(self, items):
+        if self.fail:
+            raise IOError('sink down')
+        self.batches.append(list(items))
+        self.flushed.set()
+
+
+def test_flush_at_max_size():
+    flushes = Flushes()
+    batcher = MicroBatcher(flushes, 3)
+    for i in range(7):
+        batcher.add(i)
+
+    assert flushes.batches == [[0, 1, 2], [3, 4, 5]]
+    assert len(batcher) == 1
+
+    batcher.flush()
+    assert flushes.batches[-1] == [6]
+    assert len(batcher) == 0
+
+
+def test_flush_at_max_bytes():
+    flushes = Flushes()
+    batcher = MicroBatcher(flushes, 100, max_bytes=10, sizeof=len)
+    for item in ('abcd', 'efgh', 'ijkl', 'mn'):
+        batcher.add(item)
+
+    assert flushes.batches == [['abcd', 'efgh', 'ijkl']]
+    assert len(batcher) == 1
+
+
+def test_partial_batch_flushed_after_max_latency():
+    flushes = Flushes()
+    batcher = MicroBatcher(flushes, 100, max_latency=0.05)
+    batcher.add('a')
+
+    assert flushes.flushed.wait(2)
+    assert flushes.batches == [['a']]
+    batcher.close()
+
+
+def test_failed_batch_is_requeued_in_front_and_raised():
+    flushes = Flushes()
+    batcher = MicroBatcher(flushes, 2)
+    batcher.add(1)
+    flushes.fail = True
+    with pytest.raises(IOError):
+        batcher.add(2)
+    assert len(batcher) == 2
+
+    flushes.fail = False
+    batcher.add(3)
+    assert flushes.batches == [[1, 2, 3]]
+    assert len(batcher) == 0
+
+
+def test_failed_batch_keeps_its_bytes():
+    flushes = Flushes()
+    batcher = MicroBatcher(flushes, 100, max_bytes=6, sizeof=len)
+    flushes.fail = True
+    with pytest.raises(IOError):
+        batcher.add('abcdef')
+
+    # still over max_bytes, the next add flushes everything
+    flushes.fail = False
+    batcher.add('g')
+    assert flushes.batches == [['abcdef', 'g']]
+
+
+def test_failed_deadline_flush_is_retried():
+    flushes = Flushes()
+    flushes.fail = True
+    batcher = MicroBatcher(flushes, 100, max_latency=0.05)
+    batcher.add('a')
+    time.sleep(0.2)
+    assert flushes.batches == []
+    assert len(batcher) == 1
+
+    flushes.fail = False
+    assert flushes.flushed.wait(2)
+    assert flushes.batches == [['a']]
+    batcher.close()
+
+
+def test_close_logs_a_failed_flush():
+    flushes = Flushes()
+    batcher = MicroBatcher(flushes, 100)
+    batcher.add('a')
+    flushes.fail = True
+
+    # at exit nothing is left to raise to
+    batcher.close()
+    assert len(batcher) == 1
+    # left for the exit hook
+    flushes.fail = False
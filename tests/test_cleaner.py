@@ -0,0 +1,60 @@
+"""
+Batched dedup lookups must serialize every record sharing a dedup key.
+"""
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import cleaner
+
+
+def record(id, title='Nurse', company='Acme', city='Boston', state='MA', source='feed-a'):
+    return {'source': source, 'id': id, 'title': title, 'titleDisplay': title,
+            'company': company, 'companyDisplay': company, 'city': city, 'state': state}
+
+
+def test_groups_share_any_key():
+    datas = [
+        record('1'),
+        record('2', title='Driver'),
+        # same listing under another feed record
+        record('3', source='feed-b'),
+        # same feed record, listing changed
+        record('2', title='Truck Driver'),
+        record('4', title='Cook'),
+        # joins the groups of 4 and 1
+        record('4', title='Nurse', company='Acme', source='feed-a'),
+    ]
+    assert cleaner.group_by_keys(datas) == [[0, 2, 4, 5], [1, 3]]
+
+
+def test_keys_match_the_job_id_fields():
+    a = record('1', source='feed-a')
+    b = record('9', source='feed-b')
+    assert cleaner.lookup_keys(a)[0] == cleaner.lookup_keys(b)[0]
+    assert cleaner.lookup_keys(a)[0] != cleaner.lookup_keys(record('1', city='Salem'))[0]
+
+
+def test_same_key_never_runs_concurrently(monkeypatch):
+    running = {}
+    lock = threading.Lock()
+    overlaps = []
+
+    def get_or_build_job_id(**data):
+        key = cleaner.lookup_keys(data)[0]
+        with lock:
+            if running.get(key):
+                overlaps.append(key)
+            running[key] = True
+        time.sleep(0.01)
+        with lock:
+            running[key] = False
+        return 'job-%s' % data['id'], True
+
+    monkeypatch.setattr(cleaner, 'get_or_build_job_id', get_or_build_job_id)
+    datas = [record(str(i), title='Title %s' % (i % 3)) for i in range(12)]
+    with ThreadPoolExecutor(4) as executor:
+        results = cleaner.lookup_job_ids(datas, executor)
+
+    assert results == [('job-%s' % i, True) for i in range(12)]
+    assert overlaps == []
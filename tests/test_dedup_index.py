@@ -0,0 +1,84 @@
+"""
+DedupIndex routing of new and old jobs, against the in-memory redis stand-in.
+"""
+import pytest
+
+import dedup_index
+from standins import MemoryRedis
+
+
+def record(title, city='Boston', source='feed-a', id='1'):
+    return {'source': source, 'id': id, 'titleDisplay': title, 'companyDisplay': 'Acme',
+            'city': city, 'state': 'MA'}
+
+
+@pytest.fixture
+def redis(monkeypatch):
+    r = MemoryRedis()
+    monkeypatch.setattr(dedup_index, 'r_db', r)
+    return r
+
+
+@pytest.fixture
+def seq():
+    return ['seq-1']
+
+
+def new_index(seq, tmp_path):
+    return dedup_index.DedupIndex(lambda: seq[0], path=str(tmp_path / 'bloom.bin'))
+
+
+def test_first_claim_is_new(redis, seq, tmp_path):
+    index = new_index(seq, tmp_path)
+    nurse, cook = record('Nurse'), record('Cook')
+    assert index.lookup_many([nurse, cook, record('Nurse', source='feed-b')]) == [
+        (dedup_index.dedup_key(nurse), True),
+        (dedup_index.dedup_key(cook), True),
+        # same listing later in the batch
+        (dedup_index.dedup_key(nurse), False),
+    ]
+    assert index.lookup_many([cook]) == [(dedup_index.dedup_key(cook), False)]
+    assert index.index_hits == 1
+
+
+def test_negatives_are_claimed_without_a_read(redis, seq, tmp_path, monkeypatch):
+    reads = []
+    monkeypatch.setattr(redis, 'hmget', lambda key, fields: reads.append(fields) or [None] * len(fields))
+
+    index = new_index(seq, tmp_path)
+    results = index.lookup_many([record('Title %s' % i) for i in range(50)])
+    assert all(is_new for _, is_new in results)
+    assert index.not_in_filter == 50
+    assert reads == []
+
+
+def test_claimed_by_another_cleaner_is_old(redis, seq, tmp_path):
+    first, second = new_index(seq, tmp_path), new_index(seq, tmp_path)
+    nurse = record('Nurse')
+    assert first.lookup_many([nurse]) == [(dedup_index.dedup_key(nurse), True)]
+    # not in the filter of the second cleaner, the claim tells it is old
+    assert second.lookup_many([nurse]) == [(dedup_index.dedup_key(nurse), False)]
+    assert second.claimed_elsewhere == 1
+
+
+def test_new_process_seq_starts_empty(redis, seq, tmp_path):
+    index = new_index(seq, tmp_path)
+    nurse = record('Nurse')
+    index.lookup_many([nurse])
+    seq[0] = 'seq-2'
+    assert index.lookup_many([nurse]) == [(dedup_index.dedup_key(nurse), True)]
+    assert index.process_seq == 'seq-2'
+
+
+def test_snapshot_resumes_within_the_seq_only(redis, seq, tmp_path):
+    index = new_index(seq, tmp_path)
+    nurse = record('Nurse')
+    index.lookup_many([nurse])
+    index.save()
+
+    restarted = new_index(seq, tmp_path)
+    assert restarted.lookup_many([nurse]) == [(dedup_index.dedup_key(nurse), False)]
+    assert restarted.index_hits == 1
+
+    seq[0] = 'seq-2'
+    assert new_index(seq, tmp_path).lookup_many([nurse]) == [(dedup_index.dedup_key(nurse), True)]
@@ -0,0 +1,84 @@
+"""
+CachedDescCleaner must return exactly what the utils.text cleaner returns.
+"""
+import pytest
+
+from record_cleaner.base_record_parser import desc_clean
+from record_cleaner.desc_cleaner import CachedDescCleaner
+
+
+SAMPLES = [
+    # plain text, the fast path candidates
+    'We are hiring a Registered Nurse for our Boston clinic. Apply today!',
+    'Drive a company truck across the Midwest.\nHome every weekend.\n\nCDL-A required.',
+    '  Leading and trailing blanks  ',
+    'Pay: $18 - $22 per hour, 401(k) with 4% match; benefits start day 1.',
+    'Visit https://careers.example.com/jobs/1234 or email jobs@example.com to apply.',
+    'Tab\tseparated\tlist and unicode: café, naïve, • bullet, – dash',
+    '',
+    # markup, as the feeds send it
+    '<p>We are looking for a <strong>Software Engineer</strong> to join our team.</p>'
+    '<ul><li>5+ years of Python</li><li>Experience with <em>AWS</em></li></ul>',
+    '<div class="job-desc" style="color:red"><h2>About us</h2><p>Acme &amp; Co. is a '
+    '<a href="https://acme.example.com" target="_blank" onclick="track()">leading</a> retailer.</p></div>',
+    '<p>Requirements:<br>- High school diploma<br/>- Valid driver&#39;s license</p>',
+    '<script>alert("x")</script><p>Cashier, part time</p><style>p {color: red}</style>',
+    '<table><tr><td>Shift</td><td>Nights</td></tr></table><p>Pay &gt; $20/hr &lt;negotiable&gt;</p>',
+    '&lt;p&gt;Escaped markup sent as text&lt;/p&gt; &nbsp; &copy; 2026',
+    '<p>Unclosed <b>bold <i>italic</p> and a stray </div> tag',
+    'Windows line ends\r\nsecond line\r\n',
+    '<!-- internal note --><p>Warehouse Associate</p><![CDATA[ raw ]]>',
+    '<p>' + 'Competitive salary and benefits. ' * 400 + '</p>',
+    'Plain but long. ' * 600,
+]
+
+
+def reference():
+    return desc_clean.factory(*desc_clean.args)
+
+
+def build(**kwargs):
+    return CachedDescCleaner(desc_clean.factory, desc_clean.args, desc_clean.max_len, **kwargs)
+
+
+@pytest.mark.parametrize('raw', SAMPLES)
+def test_same_output_as_utils_text(raw):
+    clean = reference()
+    expected = clean(raw)
+
+    # unverified fast path, then the cache hit
+    cleaner = build(verify=0)
+    assert cleaner(raw) == expected
+    assert cleaner(raw) == expected
+
+    assert build(fast_path=False)(raw) == expected
+
+
+def test_same_output_through_the_pool():
+    clean = reference()
+    cleaner = build(processes=2)
+    try:
+        cleaner.clean_many(SAMPLES)
+        assert [cleaner(raw) for raw in SAMPLES] == [clean(raw) for raw in SAMPLES]
+    finally:
+        if cleaner._pool is not None:
+            cleaner._pool.shutdown()
+
+
+def test_pool_started_on_first_use():
+    cleaner = build(processes=2)
+    assert cleaner._pool is None
+    cleaner.clean_many([])
+    try:
+        assert cleaner._pool is not None
+    finally:
+        cleaner._pool.shutdown()
+
+
+def test_fast_path_turned_off_by_a_rewrite():
+    cleaner = CachedDescCleaner(lambda: lambda raw: raw.strip(), (), 1000, verify=10)
+    assert cleaner('same') == 'same'
+    assert cleaner.fast_path
+    assert cleaner(' padded ') == 'padded'
+    assert not cleaner.fast_path
+    assert cleaner(' padded ') == 'padded'
@@ -0,0 +1,44 @@
+"""
+Feed history survives between tasks and drives the longest first schedule.
+"""
+import pytest
+
+import feed_schedule
+
+
+@pytest.fixture
+def stats_path(tmp_path, monkeypatch):
+    path = str(tmp_path / 'feed_stats.json')
+    monkeypatch.setattr(feed_schedule, 'FEED_STATS_PATH', path)
+    monkeypatch.setattr(feed_schedule.load_history, '__defaults__', (path,))
+    monkeypatch.setattr(feed_schedule.update_history, '__defaults__', (0.5, path))
+    return path
+
+
+def test_history_is_a_moving_average(stats_path):
+    assert feed_schedule.load_history(['A']) == {}
+    feed_schedule.update_history({'A': {'download_time': 10.0, 'bytes': 100.0}})
+    feed_schedule.update_history({'A': {'download_time': 20.0}, 'B': {'parse_time': 5.0}})
+    assert feed_schedule.load_history(['A', 'B', 'C']) == {
+        'A': {'download_time': 15.0, 'bytes': 100.0},
+        'B': {'parse_time': 5.0},
+    }
+
+
+def test_longest_first(stats_path):
+    feed_schedule.update_history({
+        'A': {'download_time': 10.0, 'parse_time': 10.0},
+        'B': {'download_time': 50.0, 'parse_time': 10.0},
+        'C': {'download_time': 5.0},
+    })
+    feeds = [{'name': 'A'}, {'name': 'B'}, {'name': 'C'}, {'name': 'D'}]
+    ordered, finish = feed_schedule.schedule_feeds(feeds, 2)
+    # D has no history, it costs the median
+    assert [f['name'] for f in ordered] == ['B', 'A', 'D', 'C']
+    assert finish == {'B': 60.0, 'A': 20.0, 'D': 40.0, 'C': 45.0}
+
+    # a prefetched feed is not downloaded again
+    feeds[1]['prefetched'] = True
+    ordered, finish = feed_schedule.schedule_feeds(feeds, 2)
+    assert [f['name'] for f in ordered] == ['A', 'D', 'B', 'C']
+    assert finish['B'] == 30.0
@@ -0,0 +1,29 @@
+"""
+The idle shortcut of the master never ends a task while workers hold messages.
+"""
+import pytest
+
+import master
+
+
+@pytest.fixture
+def idle_master(monkeypatch):
+    m = master.Master({}, [])
+    # no counter moved for longer than TOPIC_COUNT_MAX_IDLE_TIME
+    m._metrics.update([], now=0.0)
+    flushes = []
+    monkeypatch.setattr(master, 'publish_flush', lambda: flushes.append(1))
+    m.flushes = flushes
+    return m
+
+
+def test_idle_waits_for_pending_workers(idle_master, monkeypatch):
+    monkeypatch.setattr(master, 'pending_workers', lambda: ['normalizer:host:1'])
+    assert idle_master.handle_monitor() == master.ENOTFIN
+    assert idle_master.flushes == [1]
+
+
+def test_idle_finishes_once_nothing_is_held(idle_master, monkeypatch):
+    monkeypatch.setattr(master, 'pending_workers', lambda: [])
+    assert idle_master.handle_monitor() == master.SUCC
+    assert idle_master.flushes == []
@@ -0,0 +1,74 @@
+"""
+MongoEnricher fetches only the cache misses of a batch, with one $in query,
+and keeps a bounded cache.
+"""
+import pytest
+
+import mongo_enrich
+from standins import MemoryMongo, MemoryCollection
+
+
+SPECS = ({
+    'collection': 'titles',
+    'key': 'title1',
+    'field': 'title',
+    'fill': {'display': 'titleDisplay'},
+    'default': 'title1',
+}, )
+
+
+@pytest.fixture
+def db():
+    db = MemoryMongo()
+    db['titles'] = MemoryCollection([{'title': 'nurse', 'display': 'Nurse'},
+                                     {'title': 'cook', 'display': 'Cook'},
+                                     {'title': 'driver', 'display': 'Driver'}])
+    return db
+
+
+def job(title1, **extra):
+    return dict(extra, title1=title1)
+
+
+def test_misses_fetched_in_one_query(db):
+    enricher = mongo_enrich.MongoEnricher(db, SPECS, cache_size=10)
+    jobs = [job('nurse'), job('cook'), job('nurse'), job('welder'), job(None, titleDisplay='Kept')]
+    enricher.fill_many(jobs)
+
+    assert [j['titleDisplay'] for j in jobs] == ['Nurse', 'Cook', 'Nurse', 'welder', 'Kept']
+    assert db['titles'].queries == 1
+
+    # hits and cached misses are not queried again
+    enricher.fill_many([job('cook'), job('welder')])
+    assert db['titles'].queries == 1
+    enricher.fill_many([job('driver'), job('cook')])
+    assert db['titles'].queries == 2
+    assert enricher.queried == 4
+
+
+def test_cache_is_bounded(db):
+    enricher = mongo_enrich.MongoEnricher(db, SPECS, cache_size=2)
+    enricher.fill_many([job('nurse'), job('cook'), job('driver')])
+    assert len(enricher.caches[0]) == 2
+
+    # the least recently used key was evicted
+    enricher.fill_many([job('driver')])
+    assert db['titles'].queries == 1
+    enricher.fill_many([job('nurse')])
+    assert db['titles'].queries == 2
+
+
+def test_list_values_are_not_looked_up(db):
+    enricher = mongo_enrich.MongoEnricher(db, SPECS, cache_size=10)
+    jobs = [job(['nurse'], titleDisplay='Registered Nurse')]
+    enricher.fill_many(jobs)
+
+    assert jobs[0]['titleDisplay'] == 'Registered Nurse'
+    assert db['titles'].queries == 0
+
+
+def test_in_queries_are_chunked(db, monkeypatch):
+    monkeypatch.setattr(mongo_enrich, 'MONGO_IN_CHUNK_SIZE', 2)
+    enricher = mongo_enrich.MongoEnricher(db, SPECS, cache_size=10)
+    enricher.fill_many([job('nurse'), job('cook'), job('driver')])
+    assert db['titles'].queries == 2
@@ -0,0 +1,67 @@
+"""
+Master reads the counters of the topics exposing their keys in one
+pipeline, the other topics through their methods.
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import monitor
+from standins import MemoryRedis
+
+
+class MethodTopic(object):
+    # counters only behind the get_cnt_* methods
+
+    def __init__(self, name, redis):
+        self.topic_name = name
+        self.redis = redis
+
+    def get_cnt_produced(self):
+        return self.redis.get('%s:produced' % self.topic_name)
+
+    def get_cnt_consumed(self):
+        return self.redis.get('%s:consumed' % self.topic_name)
+
+    def get_cnt_cached(self):
+        return int(self.redis.get('%s:cached' % self.topic_name) or 0)
+
+
+class KeyTopic(MethodTopic):
+
+    def counter_keys(self):
+        return ['%s:%s' % (self.topic_name, counter) for counter in ('produced', 'consumed', 'cached')]
+
+
+@pytest.fixture
+def redis(monkeypatch):
+    r = MemoryRedis()
+    monkeypatch.setattr(monitor, 'r_db', r)
+    for topic, values in (('a', (5, 3, 1)), ('b', (2, 2, 0))):
+        for counter, value in zip(('produced', 'consumed', 'cached'), values):
+            r.set('%s:%s' % (topic, counter), str(value).encode())
+    return r
+
+
+def test_keyed_counters_read_in_one_pipeline(redis, monkeypatch):
+    counters = monitor.TopicCounters([KeyTopic('a', redis), KeyTopic('b', redis), KeyTopic('c', redis)])
+
+    pipelines = []
+    pipeline = redis.pipeline
+    monkeypatch.setattr(redis, 'pipeline', lambda **kw: pipelines.append(1) or pipeline(**kw))
+    monkeypatch.setattr(monitor.TopicCounters, '_read', staticmethod(lambda t: pytest.fail('method read')))
+    assert counters.read() == [(5, 3, 1), (2, 2, 0), (0, 0, 0)]
+    assert pipelines == [1]
+
+
+def test_other_topics_read_through_their_methods(redis, monkeypatch):
+    executor = ThreadPoolExecutor(2)
+    counters = monitor.TopicCounters([MethodTopic('a', redis), KeyTopic('b', redis)], executor)
+
+    pipelines = []
+    pipeline = redis.pipeline
+    monkeypatch.setattr(redis, 'pipeline', lambda **kw: pipelines.append(1) or pipeline(**kw))
+    assert counters.keys[0] is None
+    assert counters.read() == [(5, 3, 1), (2, 2, 0)]
+    assert pipelines == [1]
+    executor.shutdown()
@@ -0,0 +1,63 @@
+"""
+split_ranges must cut a staged feed at record boundaries only, so the
+parsed ranges hold every record once and in file order.
+"""
+import pytest
+
+pytest.importorskip('lxml')
+
+import parser
+
+
+def write_feed(path, n, desc='x' * 200):
+    with open(path, 'w') as f:
+        f.write('<?xml version="1.0" encoding="utf-8"?>\n<source xmlns:g="http://example.com/g">\n')
+        for i in range(n):
+            # a description mentioning the tag must not start a range
+            f.write('  <job><id>%d</id><desc>&lt;job&gt; %s</desc></job>\n' % (i, desc))
+        f.write('</source>\n')
+    return str(path)
+
+
+def test_ranges_cover_the_file_at_record_starts(tmp_path):
+    filename = write_feed(tmp_path / 'feed.xml', 200)
+    data = open(filename, 'rb').read()
+
+    header_end, ranges = parser.split_ranges(filename, 'job', chunk_size=2048)
+
+    assert data[header_end:].startswith(b'<job>')
+    assert b'<job>' not in data[:header_end]
+    assert len(ranges) > 1
+    assert ranges[0][0] == 0 and ranges[-1][1] == len(data)
+    for (_, end), (start, _) in zip(ranges, ranges[1:]):
+        assert end == start
+        assert data[start:].startswith(b'<job>')
+
+
+def test_one_range_below_the_chunk_size(tmp_path):
+    filename = write_feed(tmp_path / 'feed.xml', 5)
+    size = len(open(filename, 'rb').read())
+
+    header_end, ranges = parser.split_ranges(filename, 'job', chunk_size=1024 * 1024)
+
+    assert ranges == [(0, size)]
+    assert header_end > 0
+
+
+def test_no_record_is_one_range(tmp_path):
+    filename = write_feed(tmp_path / 'feed.xml', 0)
+    size = len(open(filename, 'rb').read())
+
+    assert parser.split_ranges(filename, 'job') == (0, [(0, size)])
+
+
+def test_ranges_parse_every_record_once_in_order(tmp_path, monkeypatch):
+    monkeypatch.setattr(parser, 'get_extract_meth', lambda feed_name: lambda elem: elem.findtext('id'))
+    filename = write_feed(tmp_path / 'feed.xml', 300)
+
+    header_end, ranges = parser.split_ranges(filename, 'job', chunk_size=4096)
+    ids = []
+    for start, end in ranges:
+        ids.extend(parser._parse_range((filename, 'FEED', 'job', header_end, start, end)))
+
+    assert ids == [str(i) for i in range(300)]
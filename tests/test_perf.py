@@ -0,0 +1,62 @@
+"""
+The perf switch is read on the calling thread, the flusher only runs while
+samples are recorded.
+"""
+import time
+
+import pytest
+
+import perf
+from standins import MemoryRedis
+
+
+@pytest.fixture
+def redis(monkeypatch):
+    r = MemoryRedis()
+    r.set('process_seq', b'seq-1')
+    monkeypatch.setattr(perf, 'r_db', r)
+    monkeypatch.setattr(perf.settings, 'KEY_PROCESS_SEQ', 'process_seq', raising=False)
+    monkeypatch.setattr(perf, 'PERF_FLUSH_INTERVAL', 0.05)
+    monkeypatch.setattr(perf, '_state', perf._State())
+    monkeypatch.setattr(perf, '_local', {})
+    monkeypatch.setattr(perf, '_flusher', None)
+    yield r
+    r.set(perf.KEY_PERF_ENABLED, '0')
+    deadline = time.time() + 2
+    while perf._flusher is not None and time.time() < deadline:
+        time.sleep(0.01)
+
+
+def test_switch_read_once_per_ttl(redis, monkeypatch):
+    reads = []
+    get = redis.get
+    monkeypatch.setattr(redis, 'get', lambda key: reads.append(key) or get(key))
+    monkeypatch.setattr(perf, 'PERF_SWITCH_TTL', 60)
+
+    for _ in range(100):
+        with perf.timed('stage'):
+            pass
+    assert reads == [perf.KEY_PERF_ENABLED]
+    assert perf._flusher is None
+    assert perf._local == {}
+
+
+def test_flusher_runs_while_enabled(redis, monkeypatch):
+    monkeypatch.setattr(perf, 'PERF_SWITCH_TTL', 0)
+    redis.set(perf.KEY_PERF_ENABLED, '1')
+    with perf.timed('stage', 10):
+        pass
+    assert perf._flusher is not None
+
+    deadline = time.time() + 2
+    while not perf.load_report('seq-1') and time.time() < deadline:
+        time.sleep(0.01)
+    assert perf.load_report('seq-1')['stage']['n'] == 10
+
+    # switched off from redis, the flusher stops once it has pushed everything
+    redis.set(perf.KEY_PERF_ENABLED, '0')
+    deadline = time.time() + 2
+    while perf._flusher is not None and time.time() < deadline:
+        time.sleep(0.01)
+    assert perf._flusher is None
+    assert not perf.enabled()
@@ -0,0 +1,62 @@
+"""
+FeedPrefetcher returns at its deadline and only marks fetched feeds current.
+"""
+import os
+import time
+import threading
+
+import pytest
+
+import prefetch
+from downloader import save_sidecar
+
+
+@pytest.fixture
+def prefetcher(tmp_path, monkeypatch):
+    live = tmp_path / 'live'
+    live.mkdir()
+    monkeypatch.setattr(prefetch, 'feed_filename',
+                        lambda name, path=str(live): os.path.join(path, '%s.xml' % name))
+    return prefetch.FeedPrefetcher(staging=str(tmp_path / 'staging'), concurrency=2)
+
+
+def fake_request(delays, release=None):
+    def _request(url, filename, session, chunk_size, validators_from=None):
+        name = os.path.basename(filename)[:-4]
+        if release is not None and name in release:
+            release[name].wait()
+        time.sleep(delays.get(name, 0))
+        if name.startswith('same'):
+            return 0, prefetch.NOT_MODIFIED
+        with open(filename, 'w') as f:
+            f.write('<source/>')
+        save_sidecar(filename, {'url': url, 'complete': True})
+        return 9, 'downloaded'
+    return _request
+
+
+def test_only_fetched_feeds_are_swapped_in(prefetcher, monkeypatch):
+    monkeypatch.setattr(prefetch, '_request', fake_request({}))
+    results = prefetcher.prefetch([{'name': 'new', 'url': 'u1'}, {'name': 'same', 'url': 'u2'}],
+                                  time.time() + 5)
+    assert results == {'new': 'downloaded', 'same': prefetch.NOT_MODIFIED}
+    assert prefetcher.swap_in() == {'new'}
+
+
+def test_deadline_is_honored(prefetcher, monkeypatch):
+    release = {'slow': threading.Event()}
+    monkeypatch.setattr(prefetch, '_request', fake_request({}, release))
+
+    try:
+        start = time.time()
+        feeds = [{'name': 'slow', 'url': 'u1'}, {'name': 'fast', 'url': 'u2'}]
+        results = prefetcher.prefetch(feeds, time.time() + 0.3)
+        assert time.time() - start < 2
+        assert results == {'fast': 'downloaded'}
+
+        # the next task starts, then the late download completes
+        assert prefetcher.swap_in() == {'fast'}
+    finally:
+        release['slow'].set()
+    time.sleep(0.2)
+    assert prefetcher.results == {}
@@ -0,0 +1,30 @@
+"""
+fingerprint_record hashes the description once, the listing hash is built
+from that digest.
+"""
+from record_fingerprint import fingerprint_record, text_hash
+
+
+def listing_hash(*values):
+    return '|'.join(values)
+
+
+def test_listing_hash_built_from_the_desc_digest():
+    data = fingerprint_record({'title': 'Nurse', 'company': 'Acme', 'city': 'Boston', 'state': 'MA',
+                               'desc': 'Night shift, ' * 500}, listing_hash)
+
+    assert data['descHash'] == text_hash('Night shift, ' * 500)
+    assert data['listingHash'] == 'Nurse|Acme|Boston|MA|' + data['descHash']
+
+
+def test_missing_values_are_undefined():
+    data = fingerprint_record({'title': 'Nurse', 'desc': ''}, listing_hash)
+
+    assert data['descHash'] == text_hash('')
+    assert data['listingHash'] == 'Nurse|undefined|undefined|undefined|undefined'
+
+
+def test_hashes_already_attached_are_kept():
+    data = {'title': 'Nurse', 'desc': 'text', 'descHash': 'd', 'listingHash': 'l'}
+    assert fingerprint_record(data, listing_hash) == {'title': 'Nurse', 'desc': 'text',
+                                                      'descHash': 'd', 'listingHash': 'l'}
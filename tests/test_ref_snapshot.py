@@ -0,0 +1,115 @@
+"""
+Reference snapshots are flat, memory-mapped tables, built once per task and
+host in a private directory.
+"""
+import os
+import threading
+
+import pytest
+
+import ref_snapshot
+import mongo_enrich
+import validator_cache
+from standins import MemoryMongo, MemoryCollection
+
+
+@pytest.fixture
+def snapshot(tmp_path):
+    path = str(tmp_path / 'ref.snap')
+    ref_snapshot.build_snapshot(path, {
+        'titles': {'Nurse', 'Cook', 7},
+        'titles:fill': {'Nurse': {'title': 'Nurse', 'display': 'Registered Nurse'}},
+        'empty': set(),
+    })
+    snapshot = ref_snapshot.RefSnapshot(path)
+    yield snapshot
+    snapshot.close()
+
+
+def test_lookups(snapshot):
+    assert snapshot.contains('titles', 'Nurse') is True
+    assert snapshot.contains('titles', 7) is True
+    assert snapshot.contains('titles', '7') is False
+    assert snapshot.contains('titles', 'Driver') is False
+    assert snapshot.contains('empty', 'Nurse') is False
+    assert snapshot.contains('cities', 'Boston') is None
+
+    assert snapshot.get('titles:fill', 'Nurse') == {'title': 'Nurse', 'display': 'Registered Nurse'}
+    assert snapshot.get('titles:fill', 'Cook', 'x') == 'x'
+    # a set has no values
+    assert snapshot.get('titles', 'Nurse', 'x') == 'x'
+
+
+def test_colliding_hashes_are_told_apart(tmp_path, monkeypatch):
+    monkeypatch.setattr(ref_snapshot, 'key_hash', lambda value: 1)
+    path = str(tmp_path / 'ref.snap')
+    ref_snapshot.build_snapshot(path, {'titles:fill': {'Nurse': 'a', 'Cook': 'b'}})
+    snapshot = ref_snapshot.RefSnapshot(path)
+
+    assert snapshot.get('titles:fill', 'Nurse') == 'a'
+    assert snapshot.get('titles:fill', 'Cook') == 'b'
+    assert snapshot.contains('titles:fill', 'Driver') is False
+    snapshot.close()
+
+
+def test_not_a_snapshot(tmp_path):
+    path = tmp_path / 'ref.snap'
+    path.write_bytes(b'\x80\x04' + b'\0' * 16)
+    with pytest.raises(ValueError):
+        ref_snapshot.RefSnapshot(str(path))
+
+
+def test_built_once_per_task(tmp_path):
+    directory = str(tmp_path / 'snapshots')
+    builds = []
+
+    def load_tables():
+        builds.append(1)
+        return {'titles': {'Nurse'}}
+
+    snapshots = []
+    threads = [threading.Thread(target=lambda: snapshots.append(
+        ref_snapshot.open_task_snapshot('1', load_tables, directory))) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert builds == [1]
+    assert [s.contains('titles', 'Nurse') for s in snapshots] == [True] * 4
+    assert os.stat(directory).st_mode & 0o777 == 0o700
+
+    # the snapshot of the previous task is removed
+    ref_snapshot.open_task_snapshot('2', load_tables, directory)
+    assert sorted(os.listdir(directory)) == ['.lock', 'ref-2.snap']
+
+
+def test_shared_directory_is_refused(tmp_path):
+    directory = tmp_path / 'shared'
+    directory.mkdir()
+    os.chmod(str(directory), 0o777)
+    with pytest.raises(PermissionError):
+        ref_snapshot.open_task_snapshot('1', lambda: {}, str(directory))
+    assert os.listdir(str(directory)) == []
+
+
+def test_fillers_answer_from_the_snapshot(tmp_path):
+    db = MemoryMongo()
+    db['titles'] = MemoryCollection([{'title': 'nurse', 'display': 'Nurse'}])
+    db['cities'] = MemoryCollection([{'name': 'Boston'}])
+    validate_specs = (('title1', 'titles', 'title'), ('city1', 'cities', 'name'))
+    fill_specs = ({'collection': 'titles', 'key': 'title1', 'field': 'title',
+                   'fill': {'display': 'titleDisplay'}, 'default': 'title1'}, )
+    snapshot = ref_snapshot.open_task_snapshot(
+        '1', lambda: ref_snapshot.load_reference_tables(db, validate_specs, fill_specs), str(tmp_path / 's'))
+    queries = db['titles'].queries, db['cities'].queries
+
+    validator = validator_cache.LazyValidator(db, validate_specs, snapshot=snapshot)
+    enricher = mongo_enrich.MongoEnricher(db, fill_specs, snapshot=snapshot)
+    jobs = [{'title1': 'nurse', 'city1': 'Boston'}, {'title1': 'cook', 'city1': 'Boston'}]
+
+    assert validator.validate_many(jobs) == [(True, []), (False, ['title1'])]
+    enricher.fill_many(jobs)
+    assert [j['titleDisplay'] for j in jobs] == ['Nurse', 'cook']
+    assert (db['titles'].queries, db['cities'].queries) == queries
+    snapshot.close()
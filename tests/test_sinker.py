@@ -0,0 +1,53 @@
+"""
+SinkerWorker bulk actions must keep the document body the old path indexed.
+"""
+import datetime
+
+import pytest
+
+pytest.importorskip('elasticsearch_dsl')
+import models.joblisting as models
+
+from sinker import build_action
+
+JobPosting = models.JobPosting
+
+
+def filled_job(**extra):
+    job = {
+        'title': 'Registered Nurse',
+        'titleDisplay': 'Registered Nurse',
+        'company': 'acme health',
+        'companyDisplay': 'Acme Health',
+        'city': 'Boston',
+        'state': 'MA',
+        'desc': '<p>Night shift, 3x12h.</p>',
+        'postingDate': datetime.datetime(2026, 10, 1, 8, 30),
+        'skillsets': ['patient care', 'triage'],
+        'majorPriority': {'nursing': 80},
+        'majorsBucket1': [],
+        'benefits': [],
+        'visaStatus': '',
+        'jobLevel': 0,
+        'price': 0.35,
+        'socCode': None,
+        'processSeq': '202610180000',
+        'listingHash': 'a1b2c3',
+    }
+    job.update(extra)
+    return job
+
+
+def old_action(job_id, job_data):
+    # SinkerWorker.process before the batched sink
+    return JobPosting(meta={'id': job_id}, **job_data).to_dict(True)
+
+
+@pytest.mark.parametrize('job', [
+    filled_job(),
+    filled_job(postingDate=None, skillsets=None, majorPriority={}),
+])
+def test_same_body_as_job_posting(job):
+    assert build_action('job-1', job) == old_action('job-1', job)
+    # the hashes the cleaner adds since are not indexed
+    assert build_action('job-1', dict(job, descHash='0123456789abcdef')) == old_action('job-1', job)
@@ -0,0 +1,72 @@
+"""
+LazyValidator asks Mongo only for the values of a batch it has not seen,
+keeps a bounded cache and validates list-valued fields element by element.
+"""
+import pytest
+
+import validator_cache
+from standins import MemoryMongo, MemoryCollection
+
+
+SPECS = (
+    ('title1', 'titles', 'title'),
+    ('city', 'cities', 'name'),
+)
+
+
+@pytest.fixture
+def db():
+    db = MemoryMongo()
+    db['titles'] = MemoryCollection([{'title': 'Nurse'}, {'title': 'RN'}])
+    db['cities'] = MemoryCollection([{'name': 'Boston'}])
+    return db
+
+
+def test_list_valued_fields(db):
+    validator = validator_cache.LazyValidator(db, SPECS)
+    # the norm api answers cities as lists
+    jobs = [
+        {'title1': 'Nurse', 'city': ['Boston']},
+        {'title1': 'Cook', 'city': ['Boston']},
+        {'title1': 'RN', 'city': ['Boston', 'Salem']},
+        {'title1': 'Nurse', 'city': []},
+        {'title1': None, 'city': 'Boston'},
+    ]
+    assert validator.validate_many(jobs) == [
+        (True, []),
+        (False, ['title1']),
+        (False, ['city']),
+        (False, ['city']),
+        (False, ['title1']),
+    ]
+    assert validator({'title1': 'Cook', 'city': 'Boston'}) == (False, ['title1'])
+
+
+def test_seen_values_are_not_queried_again(db):
+    validator = validator_cache.LazyValidator(db, SPECS)
+    validator.validate_many([{'title1': 'Nurse', 'city': 'Boston'}, {'title1': 'Cook', 'city': 'Boston'}])
+    assert (db['titles'].queries, db['cities'].queries) == (1, 1)
+
+    # unknown answers are cached too
+    validator.validate_many([{'title1': 'Cook', 'city': ['Boston']}, {'title1': 'Nurse', 'city': 'Boston'}])
+    assert (db['titles'].queries, db['cities'].queries) == (1, 1)
+
+
+def test_cache_is_bounded(db):
+    validator = validator_cache.LazyValidator(db, SPECS[:1], cache_size=2)
+    validator.validate_many([{'title1': t} for t in ('Nurse', 'RN', 'Cook')])
+
+    assert len(validator.caches[0]) == 2
+    validator.validate_many([{'title1': 'Nurse'}])
+    assert db['titles'].queries == 2
+
+
+def test_snapshot_answers_before_mongo(db):
+
+    class Snapshot(object):
+        def contains(self, table, value):
+            return {'Nurse': True, 'Cook': False}.get(value) if table == 'titles' else None
+
+    validator = validator_cache.LazyValidator(db, SPECS[:1], snapshot=Snapshot())
+    assert validator.validate_many([{'title1': 'Nurse'}, {'title1': 'Cook'}]) == [(True, []), (False, ['title1'])]
+    assert db['titles'].queries == 0
@@ -0,0 +1,191 @@
+import time
+import heapq
+import atexit
+import logging
+import itertools
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+
+class MicroBatcher(object):
+    """
+    Collects items and hands them to `flush_fn(items)` in batches.
+
+    A batch is flushed once it holds `max_size` items, `sizeof` of its items
+    adds up to `max_bytes`, or its oldest item has waited `max_latency`
+    seconds, whichever comes first. The deadline
+    is checked by a daemon thread so the tail of a stream is not held back
+    until the next item arrives. `flush_fn` always runs under the batcher
+    lock and never concurrently with itself.
+
+    If `flush_fn` raises, the batch is put back in front of the items added
+    since and the exception is raised to the caller of `add` / `flush`; the
+    deadline thread logs it and tries again once `max_latency` passed.
+    Items are never dropped, callers which ack their input before it is
+    flushed keep master waiting with a redis_access.PendingMarker.
+    """
+
+    def __init__(self, flush_fn, max_size, max_latency=None, max_bytes=None, sizeof=len):
+        self.flush_fn = flush_fn
+        self.max_size = max_size
+        self.max_latency = max_latency
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+
+        self._items = []
+        self._bytes = 0
+        self._first_time = None
+        self._lock = threading.RLock()
+        self._closed = threading.Event()
+
+        # whatever is left when the worker exits is still flushed
+        atexit.register(self.close)
+
+        if max_latency:
+            thread = threading.Thread(target=self._watch, name='micro-batcher')
+            thread.daemon = True
+            thread.start()
+
+    def __len__(self):
+        return len(self._items)
+
+    def add(self, item):
+        with self._lock:
+            if not self._items:
+                self._first_time = time.time()
+            self._items.append(item)
+            if self.max_bytes:
+                self._bytes += self.sizeof(item)
+            if len(self._items) >= self.max_size or (self.max_bytes and self._bytes >= self.max_bytes):
+                self._flush()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def close(self):
+        self._closed.set()
+        try:
+            self.flush()
+        except Exception as e:
+            logger.exception(e)
+
+    def _flush(self):
+        if not self._items:
+            return
+        items = self._items
+        self._items = []
+        self._bytes = 0
+        self._first_time = None
+        try:
+            self.flush_fn(items)
+        except Exception:
+            # retried whole, by the next add / flush or at the next deadline
+            self._items = items + self._items
+            if self.max_bytes:
+                self._bytes = sum(self.sizeof(item) for item in self._items)
+            self._first_time = time.time()
+            raise
+
+    def _watch(self):
+        interval = self.max_latency / 4.0
+        while not self._closed.wait(interval):
+            with self._lock:
+                if self._items and time.time() - self._first_time >= self.max_latency:
+                    try:
+                        self._flush()
+                    except Exception as e:
+                        logger.exception(e)
+
+
+class AdaptiveBatchSize(object):
+    """
+    Batch size tuned from the observed service response.
+
+    Additive increase while batches come back within `target_latency`,
+    multiplicative decrease when they are slow or throttled (HTTP 429).
+    """
+
+    def __init__(self, initial, min_size, max_size, target_latency):
+        self.size = initial
+        self.min_size = min_size
+        self.max_size = max_size
+        self.target_latency = target_latency
+        self.step = max(1, initial // 10)
+
+    def update(self, latency, throttled=0):
+        size = self.size
+        if throttled:
+            size = size // 2
+        elif latency > self.target_latency:
+            size = int(size * 0.75)
+        else:
+            size = size + self.step
+        size = min(self.max_size, max(self.min_size, size))
+
+        if size != self.size:
+            logger.debug('batch size %s -> %s. latency: %.2fs, throttled: %s' %
+                         (self.size, size, latency, throttled))
+        self.size = size
+        return size
+
+
+class RetryQueue(object):
+    """
+    Small delay queue, `submit(item)` is called from a daemon thread once
+    the item's delay has passed. Items put when `maxsize` are already
+    waiting are rejected, so a caller never blocks on it.
+    """
+
+    def __init__(self, submit, maxsize=100):
+        self.submit = submit
+        self.maxsize = maxsize
+
+        self._heap = []
+        self._counter = itertools.count()
+        self._unfinished = 0
+        self._cond = threading.Condition()
+
+        thread = threading.Thread(target=self._run, name='retry-queue')
+        thread.daemon = True
+        thread.start()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def put(self, item, delay=0):
+        """returns False if the queue is full and the item was not queued"""
+        with self._cond:
+            if len(self._heap) >= self.maxsize:
+                return False
+            heapq.heappush(self._heap, (time.time() + delay, next(self._counter), item))
+            self._unfinished += 1
+            self._cond.notify_all()
+        return True
+
+    def is_idle(self):
+        return self._unfinished == 0
+
+    def join(self):
+        """block until every queued item is submitted"""
+        with self._cond:
+            while self._unfinished:
+                self._cond.wait()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._heap or self._heap[0][0] > time.time():
+                    timeout = self._heap[0][0] - time.time() if self._heap else None
+                    self._cond.wait(timeout)
+                due, _, item = heapq.heappop(self._heap)
+            try:
+                self.submit(item)
+            except Exception as e:
+                logger.exception(e)
+            finally:
+                with self._cond:
+                    self._unfinished -= 1
+                    self._cond.notify_all()
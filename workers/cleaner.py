@@ -1,12 +1,90 @@
 import json
+import time
+import atexit
+import itertools
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import settings
 
 from framework.base_worker import BaseWorker
 from framework import reports
 
-from record_cleaner import parse_record
+from record_cleaner import parse_batch
 from utils.exceptions import UnsupportedFeed
 
 from utils.dup_detect import get_or_build_job_id, build_listing_hash
+from batching import MicroBatcher
+from dedup_index import DEDUP_INDEX_ENABLED, DedupIndex, dedup_key
+from record_fingerprint import fingerprint_record
+from redis_access import PendingMarker, TaskConstants
+from feed_schedule import record_feed_time
+from perf import timed
+
+
+# records cleaned together, 1 cleans every message as it arrives
+CLEAN_BATCH_SIZE = getattr(settings, 'CLEAN_BATCH_SIZE', 100)
+# max seconds a record waits in a partial batch
+CLEAN_BATCH_MAX_LATENCY = getattr(settings, 'CLEAN_BATCH_MAX_LATENCY', 1.0)
+# dedup lookups of a batch running at the same time
+DEDUP_LOOKUP_THREADS = getattr(settings, 'DEDUP_LOOKUP_THREADS', 8)
+
+
+def _lookup_serial(datas):
+    return [get_or_build_job_id(**data) for data in datas]
+
+
+def lookup_keys(data):
+    """
+    the keys a cleaned record is deduplicated under: the unique id of the
+    listing (dedup_key), which the filler also indexes the job under, and the
+    (source, id) of the feed record
+    """
+    return dedup_key(data), (data.get('source'), data.get('id'))
+
+
+def group_by_keys(datas, keys=lookup_keys):
+    """
+    indexes of datas in groups, records sharing any key end up in one group
+    groups and the indexes in a group keep the order of datas
+    """
+    parent = list(range(len(datas)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    first = {}
+    for i, data in enumerate(datas):
+        for key in keys(data):
+            root_i, root_j = find(i), find(first.setdefault(key, i))
+            if root_i != root_j:
+                parent[max(root_i, root_j)] = min(root_i, root_j)
+
+    groups = OrderedDict()
+    for i in range(len(datas)):
+        groups.setdefault(find(i), []).append(i)
+    return list(groups.values())
+
+
+def lookup_job_ids(datas, executor=None):
+    """
+    get_or_build_job_id for a batch of cleaned records, results aligned with datas
+
+    the redis round trips of different jobs overlap in the executor, records
+    sharing a dedup key (lookup_keys) stay in one serial group so they never race
+    """
+    if executor is None or len(datas) < 2:
+        return _lookup_serial(datas)
+
+    indexes = group_by_keys(datas)
+    results = [None] * len(datas)
+    for idx, group_results in zip(indexes, executor.map(_lookup_serial, [[datas[i] for i in idx] for idx in indexes])):
+        for i, result in zip(idx, group_results):
+            results[i] = result
+    return results
 
 
 class CleanerWorker(BaseWorker):
@@ -15,17 +93,60 @@ class CleanerWorker(BaseWorker):
         super(CleanerWorker, self).__init__(__name__, PreTopic, NextTopic)
 
         self.next_topic_oldjob = NextTopicOldJob()
+        self.lookup_executor = ThreadPoolExecutor(DEDUP_LOOKUP_THREADS) if DEDUP_LOOKUP_THREADS > 1 else None
+        self.task_constants = TaskConstants()
+        self.dedup_index = None
+        if DEDUP_INDEX_ENABLED:
+            self.dedup_index = DedupIndex(lambda: self.task_constants.get(settings.KEY_PROCESS_SEQ))
+            atexit.register(self.dedup_index.save)
+        # records acked but not cleaned yet keep master waiting
+        self.pending = PendingMarker(__name__)
+        self.batcher = MicroBatcher(self.process_batch, CLEAN_BATCH_SIZE, CLEAN_BATCH_MAX_LATENCY)
 
     def build_msg_key(self, record, feed_name, seq):
         return '%s-%s' % (feed_name, seq)
 
     def process(self, record, feed_name, seq):
+        self.pending.add()
+        self.batcher.add((record, feed_name, seq))
+
+    def process_batch(self, msgs):
+        """
+        clean a list of (record, feed_name, seq) messages
+        consecutive messages of the same feed are cleaned by one parse_batch call
+        a failing batch is retried whole by the batcher, records produced before
+        the failure are produced again under the same keys
+        """
+        for feed_name, group in itertools.groupby(msgs, key=lambda msg: msg[1]):
+            group = list(group)
+            start_time = time.time()
+            try:
+                errors, data = parse_batch([msg[0] for msg in group], feed_name)
+            except UnsupportedFeed:
+                # error logged in get_module
+                continue
+
+            # dedup lookups of the valid records in one go
+            valid = [d for error, d in zip(errors, data) if not error]
+            with timed('dedup_lookup', len(valid)):
+                if self.dedup_index is not None:
+                    job_ids = iter(self.dedup_index.lookup_many(valid))
+                else:
+                    job_ids = iter(lookup_job_ids(valid, self.lookup_executor))
+
+            for (record, _, seq), error, d in zip(group, errors, data):
+                self.handle_cleaned(error, d, feed_name, seq, None if error else next(job_ids))
+            self.record_clean_time(feed_name, time.time() - start_time)
+        self.pending.done(len(msgs))
+
+    def record_clean_time(self, feed_name, seconds):
+        # feed history for the master scheduling
         try:
-            error, data = parse_record(record, feed_name, seq)
-        except UnsupportedFeed:
-            # error logged in parse_record method
-            return
+            record_feed_time(self.task_constants.get(settings.KEY_PROCESS_SEQ), feed_name, 'clean_time', seconds)
+        except Exception as e:
+            self.logger.exception(e)
 
+    def handle_cleaned(self, error, data, feed_name, seq, job_id_new=None):
         # import json
         # self.logger.info('record %s' % json.dumps(data, indent=4))
 
@@ -38,20 +159,10 @@ class CleanerWorker(BaseWorker):
                     "feed": feed_name,
                 }))
         else:
-            job_id, is_new = get_or_build_job_id(**data)
-
-            ## listingHash
-            # using 'undefined' to be compatible with the origin js version
-            undefined = "undefined"
-            if "listingHash" not in data.keys():
-                listing_hash = build_listing_hash(
-                    data.get("title", None) or undefined,
-                    data.get("company", None) or undefined,
-                    data.get("city", None) or undefined,
-                    data.get("state", None) or undefined,
-                    data.get("desc", None) or undefined,
-                )
-                data["listingHash"] = listing_hash
+            job_id, is_new = job_id_new or get_or_build_job_id(**data)
+
+            ## listingHash, descHash
+            fingerprint_record(data, build_listing_hash)
 
             kwargs = {
                 'job_id': job_id,
@@ -0,0 +1,218 @@
+import os
+import math
+import time
+import struct
+import hashlib
+import logging
+
+from settings import r_db
+
+import settings
+
+from utils.dup_detect import build_unique_id
+
+
+logger = logging.getLogger(__name__)
+
+DEDUP_INDEX_ENABLED = getattr(settings, 'DEDUP_INDEX_ENABLED', False)
+DEDUP_BLOOM_CAPACITY = getattr(settings, 'DEDUP_BLOOM_CAPACITY', 20000000)
+DEDUP_BLOOM_ERROR_RATE = getattr(settings, 'DEDUP_BLOOM_ERROR_RATE', 0.01)
+DEDUP_BLOOM_PATH = getattr(settings, 'DEDUP_BLOOM_PATH', 'dedup_bloom.bin')
+# seconds between two snapshots of the bloom filter
+DEDUP_SNAPSHOT_INTERVAL = getattr(settings, 'DEDUP_SNAPSHOT_INTERVAL', 600)
+# seconds the index of a process seq is kept after its last write
+DEDUP_INDEX_TTL = getattr(settings, 'DEDUP_INDEX_TTL', 2 * 24 * 3600)
+
+# dedup key -> job_id of the jobs seen in a process seq, formatted with the seq
+KEY_DEDUP_INDEX = 'dedup:index:%s'
+
+LOG_INTERVAL = 100000
+
+SNAPSHOT_HEADER = struct.Struct('<4sQQQ32s')
+SNAPSHOT_MAGIC = b'BLM2'
+
+
+class BloomFilter(object):
+    """
+    Bloom filter over a bytearray, `k` bit positions per key by double hashing.
+    """
+
+    def __init__(self, capacity, error_rate, bits=None, count=0):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.m = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.k = max(1, int(round(self.m / float(capacity) * math.log(2))))
+        self.bits = bits if bits is not None else bytearray((self.m + 7) // 8)
+        self.count = count
+
+    def _positions(self, key):
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        h1, h2 = struct.unpack('<QQ', digest)
+        m = self.m
+        return [(h1 + i * h2) % m for i in range(self.k)]
+
+    def add(self, key):
+        bits = self.bits
+        for pos in self._positions(key):
+            bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        bits = self.bits
+        for pos in self._positions(key):
+            if not bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+    def estimated_fp_rate(self):
+        # (1 - e^(-kn/m))^k
+        return (1 - math.exp(-self.k * self.count / float(self.m))) ** self.k
+
+    def save(self, path, tag=b''):
+        # write then rename, readers never see a partial snapshot
+        with open(path + '.tmp', 'wb') as f:
+            f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, self.capacity,
+                                         int(self.error_rate * 1e9), self.count, tag))
+            f.write(self.bits)
+        os.rename(path + '.tmp', path)
+
+    @classmethod
+    def load(cls, path, capacity, error_rate, tag=b''):
+        """
+        the snapshot at `path`, or an empty filter if it is missing or was
+        built with other parameters or under another tag
+        """
+        try:
+            with open(path, 'rb') as f:
+                magic, s_capacity, s_error, count, s_tag = SNAPSHOT_HEADER.unpack(f.read(SNAPSHOT_HEADER.size))
+                if magic == SNAPSHOT_MAGIC and s_capacity == capacity and s_error == int(error_rate * 1e9) \
+                        and s_tag.rstrip(b'\0') == tag:
+                    bloom = cls(capacity, error_rate, count=count)
+                    f.readinto(bloom.bits)
+                    return bloom
+                logger.warning('bloom snapshot %s is of another process seq or parameters, start empty' % path)
+        except (IOError, OSError, struct.error) as e:
+            logger.warning('no bloom snapshot loaded: %s' % e)
+        return cls(capacity, error_rate)
+
+
+def dedup_key(data):
+    """
+    the unique id of the listing, the filler indexes the job under the same id
+    """
+    return build_unique_id(data.get('companyDisplay'), data.get('titleDisplay'),
+                           data.get('city'), data.get('state'))
+
+
+def _text(value):
+    return value.decode('utf-8') if isinstance(value, bytes) else value
+
+
+class DedupIndex(object):
+    """
+    Job ids and new/old routing of cleaned records, without a
+    get_or_build_job_id round trip per record.
+
+    A job is new the first time its dedup_key is claimed in a process seq.
+    Claims are HSETNX on the KEY_DEDUP_INDEX hash of the seq, so cleaners
+    agree on which record came first. A bloom filter of the keys this cleaner
+    has seen in the seq decides the path of a record:
+    * key not in the filter: claimed right away, no read
+    * key in the filter: one HMGET for the whole batch, found keys are old
+      jobs, misses (false positives) are claimed
+    The filter and the hash are scoped to the process seq, both start empty
+    when master starts a new one. The filter is snapshotted to disk tagged
+    with its seq, so a restarted cleaner resumes it within the same seq.
+    """
+
+    def __init__(self, get_process_seq, bloom=None, path=DEDUP_BLOOM_PATH):
+        self.get_process_seq = get_process_seq
+        self.path = path
+        self.process_seq = None
+        self.bloom = bloom
+        self._last_snapshot = time.time()
+
+        self.lookups = 0
+        self.not_in_filter = 0
+        self.index_hits = 0
+        self.false_positives = 0
+        self.claimed_elsewhere = 0
+
+    def _switch(self, process_seq):
+        """
+        scope the filter to `process_seq`, the snapshot is only reused if it
+        was taken in the same seq
+        """
+        if self.process_seq is not None:
+            self.save()
+            self.bloom = None
+        if self.bloom is None:
+            self.bloom = BloomFilter.load(self.path, DEDUP_BLOOM_CAPACITY, DEDUP_BLOOM_ERROR_RATE,
+                                          tag=process_seq.encode('utf-8'))
+        self.process_seq = process_seq
+
+    def lookup_many(self, datas):
+        """
+        (job_id, is_new) for every record, aligned with datas
+        """
+        process_seq = _text(self.get_process_seq()) or ''
+        if process_seq != self.process_seq:
+            self._switch(process_seq)
+        index_key = KEY_DEDUP_INDEX % process_seq
+
+        keys = [dedup_key(d) for d in datas]
+        results = [None] * len(datas)
+
+        maybe = [i for i, key in enumerate(keys) if key in self.bloom]
+        self.lookups += len(keys)
+        self.not_in_filter += len(keys) - len(maybe)
+
+        if maybe:
+            job_ids = r_db.hmget(index_key, [keys[i] for i in maybe])
+            for i, job_id in zip(maybe, job_ids):
+                if job_id is not None:
+                    results[i] = (_text(job_id), False)
+                    self.index_hits += 1
+                else:
+                    self.false_positives += 1
+
+        rest = [i for i, r in enumerate(results) if r is None]
+        if rest:
+            pipe = r_db.pipeline(transaction=False)
+            for i in rest:
+                pipe.hsetnx(index_key, keys[i], keys[i])
+            pipe.expire(index_key, DEDUP_INDEX_TTL)
+            claimed = pipe.execute()
+            for i, is_new in zip(rest, claimed):
+                # a key twice in the batch, or claimed by another cleaner
+                if not is_new:
+                    self.claimed_elsewhere += 1
+                results[i] = (keys[i], bool(is_new))
+                self.bloom.add(keys[i])
+
+        if self.lookups // LOG_INTERVAL != (self.lookups - len(keys)) // LOG_INTERVAL:
+            self.log_stats()
+        if time.time() - self._last_snapshot > DEDUP_SNAPSHOT_INTERVAL:
+            self.save()
+        return results
+
+    def observed_fp_rate(self):
+        # share of the keys absent from the index which the filter still let through
+        negatives = self.not_in_filter + self.false_positives
+        return float(self.false_positives) / negatives if negatives else 0.0
+
+    def log_stats(self):
+        logger.info('dedup index. lookups: %s, not in filter: %s, index hits: %s, '
+                    'false positives: %s, claimed elsewhere: %s, observed fp rate: %.4f, '
+                    'estimated fp rate: %.4f' %
+                    (self.lookups, self.not_in_filter, self.index_hits, self.false_positives,
+                     self.claimed_elsewhere, self.observed_fp_rate(), self.bloom.estimated_fp_rate()))
+
+    def save(self):
+        if self.bloom is None or self.process_seq is None:
+            return
+        try:
+            self.bloom.save(self.path, self.process_seq.encode('utf-8'))
+        except (IOError, OSError) as e:
+            logger.exception(e)
+        self._last_snapshot = time.time()
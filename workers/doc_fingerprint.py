@@ -0,0 +1,111 @@
+import json
+import hashlib
+import logging
+
+from elasticsearch_dsl.connections import connections
+from elasticsearch.helpers import scan, bulk
+
+from models.joblisting import JobPosting
+from settings import r_db
+
+import settings
+
+
+logger = logging.getLogger(__name__)
+
+# skip re-indexing documents whose content did not change since the last run
+ES_SKIP_UNCHANGED = getattr(settings, 'ES_SKIP_UNCHANGED', False)
+
+FINGERPRINT_FIELD = 'contentHash'
+# fields changing every run without changing the document
+VOLATILE_FIELDS = ('processSeq', FINGERPRINT_FIELD)
+# record fields which are not part of the indexed document
+INTERNAL_FIELDS = ('descHash', )
+
+# ids of the documents written or kept in a task, per process_seq
+KEY_SEEN_IDS = 'es:seen:%s'
+SEEN_IDS_TTL = 3 * 24 * 3600
+
+SCAN_SIZE = 5000
+
+
+def build_meta():
+    """
+    index and doc type of JobPosting documents, read once from a probe document
+    """
+    probe = JobPosting(meta={'id': '_'}).to_dict(True)
+    return {k: v for k, v in probe.items() if k not in ('_id', '_source')}
+
+
+def fingerprint(source):
+    # descHash stands for the description if the cleaner computed it
+    skip = VOLATILE_FIELDS + ('desc', ) if source.get('descHash') else VOLATILE_FIELDS
+    data = {k: v for k, v in source.items() if k not in skip}
+    raw = json.dumps(data, sort_keys=True, default=str)
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+
+def find_unchanged(client, meta, actions):
+    """
+    ids of the actions whose fingerprint equals the one of the indexed document
+    """
+    docs = [dict(meta, _id=a['_id'], _source=[FINGERPRINT_FIELD]) for a in actions]
+    rsp = client.mget(body={'docs': docs})
+    unchanged = set()
+    for action, doc in zip(actions, rsp['docs']):
+        source = doc.get('_source') or {}
+        if doc.get('found') and source.get(FINGERPRINT_FIELD) == action['_source'][FINGERPRINT_FIELD]:
+            unchanged.add(action['_id'])
+    return unchanged
+
+
+def mark_seen(process_seq, ids):
+    key = KEY_SEEN_IDS % process_seq
+    pipe = r_db.pipeline(transaction=False)
+    pipe.sadd(key, *ids)
+    pipe.expire(key, SEEN_IDS_TTL)
+    pipe.execute()
+
+
+def clean_es_by_ids(process_seq, chunk_size=1000):
+    """
+    delete the documents not written or kept in task `process_seq`
+    the ids in the index are diffed against the ids the sinkers have seen,
+    instead of a delete-by-query over every document of an old processSeq
+    returns (is_succ, del rate) like clean_es
+    """
+    key = KEY_SEEN_IDS % process_seq
+    if not r_db.exists(key):
+        logger.warning('no seen ids for %s, skip es clean up' % process_seq)
+        return False, 0.0
+
+    client = connections.get_connection()
+    meta = build_meta()
+    query = {'query': {'match_all': {}}, '_source': False}
+
+    def stale_actions():
+        ids = []
+        for hit in scan(client, query=query, index=meta['_index'], size=SCAN_SIZE):
+            ids.append(hit['_id'])
+            if len(ids) >= chunk_size:
+                for action in _stale(ids):
+                    yield action
+                ids = []
+        for action in _stale(ids):
+            yield action
+
+    def _stale(ids):
+        if not ids:
+            return []
+        pipe = r_db.pipeline(transaction=False)
+        for _id in ids:
+            pipe.sismember(key, _id)
+        return [dict(meta, _op_type='delete', _id=_id)
+                for _id, seen in zip(ids, pipe.execute()) if not seen]
+
+    n_total = r_db.scard(key)
+    n_deleted, errors = bulk(client, stale_actions(), raise_on_error=False, raise_on_exception=False)
+    n_total += n_deleted
+    if errors:
+        logger.error('%s stale documents failed to delete' % len(errors))
+    return not errors, float(n_deleted) / n_total if n_total else 0.0
@@ -1,52 +1,363 @@
 import os
+import json
+import time
+import atexit
+import logging
 import requests
 from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 
 import settings
 
 from framework.base_worker import BaseWorker
+from redis_access import TaskConstants
+from feed_schedule import record_feed_values, record_feed_time
 
 
-def _request(url, filename):
+logger = logging.getLogger(__name__)
+
+# number of byte ranges of one feed fetched at the same time by a downloader process
+DOWNLOAD_CONCURRENCY = getattr(settings, 'DOWNLOAD_CONCURRENCY', 4)
+# feeds smaller than this are fetched in a single request
+DOWNLOAD_SEGMENT_MIN_SIZE = getattr(settings, 'DOWNLOAD_SEGMENT_MIN_SIZE', 64 * 1024 * 1024)
+# feeds are multi-GB xml files, read them in large chunks
+DOWNLOAD_CHUNK_SIZE = getattr(settings, 'DOWNLOAD_CHUNK_SIZE', 1024 * 1024)
+# (connect, read) timeout in seconds
+DOWNLOAD_TIMEOUT = getattr(settings, 'DOWNLOAD_TIMEOUT', (10, 300))
+DOWNLOAD_RETRY = 3
+# hand the feed url to the parser, which parses it straight off the network
+# instead of staging it in XML_PATH first
+STREAM_PARSE = getattr(settings, 'STREAM_PARSE', False)
+
+
+def build_session(pool_size=DOWNLOAD_CONCURRENCY):
+    """
+    requests session with a connection pool large enough for every in-flight range
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def _sidecar_path(filename):
+    return filename + '.meta'
+
+
+def load_sidecar(filename):
+    """
+    validators and state of the last download of `filename`
+    {url, etag, last_modified, complete}
+    """
+    try:
+        with open(_sidecar_path(filename)) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def save_sidecar(filename, meta):
+    # write then rename so a crash never leaves a truncated sidecar
+    path = _sidecar_path(filename)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(meta, f)
+    os.rename(path + '.tmp', path)
+
+
+def _build_headers(url, filename, meta):
+    """
+    conditional / range headers from the sidecar
+    * complete file: If-None-Match / If-Modified-Since, server answers 304 if unchanged
+    * partial file: Range from the current size, If-Range so a changed feed restarts at 0
+    """
+    headers = {}
+    if meta.get('url') != url or not os.path.exists(filename):
+        return headers, 0
+
+    validator = meta.get('etag') or meta.get('last_modified')
+    if meta.get('complete'):
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+        return headers, 0
+
+    # the size of an interrupted segmented download is not an offset
+    offset = os.path.getsize(filename) if not meta.get('segmented') else 0
+    if offset and validator:
+        headers['Range'] = 'bytes=%d-' % offset
+        headers['If-Range'] = validator
+        return headers, offset
+    return headers, 0
+
+
+def feed_filename(name, directory=None):
+    return os.path.join(directory or settings.XML_PATH, '%s.xml' % name.lower())
+
+
+def _segments(total, n):
+    # n contiguous (start, end) ranges, the last one takes the remainder
+    step = total // n
+    bounds = [i * step for i in range(n)] + [total]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def _can_split(r, segments):
+    # a plain (not content-encoded) body the server can serve in ranges
+    if segments < 2 or r.status_code != 200:
+        return False
+    if r.headers.get('Accept-Ranges', '').lower() != 'bytes' or r.headers.get('Content-Encoding'):
+        return False
+    if not (r.headers.get('ETag') or r.headers.get('Last-Modified')):
+        return False
+    try:
+        return int(r.headers.get('Content-Length') or 0) >= 2 * DOWNLOAD_SEGMENT_MIN_SIZE
+    except ValueError:
+        return False
+
+
+def _write_range(r, filename, start, end, chunk_size):
+    """
+    write the body of `r` to bytes [start, end) of `filename`, extra bytes are ignored
+    returns the number of bytes written
+    """
+    remaining = end - start
+    with open(filename, 'r+b') as f:
+        f.seek(start)
+        for chunk in r.iter_content(chunk_size=chunk_size):
+            if not chunk:
+                continue
+            chunk = chunk[:remaining]
+            f.write(chunk)
+            remaining -= len(chunk)
+            if not remaining:
+                break
+    if remaining:
+        raise IOError('range %d-%d of %s truncated, %d bytes missing' % (start, end, filename, remaining))
+    return end - start
+
+
+def _fetch_range(url, filename, session, start, end, validator, chunk_size):
+    get = session.get if session is not None else requests.get
+    headers = {
+        'Range': 'bytes=%d-%d' % (start, end - 1),
+        'If-Range': validator,
+        'Accept-Encoding': 'identity',
+    }
+    with closing(get(url, stream=True, timeout=DOWNLOAD_TIMEOUT, headers=headers)) as r:
+        r.raise_for_status()
+        if r.status_code != 206:
+            # the feed changed since the first request
+            raise IOError('range %d-%d of %s not served, status %s' % (start, end, url, r.status_code))
+        return _write_range(r, filename, start, end, chunk_size)
+
+
+def _download_segmented(r, url, filename, session, chunk_size, executor, segments, meta):
+    """
+    fetch the body of `r` as `segments` byte ranges, the first one is read
+    from `r` itself and the others in `executor`. Any failure removes the
+    partial file, so the retry starts from scratch.
+    """
+    total = int(r.headers['Content-Length'])
+    ranges = _segments(total, segments)
+    validator = meta['etag'] or meta['last_modified']
+
+    meta['segmented'] = True
+    save_sidecar(filename, meta)
+    with open(filename, 'wb') as f:
+        f.truncate(total)
+
+    futures = [executor.submit(_fetch_range, url, filename, session, start, end, validator, chunk_size)
+               for start, end in ranges[1:]]
+    try:
+        size = _write_range(r, filename, ranges[0][0], ranges[0][1], chunk_size)
+        for future in futures:
+            size += future.result()
+    except Exception:
+        for future in futures:
+            future.cancel()
+        for future in futures:
+            try:
+                future.result()
+            except Exception:
+                pass
+        for path in (filename, _sidecar_path(filename)):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        raise
+    return size
+
+
+def _request(url, filename, session=None, chunk_size=DOWNLOAD_CHUNK_SIZE, validators_from=None,
+             executor=None, segments=1):
+    """
+    download `url` to `filename`, resuming or skipping it based on the sidecar
+    with `validators_from`, the conditional headers come from the complete
+    download of that other file instead, e.g. the live copy of a staged feed
+    with `executor`, a large full download is split in `segments` byte ranges
+    fetched in parallel
+    returns (bytes transferred, status) where status is one of
+    'not_modified', 'resumed', 'downloaded'
+    """
     # http://docs.python-requests.org/en/latest/user/advanced/#body-content-workflow
-    with closing(requests.get(url, stream=True)) as r:
-        with open(filename, 'wb') as f:
-            for chunk in r.iter_content(chunk_size=1024):
-                if chunk:  # filter out keep-alive new chunks
-                    f.write(chunk)
-    return
+    get = session.get if session is not None else requests.get
+    if validators_from:
+        meta = load_sidecar(validators_from)
+        headers, offset = _build_headers(url, validators_from, meta) if meta.get('complete') else ({}, 0)
+    else:
+        meta = load_sidecar(filename)
+        headers, offset = _build_headers(url, filename, meta)
+
+    size = 0
+    with closing(get(url, stream=True, timeout=DOWNLOAD_TIMEOUT, headers=headers)) as r:
+        if r.status_code == 304:
+            return size, 'not_modified'
+        r.raise_for_status()
+
+        if r.status_code == 206 and offset:
+            mode, status = 'ab', 'resumed'
+        else:
+            mode, status = 'wb', 'downloaded'
+
+        meta = {
+            'url': url,
+            'etag': r.headers.get('ETag'),
+            'last_modified': r.headers.get('Last-Modified'),
+            'complete': False,
+        }
+
+        if executor is not None and _can_split(r, segments):
+            size = _download_segmented(r, url, filename, session, chunk_size, executor, segments, meta)
+        else:
+            save_sidecar(filename, meta)
+            with open(filename, mode) as f:
+                for chunk in r.iter_content(chunk_size=chunk_size):
+                    if chunk:  # filter out keep-alive new chunks
+                        f.write(chunk)
+                        size += len(chunk)
+
+    meta['complete'] = True
+    save_sidecar(filename, meta)
+    return size, status
+
+
+class FeedDownloader(object):
+    """
+    Download engine of a downloader process.
+
+    Feeds are downloaded one at a time over one pooled session, `fetch`
+    returns once the feed is complete on disk. Large feeds are split in
+    `concurrency` byte ranges fetched by a thread pool. Per-feed throughput
+    is kept in `stats`, keyed by feed name. A failed single stream attempt
+    leaves a partial file which the retry resumes.
+    """
+
+    def __init__(self, concurrency=DOWNLOAD_CONCURRENCY, chunk_size=DOWNLOAD_CHUNK_SIZE, session=None):
+        self.concurrency = concurrency
+        self.chunk_size = chunk_size
+        self.session = session if session is not None else build_session(concurrency)
+        self.stats = {}
+
+        self._executor = ThreadPoolExecutor(max_workers=concurrency - 1) if concurrency > 1 else None
+
+    def fetch(self, name, url, filename, retry=DOWNLOAD_RETRY):
+        """
+        download a single feed
+        returns the feed stats, or None if all retries failed
+        """
+        # retries go through a single stream, which resumes the partial file
+        segments = self.concurrency
+        while True:
+            start_time = time.time()
+            try:
+                size, status = _request(url, filename, self.session, self.chunk_size,
+                                        executor=self._executor, segments=segments)
+            except Exception as e:
+                logger.error(e)
+                if retry > 0:
+                    retry -= 1
+                    segments = 1
+                    logger.info('download %s error. retry=%s' % (name, retry))
+                    continue
+                logger.warning('download %s error. skip' % name)
+                return None
+            break
+
+        timecost = time.time() - start_time
+        stat = {
+            'status': status,
+            'bytes': size,
+            'timecost': timecost,
+            'mbps': size / 1048576.0 / timecost if timecost > 0 else 0.0,
+        }
+        self.stats[name] = stat
+        logger.warning('%s %s, %s bytes, timecost: %.2fs, %.2f MB/s' %
+                       (name, status, size, timecost, stat['mbps']))
+        return stat
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+        self.session.close()
 
 
 class DownloaderWorker(BaseWorker):
 
     def __init__(self, PreTopic, NextTopic):
         super(DownloaderWorker, self).__init__(__name__, PreTopic, NextTopic)
+        self.downloader = FeedDownloader()
+        atexit.register(self.downloader.close)
+        self.task_constants = TaskConstants()
 
     def build_msg_key(self, name, url, *args, **kwargs):
         return url
 
-    def process(self, name, url, order, retry=3, **kwargs):
+    def process(self, name, url, order, retry=DOWNLOAD_RETRY, **kwargs):
         self.logger.info('downloading %2d. %s...' % (order, name))
-        filename = os.path.join(settings.XML_PATH, '%s.xml' % name.lower())
-
-        try:
-            if settings.FAKE_DOWNLOAD:
-                self.logger.info('skip downloading as FAKE_DOWNLOAD=True')
-            else:
-                _request(url, filename)
-        except Exception as e:
-            self.logger.error(e)
-            if retry > 0:
-                retry -= 1
-                self.logger.info('download %s error. retry=%s' % (name, retry))
-                self.process(name, url, order, retry=retry, **kwargs)
-            else:
-                self.logger.warning('download %s error. skip' % name)
+        filename = feed_filename(name)
+
+        if kwargs.get('prefetched') and os.path.exists(filename):
+            # master staged the feed during its idle window, it is current
+            self.logger.info('skip downloading %s, prefetched' % name)
+            self._produce(order, name, filename)
             return
 
+        if settings.FAKE_DOWNLOAD:
+            self.logger.info('skip downloading as FAKE_DOWNLOAD=True')
+            self._produce(order, name, filename)
+            return
+
+        if STREAM_PARSE:
+            self._produce(order, name, filename, url=url)
+            return
+
+        # the message is acked once the feed is on disk and handed to the parser,
+        # so the topic counters never balance while a download is in flight
+        stat = self.downloader.fetch(name, url, filename, retry=retry)
+        if stat is not None:
+            self._downloaded(order, name, filename, stat)
+
+    def _downloaded(self, order, name, filename, stat):
+        # feed history for the master scheduling
+        # a 304 transferred nothing, it says nothing of the download cost
+        if stat['status'] != 'not_modified':
+            try:
+                process_seq = self.task_constants.get(settings.KEY_PROCESS_SEQ)
+                record_feed_values(process_seq, name, bytes=stat['bytes'])
+                record_feed_time(process_seq, name, 'download_time', stat['timecost'])
+            except Exception as e:
+                self.logger.exception(e)
+        self._produce(order, name, filename)
+
+    def _produce(self, order, name, filename, **extra):
         kwargs = {
             'order': order,
             'feed_name': name,
             'filename': filename,
         }
+        kwargs.update(extra)
         self.produce_msg(**kwargs)
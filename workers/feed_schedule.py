@@ -0,0 +1,160 @@
+import os
+import json
+import heapq
+import logging
+
+from settings import r_db
+
+import settings
+
+
+logger = logging.getLogger(__name__)
+
+# produce feeds longest first instead of in load_cache order
+FEED_SCHEDULE_LPT = getattr(settings, 'FEED_SCHEDULE_LPT', True)
+# replicas feeds are spread over, None reads it from the workers info
+FEED_SCHEDULE_WORKERS = getattr(settings, 'FEED_SCHEDULE_WORKERS', None)
+# weight of the last run in the history of a feed
+FEED_STATS_ALPHA = getattr(settings, 'FEED_STATS_ALPHA', 0.5)
+# per feed history on the master host, {feed: {metric: moving average}}
+# kept out of redis, which init_redis wipes at every task
+FEED_STATS_PATH = getattr(settings, 'FEED_STATS_PATH', 'feed_stats.json')
+
+# per task measures written by the workers, {'<feed>:<metric>': value}
+KEY_FEED_TASK = 'feed:task:%s'
+FEED_TASK_TTL = 3 * 24 * 3600
+
+# seconds the stages spend on a feed, summed into its cost
+TIME_METRICS = ('download_time', 'parse_time', 'clean_time')
+METRICS = ('bytes', 'records') + TIME_METRICS
+
+
+def _task_field(feed_name, metric):
+    return '%s:%s' % (feed_name, metric)
+
+
+def record_feed_time(process_seq, feed_name, metric, seconds):
+    """add `seconds` to a time metric of the feed in task `process_seq`, from any worker"""
+    if not process_seq:
+        return
+    key = KEY_FEED_TASK % (process_seq.decode('utf-8') if isinstance(process_seq, bytes) else process_seq)
+    pipe = r_db.pipeline(transaction=False)
+    pipe.hincrbyfloat(key, _task_field(feed_name, metric), seconds)
+    pipe.expire(key, FEED_TASK_TTL)
+    pipe.execute()
+
+
+def record_feed_values(process_seq, feed_name, **values):
+    """set measures of the feed in task `process_seq`, e.g. bytes, records, finished"""
+    if not process_seq or not values:
+        return
+    key = KEY_FEED_TASK % (process_seq.decode('utf-8') if isinstance(process_seq, bytes) else process_seq)
+    pipe = r_db.pipeline(transaction=False)
+    pipe.hset(key, mapping={_task_field(feed_name, k): v for k, v in values.items()})
+    pipe.expire(key, FEED_TASK_TTL)
+    pipe.execute()
+
+
+def load_task_measures(process_seq):
+    """{feed: {metric: value}} measured in task `process_seq`"""
+    measures = {}
+    for field, value in r_db.hgetall(KEY_FEED_TASK % process_seq).items():
+        field = field.decode('utf-8') if isinstance(field, bytes) else field
+        feed_name, _, metric = field.rpartition(':')
+        measures.setdefault(feed_name, {})[metric] = float(value)
+    return measures
+
+
+def load_history(feed_names, path=FEED_STATS_PATH):
+    """{feed: {metric: moving average}} of the feeds with history"""
+    try:
+        with open(path) as f:
+            stats = json.load(f)
+    except (IOError, OSError, ValueError) as e:
+        logger.warning('no feed history loaded: %s' % e)
+        return {}
+    return {name: stats[name] for name in feed_names if stats.get(name)}
+
+
+def update_history(measures, alpha=FEED_STATS_ALPHA, path=FEED_STATS_PATH):
+    """fold the measures of a finished task into the moving averages"""
+    if not measures:
+        return
+    try:
+        with open(path) as f:
+            history = json.load(f)
+    except (IOError, OSError, ValueError):
+        history = {}
+    for name, values in measures.items():
+        old = history.get(name, {})
+        new = dict(old)
+        for metric in METRICS:
+            if metric in values:
+                new[metric] = values[metric] if metric not in old else \
+                    alpha * values[metric] + (1 - alpha) * old[metric]
+        if new:
+            history[name] = new
+    # write then rename, a crash never leaves a partial history
+    with open(path + '.tmp', 'w') as f:
+        json.dump(history, f, sort_keys=True)
+    os.rename(path + '.tmp', path)
+
+
+def feed_cost(stats, prefetched=False):
+    # a prefetched feed is already on disk, the downloader does not fetch it
+    return sum(stats.get(metric, 0.0) for metric in TIME_METRICS
+               if not (prefetched and metric == 'download_time'))
+
+
+def lpt_schedule(names, costs, n_workers):
+    """
+    longest processing time first over `n_workers` identical replicas
+
+    replicas pull feeds from one queue, so producing them longest first makes
+    each free replica take the longest remaining feed.
+    returns (names in produce order, {name: predicted finish, seconds from start})
+    """
+    ordered = sorted(names, key=lambda name: -costs[name])
+    loads = [0.0] * max(1, n_workers)
+    finish = {}
+    for name in ordered:
+        start = heapq.heappop(loads)
+        finish[name] = start + costs[name]
+        heapq.heappush(loads, finish[name])
+    return ordered, finish
+
+
+def schedule_feeds(feeds, n_workers):
+    """
+    (feeds in produce order, {name: predicted finish}), feeds without history
+    are given the median cost of the others
+    """
+    names = [feed['name'] for feed in feeds]
+    history = load_history(names)
+    known = sorted(feed_cost(stats) for stats in history.values())
+    default = known[len(known) // 2] if known else 0.0
+    costs = {feed['name']: feed_cost(history[feed['name']], feed.get('prefetched'))
+             if feed['name'] in history else default for feed in feeds}
+    ordered, finish = lpt_schedule(names, costs, n_workers)
+    by_name = {feed['name']: feed for feed in feeds}
+    return [by_name[name] for name in ordered], finish
+
+
+def report_schedule(process_seq, task_start_time, predicted):
+    """
+    log the predicted and actual finish time of every feed, then fold the
+    measures of the task into the history. Returns the measures.
+    """
+    measures = load_task_measures(process_seq)
+    actual_makespan = 0.0
+    for name in sorted(predicted, key=predicted.get):
+        finished = measures.get(name, {}).get('finished')
+        actual = finished - task_start_time if finished else None
+        if actual is not None:
+            actual_makespan = max(actual_makespan, actual)
+        logger.info('feed %s. predicted finish: %.0fs, actual: %s' %
+                    (name, predicted[name], '%.0fs' % actual if actual is not None else 'n/a'))
+    logger.warning('feeds makespan. predicted: %.0fs, actual: %.0fs' %
+                   (max(predicted.values() or [0.0]), actual_makespan))
+    update_history(measures)
+    return measures
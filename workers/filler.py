@@ -1,77 +1,24 @@
 import json
 import time
+import threading
 import settings
 
 from framework.base_worker import BaseWorker
 from utils.dup_detect import build_unique_id
-from utils.cache_based_validator import build_cache, cache_based_validator
-from utils.mongo_service import build_mongo_cache, mongo_filler
 from utils.pay_price import calc_pay_price
-from settings import r_db
-
-# import settings
-
-MAJOR_IN_DESC_AND_PREFERRED_TITLE                     = 80
-MAJOR_SYNONYM_IN_DESC_AND_PREFERRED_TITLE             = 55
-MAJOR_IN_DESC_AND_TITLE                               = 50
-MAJOR_SYNONYM_IN_DESC_AND_TITLE                       = 45
-MAJOR_PREFERRED_TITLE                                 = 40
-MAJOR_IN_DESC                                         = 37
-MAJOR_SYNONYM_IN_DESC                                 = 35
-MAJOR_TITLE                                           = 18
-MAJOR_TITLE_TOKEN                                     = 10
-MAJOR_PREFERRED_SIMILAR_TITLE                         = 6
-MAJOR_SIMILAR_TITLE                                   = 3
-MAJOR_DEPRIORTIZE_KEYWORD                             = 0.2
-MAJOR_SIMILAR_TITLE_TOKEN                             = 1
-MAJOR_DEPRIORTIZE_TITLE                               = 0.02
-
-MAJOR_BUCKET_1_CHOICES = {
-    MAJOR_IN_DESC_AND_TITLE,
-    MAJOR_SYNONYM_IN_DESC_AND_TITLE,
-    MAJOR_IN_DESC,
-    MAJOR_SYNONYM_IN_DESC,
-}
-
-MAJOR_BUCKET_3_CHOICES = {
-    MAJOR_IN_DESC_AND_PREFERRED_TITLE,
-    MAJOR_SYNONYM_IN_DESC_AND_PREFERRED_TITLE,
-    MAJOR_PREFERRED_TITLE,
-}
-
-
-def float_in(val, vals):
-    for target in vals:
-        if abs(val - target) < 0.001:
-            return True
-    return False
-
-
-def fill_majors_bucket(job_data, norm_rsp):
-    major = norm_rsp.get('major')
-    if major:
-        major_priority = major or {}
-        majors = list(major_priority.keys())
-        bucket_1 = []
-        bucket_2 = []
-        bucket_3 = []
-        for k, v in major_priority.items():
-            if float_in(v, MAJOR_BUCKET_1_CHOICES):
-                bucket_1.append(k)
-            elif float_in(v, MAJOR_BUCKET_3_CHOICES):
-                bucket_3.append(k)
-            else:
-                bucket_2.append(k)
-
-        job_data.update({
-            'majorPriority': major_priority,  # using it later?
-            'majors': majors,
-            'majorsBucket1': bucket_1,
-            'majorsBucket2': bucket_2,
-            'majorsBucket3': bucket_3,
-        })
-    else:
-        job_data['majorPriority'] = {}
+from redis_access import PendingMarker, TaskConstants, on_flush
+from batching import MicroBatcher
+from perf import timed
+from mongo_enrich import MongoEnricher
+from validator_cache import LazyValidator
+from ref_snapshot import REF_SNAPSHOT_ENABLED, open_task_snapshot, load_reference_tables
+from majors_bucket import fill_majors_bucket, fill_majors_buckets
+
+
+# normalized jobs filled together
+FILL_BATCH_SIZE = getattr(settings, 'FILL_BATCH_SIZE', 200)
+# max seconds a job waits in a partial batch
+FILL_BATCH_MAX_LATENCY = getattr(settings, 'FILL_BATCH_MAX_LATENCY', 1.0)
 
 
 def fill_price(job_data):
@@ -82,7 +29,7 @@ def fill_price(job_data):
     job_data['price'] = calc_pay_price(posting_date, price)
 
 
-def api_filler(job_id, norm_rsp, job_data):
+def api_filler(job_id, norm_rsp, job_data, majors=True):
 
     title = norm_rsp.get('closest_lay_title')
     city = norm_rsp.get('normalized_city')
@@ -90,7 +37,9 @@ def api_filler(job_id, norm_rsp, job_data):
     _company = norm_rsp.get('clean_org_name')
     _companyDisplay = norm_rsp.get('display_org_name') or job_data['company']
 
-    fill_majors_bucket(job_data, norm_rsp)
+    # batch callers classify the majors of all jobs at once
+    if majors:
+        fill_majors_bucket(job_data, norm_rsp)
 
     job_data.update({
         'title': title,
@@ -129,62 +78,116 @@ class FillerWorker(BaseWorker):
 
     def __init__(self, PreTopic, NextTopic):
 
-        # norm job validate method
-        cache = build_cache()
-        self.cache_based_validate = cache_based_validator(cache)
+        # norm job validate method, reference values are looked up on demand
+        self.validator = LazyValidator()
+        # mongo filler, reference documents are looked up on demand
+        self.mongo_enricher = MongoEnricher()
+        # task of the reference snapshot shared by the fillers of the host, if enabled
+        self.snapshot_seq = None
+
+        # processSeq is constant during a task, read it from redis once per task
+        self.task_constants = TaskConstants()
+        # jobs acked but not produced yet keep master waiting
+        self.pending = PendingMarker(__name__)
 
-        # mongo filler
-        mongo_cache = build_mongo_cache()
-        self.mongo_fill = mongo_filler(*mongo_cache)
-        
         # init super last because it will send OK msg to master node
         # and only after all init works it's considered OK.
         super(FillerWorker, self).__init__(__name__, PreTopic, NextTopic)
+        self.batcher = MicroBatcher(self.process_batch, FILL_BATCH_SIZE, FILL_BATCH_MAX_LATENCY)
+        on_flush(self.flush)
 
     def build_msg_key(self, job_id, seq, *args, **kwargs):
         return "%s-%s" % (job_id, str(seq))
 
     def process(self, job_id, norm_rsp, job_data, seq):
-        api_filler(job_id, norm_rsp, job_data)
+        self.pending.add()
+        self.batcher.add((job_id, norm_rsp, job_data, seq))
+
+    def flush(self):
+        """fill the jobs left in the current batch, e.g. when the stage finishes"""
+        self.batcher.flush()
+
+    def load_snapshot(self, process_seq):
+        """
+        switch the validator and the mongo filler to the reference snapshot of
+        task `process_seq`, built once per host and mapped by every filler.
+        runs in the background, batches use the on demand lookups meanwhile
+        """
+        seq = process_seq.decode('utf-8') if isinstance(process_seq, bytes) else process_seq
+        try:
+            snapshot = open_task_snapshot(seq, lambda: load_reference_tables(
+                self.mongo_enricher.db, self.validator.specs, self.mongo_enricher.specs))
+        except Exception as e:
+            # keep the on demand lookups
+            self.logger.exception(e)
+            return
+        if self.snapshot_seq == process_seq:
+            # the previous snapshot is unmapped once no batch uses it
+            self.validator.snapshot = self.mongo_enricher.snapshot = snapshot
+
+    def process_batch(self, msgs):
+        """
+        fill a list of (job_id, norm_rsp, job_data, seq) messages
+        a failing batch is retried whole by the batcher, jobs produced before
+        the failure are produced again under the same keys
+        """
+        # add processSeq field to distinguish between tasks
+        processSeq = self.task_constants.get(settings.KEY_PROCESS_SEQ)
+        if REF_SNAPSHOT_ENABLED and processSeq is not None and processSeq != self.snapshot_seq:
+            self.snapshot_seq = processSeq
+            thread = threading.Thread(target=self.load_snapshot, args=(processSeq, ), name='ref-snapshot')
+            thread.daemon = True
+            thread.start()
 
-        # filter out norm failed jobs
+        # fill copies, a retried batch starts again from the normalized jobs
+        msgs = [(job_id, norm_rsp, dict(job_data), seq) for job_id, norm_rsp, job_data, seq in msgs]
 
-        ok, fields = self.cache_based_validate(job_data)
-        if not ok:
-            fields_dump = {f: job_data[f] for f in fields}
-            fields_dump["jobId"] = job_id
-            fields_dump["source"] = job_data["source"]
-            self.logger.debug('discarded - fields unknown - ' + json.dumps(fields_dump))
-            return
+        fill_majors_buckets([m[2] for m in msgs], [m[1] for m in msgs])
+        for job_id, norm_rsp, job_data, seq in msgs:
+            api_filler(job_id, norm_rsp, job_data, majors=False)
 
-        # mongo filler
-        self.mongo_fill(job_data)
+        # filter out norm failed jobs
+        valid = []
+        results = self.validator.validate_many([m[2] for m in msgs])
+        for msg, (ok, fields) in zip(msgs, results):
+            job_id, _, job_data, _ = msg
+            if not ok:
+                fields_dump = {f: job_data[f] for f in fields}
+                fields_dump["jobId"] = job_id
+                fields_dump["source"] = job_data["source"]
+                self.logger.debug('discarded - fields unknown - ' + json.dumps(fields_dump))
+                continue
+            valid.append(msg)
 
-        # fill price
-        fill_price(job_data)
+        # mongo filler
+        if valid:
+            with timed('mongo_fill', len(valid)):
+                self.mongo_enricher.fill_many([m[2] for m in valid])
 
-        # generate uniqueID by
-        # sha1(companyDisplay, titleDisplay, city, state)
+        for job_id, _, job_data, seq in valid:
+            # fill price
+            fill_price(job_data)
 
-        unique_id = build_unique_id(
-            job_data["companyDisplay"],
-            job_data["titleDisplay"],
-            job_data["city"],
-            job_data["state"],
-        )
+            # generate uniqueID by
+            # sha1(companyDisplay, titleDisplay, city, state)
 
-        # add processSeq field to distinguish between tasks
-        processSeq = r_db.get(settings.KEY_PROCESS_SEQ)
-        job_data["processSeq"] = processSeq
+            unique_id = build_unique_id(
+                job_data["companyDisplay"],
+                job_data["titleDisplay"],
+                job_data["city"],
+                job_data["state"],
+            )
 
-        kwargs = {
-            'job_id': unique_id,
-            'job_data': job_data,
-            'seq': seq,
-        }
+            job_data["processSeq"] = processSeq
 
-        # import json
-        # self.logger.info('record %s' % json.dumps(job_data, indent=4))
+            kwargs = {
+                'job_id': unique_id,
+                'job_data': job_data,
+                'seq': seq,
+            }
 
-        self.produce_msg(**kwargs)
+            # import json
+            # self.logger.info('record %s' % json.dumps(job_data, indent=4))
 
+            self.produce_msg(**kwargs)
+        self.pending.done(len(msgs))
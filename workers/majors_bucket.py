@@ -0,0 +1,159 @@
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+MAJOR_IN_DESC_AND_PREFERRED_TITLE                     = 80
+MAJOR_SYNONYM_IN_DESC_AND_PREFERRED_TITLE             = 55
+MAJOR_IN_DESC_AND_TITLE                               = 50
+MAJOR_SYNONYM_IN_DESC_AND_TITLE                       = 45
+MAJOR_PREFERRED_TITLE                                 = 40
+MAJOR_IN_DESC                                         = 37
+MAJOR_SYNONYM_IN_DESC                                 = 35
+MAJOR_TITLE                                           = 18
+MAJOR_TITLE_TOKEN                                     = 10
+MAJOR_PREFERRED_SIMILAR_TITLE                         = 6
+MAJOR_SIMILAR_TITLE                                   = 3
+MAJOR_DEPRIORTIZE_KEYWORD                             = 0.2
+MAJOR_SIMILAR_TITLE_TOKEN                             = 1
+MAJOR_DEPRIORTIZE_TITLE                               = 0.02
+
+MAJOR_BUCKET_1_CHOICES = {
+    MAJOR_IN_DESC_AND_TITLE,
+    MAJOR_SYNONYM_IN_DESC_AND_TITLE,
+    MAJOR_IN_DESC,
+    MAJOR_SYNONYM_IN_DESC,
+}
+
+MAJOR_BUCKET_3_CHOICES = {
+    MAJOR_IN_DESC_AND_PREFERRED_TITLE,
+    MAJOR_SYNONYM_IN_DESC_AND_PREFERRED_TITLE,
+    MAJOR_PREFERRED_TITLE,
+}
+
+
+FLOAT_TOLERANCE = 0.001
+
+
+def float_in(val, vals):
+    for target in vals:
+        if abs(val - target) < FLOAT_TOLERANCE:
+            return True
+    return False
+
+
+def _build_lookup():
+    """
+    rounded score -> [(target, bucket)], bucket 1 targets first as float_in
+    checks them first. Every score within FLOAT_TOLERANCE of a target rounds
+    to one of the keys of that target.
+    """
+    lookup = {}
+    for bucket, choices in ((1, MAJOR_BUCKET_1_CHOICES), (3, MAJOR_BUCKET_3_CHOICES)):
+        for target in sorted(choices):
+            for key in {round(target - FLOAT_TOLERANCE), round(target + FLOAT_TOLERANCE)}:
+                lookup.setdefault(key, []).append((target, bucket))
+    return lookup
+
+
+BUCKET_LOOKUP = _build_lookup()
+
+
+def bucket_of(v):
+    """
+    same result as the float_in checks against the bucket 1 and 3 choices
+    """
+    try:
+        key = round(v)
+    except (ValueError, OverflowError):
+        # nan and inf are never close to a target
+        return 2
+    for target, bucket in BUCKET_LOOKUP.get(key, ()):
+        if abs(v - target) < FLOAT_TOLERANCE:
+            return bucket
+    return 2
+
+
+def _update_buckets(job_data, major_priority, buckets):
+    bucket_1 = []
+    bucket_2 = []
+    bucket_3 = []
+    lists = {1: bucket_1, 2: bucket_2, 3: bucket_3}
+    for k, bucket in zip(major_priority.keys(), buckets):
+        lists[bucket].append(k)
+
+    job_data.update({
+        'majorPriority': major_priority,  # using it later?
+        'majors': list(major_priority.keys()),
+        'majorsBucket1': bucket_1,
+        'majorsBucket2': bucket_2,
+        'majorsBucket3': bucket_3,
+    })
+
+
+def fill_majors_bucket(job_data, norm_rsp):
+    major = norm_rsp.get('major')
+    if major:
+        _update_buckets(job_data, major, [bucket_of(v) for v in major.values()])
+    else:
+        job_data['majorPriority'] = {}
+
+
+def _build_arrays():
+    """
+    sorted targets and their buckets, bucket 1 wins for a target in both sets
+    """
+    targets = {}
+    for items in BUCKET_LOOKUP.values():
+        for target, bucket in items:
+            targets[target] = min(bucket, targets.get(target, bucket))
+    keys = sorted(targets)
+    return (np.array(keys, dtype=np.float64),
+            np.array([targets[t] for t in keys], dtype=np.int8))
+
+
+if np is not None:
+    BUCKET_TARGETS, BUCKET_VALUES = _build_arrays()
+
+
+def classify_scores(scores):
+    """
+    bucket of every score in one numpy pass. The tolerance check is the same
+    float operation as float_in, so results are identical.
+    """
+    scores = np.asarray(scores, dtype=np.float64)
+    result = np.full(len(scores), 2, dtype=np.int8)
+    idx = np.searchsorted(BUCKET_TARGETS, scores)
+    last = len(BUCKET_TARGETS) - 1
+    # targets are far apart, a score can only be close to its sorted neighbours
+    for cand in (np.clip(idx - 1, 0, last), np.clip(idx, 0, last)):
+        match = (np.abs(scores - BUCKET_TARGETS[cand]) < FLOAT_TOLERANCE) & (result == 2)
+        result[match] = BUCKET_VALUES[cand][match]
+    return result
+
+
+def fill_majors_buckets(job_datas, norm_rsps):
+    """
+    fill_majors_bucket for a batch of jobs, the scores of the whole batch are
+    classified together. Falls back to the per-job lookup without numpy.
+    """
+    if np is None:
+        for job_data, norm_rsp in zip(job_datas, norm_rsps):
+            fill_majors_bucket(job_data, norm_rsp)
+        return
+
+    scores = []
+    for norm_rsp in norm_rsps:
+        scores.extend((norm_rsp.get('major') or {}).values())
+    buckets = classify_scores(scores).tolist() if scores else []
+
+    pos = 0
+    for job_data, norm_rsp in zip(job_datas, norm_rsps):
+        major = norm_rsp.get('major')
+        if major:
+            n = len(major)
+            _update_buckets(job_data, major, buckets[pos:pos + n])
+            pos += n
+        else:
+            job_data['majorPriority'] = {}
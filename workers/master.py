@@ -2,12 +2,20 @@ import time
 import json
 
 from os.path import join
+from concurrent.futures import ThreadPoolExecutor
 
 import settings
 
 from settings import r_db
 from framework.base_worker import BaseWorker
 from utils.clean_es import clean_es
+from doc_fingerprint import ES_SKIP_UNCHANGED, clean_es_by_ids
+from redis_access import publish_task_changed, publish_flush, pending_workers
+from prefetch import FEED_PREFETCH, FEED_PREFETCH_MARGIN, FeedPrefetcher
+from perf import log_report
+from feed_schedule import FEED_SCHEDULE_LPT, FEED_SCHEDULE_WORKERS, schedule_feeds, report_schedule
+from monitor import (METRICS_SNAPSHOT_PATH, METRICS_PORT, PipelineMetrics, MetricsServer,
+                     TopicCounters, write_snapshot)
 from utils import cache
 from topics.job_source import JobSourceTopic
 from topics.downloaded_xml import DownloadedXmlTopic
@@ -29,10 +37,20 @@ class Master(BaseWorker):
         # !IMPORTANT
         # if new state are added, make sure they are reset in handle_setup
         self._topic_check_idx = 0
-        self._last_topic_counts = None
-        self._topic_idle_start_time = None
+        self._finished_counts = None
+        self._metrics = PipelineMetrics(self._topic_names())
         self._task_start_time = None
         self._task_finish_time = None
+        self._feed_finish_predicted = {}
+        self._prefetcher = FeedPrefetcher() if FEED_PREFETCH else None
+
+        # counters of the topics exposing their keys in one pipeline, the
+        # other topics are read concurrently through their methods
+        self._counters = TopicCounters(topics, ThreadPoolExecutor(max(1, len(topics))))
+        self._metrics_server = MetricsServer(METRICS_PORT) if METRICS_PORT else None
+
+    def _topic_names(self):
+        return [topic.topic_name for topic in self._topics]
 
     @staticmethod
     def _run(meth, sleep_interval=None):
@@ -90,6 +108,8 @@ class Master(BaseWorker):
         process_seq = time.strftime("%Y%m%d%H%M", time.gmtime())
         self._process_seq = process_seq
         r_db.set(settings.KEY_PROCESS_SEQ, process_seq)
+        # workers cache task constants locally
+        publish_task_changed()
         self.logger.info("generated process_seq: %s" % process_seq)
 
         # send init message
@@ -97,7 +117,28 @@ class Master(BaseWorker):
         topic = JobSourceTopic()
         topic.set_producer_running()
 
-        for feed in topic.load_cache():
+        feeds = list(topic.load_cache())
+
+        # feeds prefetched in the last idle window become current now
+        prefetched = set()
+        if self._prefetcher is not None:
+            try:
+                prefetched = self._prefetcher.swap_in()
+            except Exception as e:
+                self.logger.exception(e)
+        feeds = [dict(feed, prefetched=True) if feed['name'] in prefetched else feed for feed in feeds]
+
+        self._feed_finish_predicted = {}
+        if FEED_SCHEDULE_LPT:
+            try:
+                feeds, self._feed_finish_predicted = schedule_feeds(feeds, self._feed_workers())
+                self.logger.info("feeds scheduled longest first, predicted makespan: %.0fs" %
+                                 max(self._feed_finish_predicted.values() or [0.0]))
+            except Exception as e:
+                # keep load_cache order
+                self.logger.exception(e)
+
+        for feed in feeds:
             self.logger.info('sent to Topic %s, feed=%2d. %s' % (topic.topic_name, feed['order'], feed['name']))
             topic.produce(feed)
 
@@ -105,13 +146,25 @@ class Master(BaseWorker):
 
         # reset state
         self._topic_check_idx = 0
-        self._last_topic_counts = None
-        self._topic_idle_start_time = None
+        self._finished_counts = None
+        self._metrics = PipelineMetrics(self._topic_names())
         self._task_start_time = time.time()
         self._task_finish_time = None
 
         self.logger.info("finished setting up env")
 
+    def _feed_workers(self):
+        """
+        feeds processed at a time, the fewest replicas of downloaders and parsers:
+        each replica takes one feed at a time, DOWNLOAD_CONCURRENCY only splits
+        a single feed in byte ranges
+        """
+        if FEED_SCHEDULE_WORKERS:
+            return FEED_SCHEDULE_WORKERS
+        counts = [int(n) for worker, n in self._workers_info.items()
+                  if 'download' in worker.lower() or 'parser' in worker.lower()]
+        return min(counts) if counts else 1
+
     def handle_monitor(self):
         """
         Monitoring worker status and task progress
@@ -121,64 +174,101 @@ class Master(BaseWorker):
            1. how many steps have finished
            2. the number of message in, message out, error message
         """
-        # dump current topic counts
-        topic_counts = [(
-            topic.get_cnt_produced() or 0,
-            topic.get_cnt_consumed() or 0,
-            topic.get_cnt_cached() or 0,
-        ) for topic in self._topics]
+        # dump current topic counts, in one round trip
+        topic_counts = self._counters.read()
+        self._metrics.update(topic_counts)
+        self.publish_metrics()
 
         # if topic counts didn't change for more than TOPIC_COUNT_MAX_IDLE_TIME
         # consider the system has finished and log a warning
+        # the task normally finishes on its counters below, this only ends a stuck one
         # >> shared states involved <<
-        # * _last_topic_counts
-        # * _topic_idle_start_time
+        # * _metrics
         # * TOPIC_COUNT_MAX_IDLE_TIME
-        if self._last_topic_counts and self._last_topic_counts == topic_counts:
-            if not self._topic_idle_start_time:
-                self.logger.warn("topic counts didn't change, starts counting idle time")
-                self._topic_idle_start_time = time.time()
-            else:
-                idle_time = time.time() - self._topic_idle_start_time
-                if idle_time > TOPIC_COUNT_MAX_IDLE_TIME:
-                    self.logger.warn("topic counts didn't change for %ds, consider as finished" %
-                                     TOPIC_COUNT_MAX_IDLE_TIME)
-                    return SUCC
-                self.logger.warn("topic has been idle for %ds" % idle_time)
-        else:
-            # topic counts changed, so set _topic_idle_start_time to None
-            self._topic_idle_start_time = None
-        self._last_topic_counts = topic_counts
+        if not self._metrics.changed:
+            idle_time = self._metrics.quiet_time()
+            if idle_time > TOPIC_COUNT_MAX_IDLE_TIME:
+                # messages held by a worker move no counter, e.g. norm batches
+                # waiting for a retry, finishing would delete their documents
+                pending = pending_workers()
+                if pending:
+                    self.logger.warning("topic counts didn't change for %ds, waiting for workers holding messages: %s" %
+                                        (idle_time, ', '.join(pending)))
+                    publish_flush()
+                    return ENOTFIN
+                self.logger.warn("topic counts didn't change for %ds, consider as finished" %
+                                 TOPIC_COUNT_MAX_IDLE_TIME)
+                return SUCC
+            self.logger.warn("topic has been idle for %ds" % idle_time)
 
         # check topic finish state
-        while self._topic_check_idx < len(self._topics):
-            # all topics before are finished while this topic is not at last check
-            # so check it
-            topic = self._topics[self._topic_check_idx]
-            n_produced, n_consumed, n_cached = topic_counts[self._topic_check_idx]
+        # every topic at each check, a worker holding acked messages may still
+        # produce to a topic found done before
+        for idx, topic in enumerate(self._topics):
+            n_produced, n_consumed, n_cached = topic_counts[idx]
 
             # do not check n_produced > 0, for feed error may result in 0 message produced in some workerss
             if n_consumed < n_produced:  # n_msg_out >= n_msg_in
                 self.logger.debug("running %s, produced/consumed/cached: %s/%s/%s" %
                                   (topic.topic_name, n_produced, n_consumed, n_cached))
+                self._finished_counts = None
                 return ENOTFIN  # unfinished
-            else:
-                self._topic_check_idx += 1
+            elif idx >= self._topic_check_idx:
+                self._topic_check_idx = idx + 1
                 self.logger.warning("done %s, produced/consumed/cached: %s/%s/%s" %
                                     (topic.topic_name, n_produced, n_consumed, n_cached))
 
+        # batching workers ack messages before they produce them downstream
+        # >> shared states involved <<
+        # * _finished_counts
+        pending = pending_workers()
+        if pending:
+            self.logger.info("topics done, waiting for workers holding messages: %s" % ', '.join(pending))
+            # the stage ended, no need to wait for the batch deadlines
+            publish_flush()
+            self._finished_counts = None
+            return ENOTFIN
+
+        # a message held between two checks moves the counters, so balanced
+        # counters which did not change since the previous check, with nothing
+        # held at either, mean every message went through
+        if self._finished_counts != topic_counts:
+            self._finished_counts = topic_counts
+            return ENOTFIN
+
         self.logger.info("considered success, go to finish state.")
         return SUCC
 
+    def publish_metrics(self):
+        """
+        records/sec, queue depth and eta of every stage, to the snapshot file and endpoint
+        """
+        data = self._metrics.snapshot()
+        data['process_seq'] = getattr(self, '_process_seq', None)
+        self.logger.info("eta: %ss, %s" % (data['eta'], ', '.join(
+            '%s %s/s depth %s' % (s['topic'], s['out_rate'], s['depth']) for s in data['stages'])))
+        if self._metrics_server is not None:
+            self._metrics_server.data = data
+        if METRICS_SNAPSHOT_PATH:
+            try:
+                write_snapshot(METRICS_SNAPSHOT_PATH, data)
+            except (IOError, OSError) as e:
+                self.logger.exception(e)
+
     def handle_finish(self):
         """
         After all data has been processed.
         1. _delete_by_query { query: { bool: { must_not: { term { processSeq: $SEQ } } } } }
+           or with ES_SKIP_UNCHANGED, delete the ids the sinkers didn't see in this task,
+           as unchanged documents keep their old processSeq
         """
         process_seq_id = self._process_seq
         if process_seq_id:
             try:
-                is_succ, rate = clean_es(process_seq_id)
+                if ES_SKIP_UNCHANGED:
+                    is_succ, rate = self.clean_es_by_ids(process_seq_id)
+                else:
+                    is_succ, rate = clean_es(process_seq_id)
                 if is_succ:
                     self.logger.info("successfully cleand up elasticsearch, del rate: %f" % rate)
                 else:
@@ -187,16 +277,51 @@ class Master(BaseWorker):
                 self.logger.exception(e)
         else:
             self.logger.warn("process seq (%s) not valid, skip es clean up" % process_seq_id)
+
+        # predicted vs actual feed finish times, and feed history for the next schedule
+        if process_seq_id:
+            try:
+                report_schedule(process_seq_id, self._task_start_time, self._feed_finish_predicted)
+            except Exception as e:
+                self.logger.exception(e)
+            # where the stages spent their time, all workers included
+            try:
+                log_report(process_seq_id, self.logger)
+            except Exception as e:
+                self.logger.exception(e)
         
         # mark finish time
         self._task_finish_time = time.time()
 
+    def clean_es_by_ids(self, process_seq_id):
+        """
+        the id diff is only right once every sinker wrote what it acked, the ids
+        of documents still held are not in the seen set yet. handle_monitor
+        waits for that, this is the barrier in case the wait was cut short
+        """
+        pending = pending_workers()
+        if pending:
+            self.logger.warn("workers still hold documents: %s, skip es clean up" % ', '.join(pending))
+            return False, 0.0
+        return clean_es_by_ids(process_seq_id)
+
     def handle_idle(self):
         """
         Checks if it's ok to start task of next day
+        With FEED_PREFETCH, changed feeds are staged for the next task meanwhile
         Then switch master status to S_SETUP
         """
         time_remain = TASK_RERUN_WAIT_TIME + self._task_finish_time - time.time()
+
+        # move the downloads of the next task off its critical path
+        if self._prefetcher is not None and time_remain > FEED_PREFETCH_MARGIN:
+            deadline = TASK_RERUN_WAIT_TIME + self._task_finish_time - FEED_PREFETCH_MARGIN
+            try:
+                self._prefetcher.prefetch(list(JobSourceTopic().load_cache()), deadline)
+            except Exception as e:
+                self.logger.exception(e)
+            time_remain = TASK_RERUN_WAIT_TIME + self._task_finish_time - time.time()
+
         while time_remain > 0:
             self.logger.info("Idling... remaining idle time: %ds" % time_remain)
             time.sleep(60)
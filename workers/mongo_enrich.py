@@ -0,0 +1,191 @@
+import logging
+import threading
+from collections import OrderedDict
+
+import settings
+
+
+logger = logging.getLogger(__name__)
+
+MONGO_URL = getattr(settings, 'MONGO_URL', 'mongodb://localhost:27017')
+MONGO_DB = getattr(settings, 'MONGO_DB', 'jobs')
+# reference documents kept per enrichment spec
+MONGO_CACHE_SIZE = getattr(settings, 'MONGO_CACHE_SIZE', 200000)
+# max keys in one $in query
+MONGO_IN_CHUNK_SIZE = getattr(settings, 'MONGO_IN_CHUNK_SIZE', 1000)
+
+# collection: reference collection
+# key: job field holding the lookup value
+# field: document field matched against it
+# fill: {document field: job field}, copied into the job
+# default: job field copied into the fill targets when no document matches
+MONGO_FILL_SPECS = getattr(settings, 'MONGO_FILL_SPECS', (
+    {
+        'collection': 'titles',
+        'key': 'title1',
+        'field': 'title',
+        'fill': {'display': 'titleDisplay'},
+        'default': 'title1',
+    },
+))
+
+LOG_INTERVAL = 100000
+
+# cached marker of a key without document, so it is not queried again
+MISSING = object()
+_NOT_CACHED = object()
+
+
+def snapshot_table(spec):
+    # name of the fill table of `spec` in a reference snapshot
+    return '%s:fill' % spec['collection']
+
+
+def build_mongo_db():
+    from pymongo import MongoClient
+    return MongoClient(MONGO_URL, connect=False)[MONGO_DB]
+
+
+def lookup_key(value):
+    """
+    `value` as a lookup key, None if it can not be looked up (empty or a
+    list, the norm api answers some fields as lists)
+    """
+    if value is None or value == '' or isinstance(value, (list, tuple, dict, set)):
+        return None
+    return value
+
+
+class LRUCache(object):
+    """
+    Bounded mapping evicting the least recently used keys, safe across threads.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def get_many(self, keys):
+        """
+        (found, missing keys) for `keys`
+        """
+        found = {}
+        missing = []
+        for key in keys:
+            value = self.get(key, _NOT_CACHED)
+            if value is _NOT_CACHED:
+                missing.append(key)
+            else:
+                found[key] = value
+        return found, missing
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return float(self.hits) / total if total else 0.0
+
+
+class MongoEnricher(object):
+    """
+    Fills jobs from reference collections, a batch at a time.
+
+    The distinct lookup values of a batch are read from a bounded LRU cache
+    per spec, the misses are fetched with one `$in` query per spec (chunked
+    by MONGO_IN_CHUNK_SIZE). Keys without document are cached too. Nothing
+    is loaded ahead, so startup time and memory do not depend on the size
+    of the collections. Query errors reach the caller, the batcher retries
+    the batch. Specs whose table is in `snapshot`, a RefSnapshot, are
+    answered by it instead.
+    """
+
+    def __init__(self, db=None, specs=MONGO_FILL_SPECS, cache_size=MONGO_CACHE_SIZE, snapshot=None):
+        self._db = db
+        self.specs = specs
+        self.snapshot = snapshot
+        self.caches = [LRUCache(cache_size) for _ in specs]
+        self.queried = 0
+        self.filled = 0
+
+    @property
+    def db(self):
+        if self._db is None:
+            self._db = build_mongo_db()
+        return self._db
+
+    def fetch(self, spec, keys):
+        projection = dict.fromkeys(spec['fill'], 1)
+        projection[spec['field']] = 1
+        projection['_id'] = 0
+        docs = {}
+        collection = self.db[spec['collection']]
+        for i in range(0, len(keys), MONGO_IN_CHUNK_SIZE):
+            chunk = keys[i:i + MONGO_IN_CHUNK_SIZE]
+            for doc in collection.find({spec['field']: {'$in': chunk}}, projection):
+                docs.setdefault(doc.get(spec['field']), doc)
+        self.queried += len(keys)
+        return docs
+
+    def lookup(self, spec, cache, keys):
+        """
+        {key: document or MISSING} for the distinct `keys`
+        """
+        snapshot, table = self.snapshot, snapshot_table(spec)
+        if snapshot is not None and table in snapshot.tables:
+            # complete for the task and shared by the host, no need to cache
+            return {key: snapshot.get(table, key, MISSING) for key in keys}
+
+        found, missing = cache.get_many(keys)
+        if missing:
+            docs = self.fetch(spec, missing)
+            for key in missing:
+                doc = docs.get(key, MISSING)
+                cache.put(key, doc)
+                found[key] = doc
+        return found
+
+    def fill_many(self, job_datas):
+        for spec, cache in zip(self.specs, self.caches):
+            keys = [lookup_key(j.get(spec['key'])) for j in job_datas]
+            # in batch order, so the cache evicts in a predictable order
+            distinct = [k for k in OrderedDict.fromkeys(keys) if k is not None]
+            docs = self.lookup(spec, cache, distinct) if distinct else {}
+            for key, job_data in zip(keys, job_datas):
+                doc = docs.get(key, MISSING)
+                for src, dst in spec['fill'].items():
+                    if doc is not MISSING and doc.get(src) is not None:
+                        job_data[dst] = doc[src]
+                    elif job_data.get(dst) is None and spec.get('default'):
+                        job_data[dst] = job_data.get(spec['default'])
+
+        before = self.filled
+        self.filled += len(job_datas)
+        if self.filled // LOG_INTERVAL != before // LOG_INTERVAL:
+            self.log_stats()
+
+    def log_stats(self):
+        for spec, cache in zip(self.specs, self.caches):
+            logger.info('mongo enrich %s. cached: %s, hit rate: %.2f%%, queried keys: %s' %
+                        (spec['collection'], len(cache), cache.hit_rate() * 100, self.queried))
@@ -0,0 +1,166 @@
+import os
+import json
+import time
+import logging
+import threading
+from collections import deque
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from settings import r_db
+
+import settings
+
+
+logger = logging.getLogger(__name__)
+
+# seconds of counter history the rates are computed over
+MONITOR_WINDOW = getattr(settings, 'MONITOR_WINDOW', 60)
+# json snapshot of the metrics rewritten every tick, None disables it
+METRICS_SNAPSHOT_PATH = getattr(settings, 'METRICS_SNAPSHOT_PATH', None)
+# local http endpoint serving the snapshot, None disables it
+METRICS_PORT = getattr(settings, 'METRICS_PORT', None)
+
+COUNTER_METHODS = ('get_cnt_produced', 'get_cnt_consumed', 'get_cnt_cached')
+
+
+class TopicCounters(object):
+    """
+    Reads (produced, consumed, cached) of every topic.
+
+    A topic exposing `counter_keys()`, the redis keys holding its produced,
+    consumed and cached counters as plain values, is read with one GET per
+    key, all topics in one pipeline. The other topics are asked through
+    their get_cnt_* methods, overlapped in `executor` if given.
+    """
+
+    def __init__(self, topics, executor=None):
+        self.topics = topics
+        self.executor = executor
+        self.keys = [tuple(topic.counter_keys()) if hasattr(topic, 'counter_keys') else None
+                     for topic in topics]
+        unkeyed = [type(t).__name__ for t, k in zip(topics, self.keys) if k is None]
+        if unkeyed:
+            logger.info('counters read through the topic methods: %s' % ', '.join(unkeyed))
+
+    @staticmethod
+    def _read(topic):
+        return tuple(getattr(topic, meth)() for meth in COUNTER_METHODS)
+
+    def read(self):
+        """
+        [(produced, consumed, cached)] of every topic, aligned with topics
+        """
+        keyed = [i for i, k in enumerate(self.keys) if k is not None]
+        raw = [None] * len(self.topics)
+        if keyed:
+            pipe = r_db.pipeline(transaction=False)
+            for i in keyed:
+                for key in self.keys[i]:
+                    pipe.get(key)
+            values = pipe.execute()
+            for n, i in enumerate(keyed):
+                raw[i] = values[n * 3:n * 3 + 3]
+
+        rest = [i for i, k in enumerate(self.keys) if k is None]
+        if rest:
+            mapper = self.executor.map if self.executor is not None else map
+            for i, values in zip(rest, mapper(self._read, [self.topics[i] for i in rest])):
+                raw[i] = values
+        return [tuple(int(v or 0) for v in values) for values in raw]
+
+
+class PipelineMetrics(object):
+    """
+    Rolling window of topic counters, and the rates derived from it.
+
+    `update` is called once per master tick with the counters of every topic.
+    """
+
+    def __init__(self, names, window=MONITOR_WINDOW):
+        self.names = names
+        self.window = window
+        self.start_time = time.time()
+        self._history = deque()
+        self._last_change = None
+        self.changed = True
+
+    def update(self, counts, now=None):
+        now = time.time() if now is None else now
+        self.changed = not self._history or self._history[-1][1] != counts
+        if self.changed:
+            self._last_change = now
+        self._history.append((now, counts))
+        # keep one sample older than the window, rates span the full window
+        while len(self._history) > 2 and now - self._history[1][0] >= self.window:
+            self._history.popleft()
+
+    def quiet_time(self, now=None):
+        """seconds since a counter last changed"""
+        if self._last_change is None:
+            return 0.0
+        return (time.time() if now is None else now) - self._last_change
+
+    def snapshot(self, now=None):
+        now = time.time() if now is None else now
+        stages = []
+        if self._history:
+            t0, first = self._history[0]
+            t1, last = self._history[-1]
+            span = t1 - t0
+            for name, (p0, c0, _), (produced, consumed, cached) in zip(self.names, first, last):
+                in_rate = (produced - p0) / span if span > 0 else 0.0
+                out_rate = (consumed - c0) / span if span > 0 else 0.0
+                depth = max(0, produced - consumed)
+                stages.append({
+                    'topic': name,
+                    'produced': produced,
+                    'consumed': consumed,
+                    'cached': cached,
+                    'depth': depth,
+                    'in_rate': round(in_rate, 2),
+                    'out_rate': round(out_rate, 2),
+                    'eta': round(depth / out_rate, 1) if out_rate > 0 else (0.0 if not depth else None),
+                })
+        etas = [s['eta'] for s in stages]
+        return {
+            'time': now,
+            'elapsed': round(now - self.start_time, 1),
+            'quiet_time': round(self.quiet_time(now), 1),
+            # the slowest stage bounds the end of the task
+            'eta': None if None in etas else max(etas or [0.0]),
+            'stages': stages,
+        }
+
+
+def write_snapshot(path, data):
+    # write then rename, readers never see a partial file
+    with open(path + '.tmp', 'w') as f:
+        json.dump(data, f)
+    os.rename(path + '.tmp', path)
+
+
+class MetricsServer(object):
+    """
+    Serves the last metrics snapshot as json on a local port, from a daemon thread.
+    """
+
+    def __init__(self, port, host='127.0.0.1'):
+        self.data = {}
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = json.dumps(server.data).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._httpd = HTTPServer((host, port), Handler)
+        thread = threading.Thread(target=self._httpd.serve_forever, name='metrics-server')
+        thread.daemon = True
+        thread.start()
@@ -0,0 +1,162 @@
+import json
+import time
+import hashlib
+import logging
+import sqlite3
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+# max number of variables in one sqlite statement
+SQLITE_MAX_VARS = 900
+
+
+def build_version(flags, version=1):
+    """
+    cache namespace of the norm responses, changes with the request flags
+    so responses classified with other flags are never served
+    """
+    raw = json.dumps([version, flags], sort_keys=True)
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()[:12]
+
+
+def _normalize(value):
+    if isinstance(value, str):
+        return ' '.join(value.split())
+    return value
+
+
+def build_key(version, norm_job):
+    """
+    content address of a norm request job, insensitive to whitespace noise
+    """
+    data = {k: _normalize(v) for k, v in norm_job.items()}
+    raw = json.dumps(data, sort_keys=True)
+    return '%s:%s' % (version, hashlib.sha1(raw.encode('utf-8')).hexdigest())
+
+
+class SqliteNormCache(object):
+    """
+    Norm responses in a local sqlite file, which survives between runs.
+
+    Entries expire `ttl` seconds after they are written. Once more than
+    `max_entries` are stored the least recently used ones are evicted.
+    """
+
+    def __init__(self, path, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS norm_cache '
+            '(key TEXT PRIMARY KEY, value TEXT, expires REAL, accessed REAL)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS norm_cache_accessed ON norm_cache (accessed)')
+        self._conn.commit()
+        self._writes = 0
+
+    def get_many(self, keys):
+        now = time.time()
+        found = {}
+        with self._lock:
+            for i in range(0, len(keys), SQLITE_MAX_VARS):
+                chunk = keys[i:i + SQLITE_MAX_VARS]
+                marks = ','.join('?' * len(chunk))
+                rows = self._conn.execute(
+                    'SELECT key, value FROM norm_cache WHERE key IN (%s) AND expires > ?' % marks,
+                    chunk + [now]).fetchall()
+                for key, value in rows:
+                    found[key] = json.loads(value)
+                if rows:
+                    hit_keys = [r[0] for r in rows]
+                    self._conn.execute(
+                        'UPDATE norm_cache SET accessed = ? WHERE key IN (%s)' % ','.join('?' * len(hit_keys)),
+                        [now] + hit_keys)
+            self._conn.commit()
+        return found
+
+    def set_many(self, items):
+        now = time.time()
+        rows = [(key, json.dumps(value), now + self.ttl, now) for key, value in items.items()]
+        with self._lock:
+            self._conn.executemany('INSERT OR REPLACE INTO norm_cache VALUES (?, ?, ?, ?)', rows)
+            self._conn.commit()
+            self._writes += len(rows)
+            if self._writes >= self.max_entries // 100 + 1:
+                self._writes = 0
+                self._evict(now)
+
+    def _evict(self, now):
+        self._conn.execute('DELETE FROM norm_cache WHERE expires <= ?', (now, ))
+        count = self._conn.execute('SELECT COUNT(*) FROM norm_cache').fetchone()[0]
+        if count > self.max_entries:
+            self._conn.execute(
+                'DELETE FROM norm_cache WHERE key IN '
+                '(SELECT key FROM norm_cache ORDER BY accessed LIMIT ?)', (count - self.max_entries, ))
+        self._conn.commit()
+
+
+class RedisNormCache(object):
+    """
+    Norm responses in redis, shared by every normalizer.
+    Expiry is a redis TTL, LRU eviction is left to the redis maxmemory policy.
+    """
+
+    def __init__(self, client, ttl):
+        self.client = client
+        self.ttl = int(ttl)
+
+    def get_many(self, keys):
+        if not keys:
+            return {}
+        values = self.client.mget(keys)
+        return {k: json.loads(v) for k, v in zip(keys, values) if v is not None}
+
+    def set_many(self, items):
+        pipe = self.client.pipeline(transaction=False)
+        for key, value in items.items():
+            pipe.setex(key, self.ttl, json.dumps(value))
+        pipe.execute()
+
+
+class NormCache(object):
+    """
+    Content-addressed norm response cache in front of the norm service.
+    `backend` is a SqliteNormCache or RedisNormCache.
+    """
+
+    def __init__(self, backend, version):
+        self.backend = backend
+        self.version = version
+        self.hits = 0
+        self.misses = 0
+
+    def keys(self, norm_jobs):
+        return [build_key(self.version, j) for j in norm_jobs]
+
+    def get_many(self, keys):
+        try:
+            found = self.backend.get_many(keys)
+        except Exception as e:
+            # the cache is an optimization, never fail a batch for it
+            logger.exception(e)
+            found = {}
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return found
+
+    def set_many(self, items):
+        if not items:
+            return
+        try:
+            self.backend.set_many(items)
+        except Exception as e:
+            logger.exception(e)
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return float(self.hits) / total if total else 0.0
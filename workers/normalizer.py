@@ -2,9 +2,22 @@ import logging
 import requests
 import time
 import json
+import atexit
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 from framework.base_worker import BaseWorker
 from framework import reports
+from batching import MicroBatcher, AdaptiveBatchSize, RetryQueue
+from perf import timeperf
+from redis_access import PendingMarker
+from norm_cache import NormCache, SqliteNormCache, RedisNormCache, build_version
 
 import settings
 from settings._redis import r_db
@@ -26,8 +39,20 @@ MAJOR_BUCKET_1_CHOICES = {
     MAJOR_SYNONYM_IN_DESC,
 }
 
+# (seconds since the first failure of a batch, base retry delay in seconds)
+# a batch still failing after the last stage is given up
 RETRY_PRESET = [(3, 0), (10, 0), (60, 10), (600, 30), (1800, 120)]
 RETRY_PRESET_LEN = len(RETRY_PRESET)
+# jittered exponential backoff added on top of the preset delay
+RETRY_MIN_BACKOFF = 0.5
+RETRY_MAX_BACKOFF = 30
+# batches failing this many times (other than 429) are split in halves
+RETRY_BISECT_AFTER = 3
+# batches waiting for a retry, more failing batches are discarded
+RETRY_QUEUE_SIZE = 100
+# rejections caused by the content of the batch, bisected to isolate the bad jobs
+# other 4xx (auth, config) fail the same for any job, the batch is discarded at once
+BISECT_STATUS_CODES = {400, 413, 422}
 
 logger = logging.getLogger(__name__)
 
@@ -36,97 +61,295 @@ LOG_INTERVAL = 10
 
 LOCATION_EDIT_DISTANCE = 2
 
-_job_batch = []
-_job_ids = []
-_job_seqs = []
-_job_feeds = []
+# a partial batch is sent once its oldest job waited this long (seconds)
+NORM_BATCH_MAX_LATENCY = getattr(settings, 'NORM_BATCH_MAX_LATENCY', 5.0)
+# bounds of the adaptive batch size, NORM_BATCH_SIZE is the initial size
+NORM_BATCH_MIN_SIZE = getattr(settings, 'NORM_BATCH_MIN_SIZE', max(1, settings.NORM_BATCH_SIZE // 4))
+NORM_BATCH_MAX_SIZE = getattr(settings, 'NORM_BATCH_MAX_SIZE', settings.NORM_BATCH_SIZE * 4)
+# batches answered slower than this shrink the batch size (seconds)
+NORM_TARGET_LATENCY = getattr(settings, 'NORM_TARGET_LATENCY', 10.0)
+# norm batches in flight at the same time
+NORM_CONCURRENCY = getattr(settings, 'NORM_CONCURRENCY', 4)
 
+# norm response cache, 'sqlite', 'redis' or None to disable it
+NORM_CACHE_BACKEND = getattr(settings, 'NORM_CACHE_BACKEND', None)
+NORM_CACHE_PATH = getattr(settings, 'NORM_CACHE_PATH', 'norm_cache.sqlite')
+NORM_CACHE_REDIS_URL = getattr(settings, 'NORM_CACHE_REDIS_URL', None)
+NORM_CACHE_TTL = getattr(settings, 'NORM_CACHE_TTL', 7 * 24 * 3600)
+NORM_CACHE_MAX_ENTRIES = getattr(settings, 'NORM_CACHE_MAX_ENTRIES', 5000000)
+# bump to drop every cached response, e.g. after a norm service release
+NORM_CACHE_VERSION = getattr(settings, 'NORM_CACHE_VERSION', 1)
 
-def timeperf(f):
-    def wrapper(*args, **kwargs):
-        t1 = time.time()
-        r = f(*args, **kwargs)
-        t = time.time() - t1
-        logger.info('timecost: %.4f' % t)
-        return r
-    return wrapper
+NORM_FLAGS = {
+    'classify_job_level': True,
+    'classify_major': True,
+    'classify_education_degree': True,
+    'extract_benefits': True,
+    'extract_visa_status': True,
+    'extract_job_type': True,
+}
+
+
+def retry_delay(elapsed, attempt):
+    """
+    seconds to wait before the next attempt of a batch, None to give up
+    """
+    for max_elapsed, base_delay in RETRY_PRESET:
+        if elapsed < max_elapsed:
+            break
+    else:
+        return None
+    backoff = min(RETRY_MAX_BACKOFF, RETRY_MIN_BACKOFF * 2 ** attempt)
+    return base_delay + random.uniform(0, backoff)
+
+
+def build_norm_session(pool_size=NORM_CONCURRENCY):
+    # keep-alive connections to the norm service, one per in-flight batch
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def build_norm_job(r):
+    return {
+        'title': r['title'],
+        'description': r['desc'],
+        'soc_hint': r.get('socCodeHint') or 'Undefined',
+        'organization': r['company'],
+        'city': r['city'] or '',
+        'state': r['state'] or '',
+        'edit_distance_threshold': settings.LOCATION_EDIT_DISTANCE,
+    }
+
+
+def build_norm_cache():
+    if NORM_CACHE_BACKEND == 'sqlite':
+        backend = SqliteNormCache(NORM_CACHE_PATH, NORM_CACHE_TTL, NORM_CACHE_MAX_ENTRIES)
+    elif NORM_CACHE_BACKEND == 'redis':
+        import redis
+        backend = RedisNormCache(redis.StrictRedis.from_url(NORM_CACHE_REDIS_URL), NORM_CACHE_TTL)
+    else:
+        return None
+    return NormCache(backend, build_version(NORM_FLAGS, NORM_CACHE_VERSION))
 
 
-# @timeperf
-def request_norm(jobs, batch_id):
+@timeperf('norm_round_trip')
+def request_norm(jobs, batch_id, session=None, norm_jobs=None):
     data = {
         'batch_id': batch_id,
-        'classify_job_level': True,
-        'classify_major': True,
-        'classify_education_degree': True,
-        'extract_benefits': True,
-        'extract_visa_status': True,
-        'extract_job_type': True,
-        'jobs': [{
-            'title': r['title'],
-            'description': r['desc'],
-            'soc_hint': r.get('socCodeHint') or 'Undefined',
-            'organization': r['company'],
-            'city': r['city'] or '',
-            'state': r['state'] or '',
-            'edit_distance_threshold': settings.LOCATION_EDIT_DISTANCE,
-        } for r in jobs],
+        'jobs': norm_jobs if norm_jobs is not None else [build_norm_job(r) for r in jobs],
     }
-    r = requests.post(settings.URL_NORM_JOB, json=data)
-    return r.status_code, r.json()
+    data.update(NORM_FLAGS)
+    post = session.post if session is not None else requests.post
+    r = post(settings.URL_NORM_JOB, json=data)
+    try:
+        return r.status_code, r.json()
+    except ValueError:
+        # e.g. an html error page, the status code still drives the retry
+        logger.warning('norm batch %s, status %s, body not json: %r' % (batch_id, r.status_code, r.text[:200]))
+        return r.status_code, {}
+
+
+class NormBatch(object):
+    """
+    jobs sent in one norm request, with their retry state
+    msgs are (job_id, job_data, feed_name, seq) tuples
+    """
+
+    def __init__(self, msgs, first_failure=None):
+        self.msgs = msgs
+        self.attempt = 0
+        self.first_failure = first_failure
+
+    def __len__(self):
+        return len(self.msgs)
+
+
+class NormPipeline(object):
+    """
+    Keeps up to `concurrency` norm batches in flight.
+
+    `request(batch)` runs in a thread pool, its results are handed to
+    `handle(batch, result)` by a single thread in submit order, so jobs are
+    produced in the same order as with one batch at a time.
+    `submit` blocks while `concurrency` batches are pending.
+    """
+
+    def __init__(self, request, handle, concurrency=NORM_CONCURRENCY):
+        self.request = request
+        self.handle = handle
+
+        self._executor = ThreadPoolExecutor(max_workers=concurrency)
+        self._slots = threading.BoundedSemaphore(concurrency)
+        self._pending = queue.Queue()
+
+        thread = threading.Thread(target=self._consume, name='norm-pipeline')
+        thread.daemon = True
+        thread.start()
+
+    def submit(self, batch):
+        self._slots.acquire()
+        future = self._executor.submit(self.request, batch)
+        self._pending.put((batch, future))
+
+    def is_idle(self):
+        return self._pending.unfinished_tasks == 0
+
+    def join(self):
+        """block until every submitted batch is handled"""
+        self._pending.join()
+
+    def _consume(self):
+        while True:
+            batch, future = self._pending.get()
+            try:
+                self.handle(batch, future.result())
+            except Exception as e:
+                logger.exception(e)
+            finally:
+                self._slots.release()
+                self._pending.task_done()
 
 
 class NormalizerWorker(BaseWorker):
 
     def __init__(self, PreTopic, NextTopic):
         super(NormalizerWorker, self).__init__(__name__, PreTopic, NextTopic)
-        self.processed = False
+        self.session = build_norm_session(NORM_CONCURRENCY)
+        self.cache = build_norm_cache()
+        self.pipeline = NormPipeline(self.request_batch, self.handle_batch, NORM_CONCURRENCY)
+        # failed batches wait here, the pipeline consumer must never block on a resubmit
+        self.retries = RetryQueue(self.pipeline.submit, RETRY_QUEUE_SIZE)
+        # registered before the batcher, so at exit it waits for the batch the batcher flushes
+        atexit.register(self.drain)
+        # jobs acked but not produced or discarded yet keep master waiting,
+        # batched, in flight or waiting for a retry alike
+        self.pending = PendingMarker(__name__)
+
+        self.batch_size = AdaptiveBatchSize(settings.NORM_BATCH_SIZE, NORM_BATCH_MIN_SIZE,
+                                            NORM_BATCH_MAX_SIZE, NORM_TARGET_LATENCY)
+        self.batcher = MicroBatcher(self.send_batch, self.batch_size.size, NORM_BATCH_MAX_LATENCY)
 
     def build_msg_key(self, job_id, seq, *args, **kwargs):
         return "%s-%s" % (job_id, str(seq))
 
     def process(self, job_id, job_data, feed_name, seq):
+        self.pending.add()
+        self.batcher.add((job_id, job_data, feed_name, seq))
 
-        _job_batch.append(job_data)
-        _job_ids.append(job_id)
-        _job_feeds.append(feed_name)
-        _job_seqs.append(seq)
+    def send_batch(self, msgs):
+        self.pipeline.submit(NormBatch(msgs))
 
-        job_number = len(_job_batch)
-        if job_number < settings.NORM_BATCH_SIZE:
-            self.processed = False
-            return
+    def flush(self):
+        """send the jobs left in the current batch and wait for all batches in flight"""
+        self.batcher.flush()
+        self.drain()
+
+    def drain(self):
+        """wait until no batch is in flight or waiting for a retry"""
+        while not (self.pipeline.is_idle() and self.retries.is_idle()):
+            self.pipeline.join()
+            self.retries.join()
+
+    def request_batch(self, batch):
+        """
+        runs in the pipeline thread pool, one attempt
+        returns (batch_id, status_code, rsp_json, latency)
+        only the jobs missing in the norm cache are sent to the service,
+        latency is None if none was
+        any error is returned as status None, so handle_batch retries the batch
+        """
+        try:
+            return self._request_batch(batch)
+        except Exception as e:
+            logger.exception(e)
+            return None, None, {}, None
 
-        self.processed = True
+    def _request_batch(self, batch):
+        norm_jobs = [build_norm_job(m[1]) for m in batch.msgs]
 
-        # batch full, send norm requests
+        # send norm requests
         batch_id = r_db.incr(settings.r_batch_num_key)
 
-        status_code, rsp_json = request_norm(_job_batch, batch_id)
+        keys = None
+        cached = {}
+        if self.cache is not None:
+            # the description is keyed by the descHash the cleaner computed
+            keys = self.cache.keys([dict(j, description=m[1].get('descHash') or j['description'])
+                                    for m, j in zip(batch.msgs, norm_jobs)])
+            cached = self.cache.get_many(keys)
+            if batch_id % LOG_INTERVAL == 0:
+                logger.info('norm cache hit rate: %.3f' % self.cache.hit_rate())
+        misses = [i for i in range(len(norm_jobs)) if keys is None or keys[i] not in cached]
+        if not misses:
+            # no latency, the batch size is only tuned from the service response
+            return batch_id, 200, {'normalized_jobs': [cached[k] for k in keys]}, None
+
+        start_time = time.time()
+        try:
+            status_code, rsp_json = request_norm(None, batch_id, self.session,
+                                                 [norm_jobs[i] for i in misses])
+        except Exception as e:
+            logger.exception(e)
+            status_code, rsp_json = None, {}
+        latency = time.time() - start_time
+
+        if self.cache is None:
+            return batch_id, status_code, rsp_json, latency
+
+        normalized_jobs = rsp_json.get('normalized_jobs', []) if status_code == 200 else None
+        if normalized_jobs is None or len(normalized_jobs) != len(misses):
+            # leave the error handling to handle_batch
+            return batch_id, status_code, {} if status_code == 200 else rsp_json, latency
+
+        self.cache.set_many({keys[i]: rsp for i, rsp in zip(misses, normalized_jobs)
+                             if 'error_code' not in rsp})
+        for i, rsp in zip(misses, normalized_jobs):
+            cached[keys[i]] = rsp
+        return batch_id, status_code, {'normalized_jobs': [cached[k] for k in keys]}, latency
+
+    def handle_batch(self, batch, result):
+        """
+        runs in the pipeline consumer thread, in submit order
+        a batch failing here, e.g. on a kafka error, is retried whole
+        """
+        try:
+            self._handle_batch(batch, result)
+        except Exception as e:
+            logger.exception(e)
+            self.retry(batch, result[0])
+
+    def _handle_batch(self, batch, result):
+        batch_id, status_code, rsp_json, latency = result
+        job_number = len(batch)
+        if latency is not None:
+            self.tune_batch_size(latency, status_code == 429)
 
         # handle status code: 429, non 200
-        retry_times = 10
-        for i in range(retry_times):
-            if status_code != 429:
-                break
-            logger.info("batch %d status code 429, retry" % batch_id)
-            status_code, rsp_json = request_norm(_job_batch, batch_id)
-        else:
-            logger.error('batch %d retried %d times, give up...' % (batch_id, retry_times))
-            for jobid, feed in zip(_job_ids, _job_feeds):
-                self.logger.debug('discarded - norm req failed - ' + json.dumps({"jobId": jobid, "feed": feed}))
+        if status_code != 200:
+            logger.info("batch %s status code %s, retry" % (batch_id, status_code))
+            if status_code in BISECT_STATUS_CODES:
+                # rejected request, most likely caused by some of the jobs
+                self.bisect(batch, batch_id, 'norm req failed')
+            elif status_code != 429 and status_code is not None and status_code < 500:
+                logger.error('batch %s rejected with status %s, give up...' % (batch_id, status_code))
+                self.discard(batch, 'norm req rejected')
+            elif status_code != 429 and batch.attempt + 1 >= RETRY_BISECT_AFTER:
+                self.bisect(batch, batch_id, 'norm req failed')
+            else:
+                self.retry(batch, batch_id)
             return
 
         # handle response length mismatch
         if len(rsp_json.get('normalized_jobs', [])) != job_number:
-            reports.incr_by(job_number, 'norm-error')
             logger.error('unexpected norm error. length_neq_sent_size. batch_id: %s' % (batch_id, ))
-            for jobid, feed in zip(_job_ids, _job_feeds):
-                self.logger.debug('discarded - norm resp invalid - ' + json.dumps({"jobId": jobid, "feed": feed}))
+            self.bisect(batch, batch_id, 'norm resp invalid')
             return
 
         # handle every single normed job
-        for job_id, norm_rsp, i_job_data, job_seq, job_feed in zip(_job_ids, rsp_json['normalized_jobs'], _job_batch, _job_seqs, _job_feeds):
+        for (job_id, i_job_data, job_feed, job_seq), norm_rsp in zip(batch.msgs, rsp_json['normalized_jobs']):
             if 'error_code' in norm_rsp:
                 reports.incr('norm-error')
                 self.logger.debug('discarded - norm failed - ' + json.dumps({"jobId": job_id, "feed": job_feed}))
@@ -138,12 +361,44 @@ class NormalizerWorker(BaseWorker):
                     'seq': job_seq,
                 }
                 self.produce_msg(**kwargs)
+        self.pending.done(job_number)
 
-    def post_process(self, *args, **kwargs):
-        if not self.processed:
+    def retry(self, batch, batch_id):
+        now = time.time()
+        if batch.first_failure is None:
+            batch.first_failure = now
+        delay = retry_delay(now - batch.first_failure, batch.attempt)
+        batch.attempt += 1
+
+        if delay is None:
+            logger.error('batch %s retried %d times, give up...' % (batch_id, batch.attempt))
+            self.discard(batch, 'norm req failed')
+        elif not self.retries.put(batch, delay):
+            logger.error('retry queue full, batch %s give up...' % batch_id)
+            self.discard(batch, 'norm req failed')
+
+    def bisect(self, batch, batch_id, reason):
+        """
+        retry both halves of a batch, so one bad job does not sink the others
+        a single failing job is discarded
+        """
+        if len(batch) == 1:
+            self.discard(batch, reason)
             return
 
-        del _job_batch[:]
-        del _job_ids[:]
-        del _job_seqs[:]
-        del _job_feeds[:]
+        mid = len(batch) // 2
+        first_failure = batch.first_failure or time.time()
+        logger.info('batch %s split in %s + %s' % (batch_id, mid, len(batch) - mid))
+        for msgs in (batch.msgs[:mid], batch.msgs[mid:]):
+            half = NormBatch(msgs, first_failure)
+            if not self.retries.put(half):
+                self.discard(half, reason)
+
+    def discard(self, batch, reason):
+        reports.incr_by(len(batch), 'norm-error')
+        for job_id, _, feed, _ in batch.msgs:
+            self.logger.debug('discarded - %s - ' % reason + json.dumps({"jobId": job_id, "feed": feed}))
+        self.pending.done(len(batch))
+
+    def tune_batch_size(self, latency, throttled):
+        self.batcher.max_size = self.batch_size.update(latency, throttled)
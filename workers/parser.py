@@ -1,14 +1,37 @@
+import io
 import os
+import re
 import time
+import zlib
+import multiprocessing
+from collections import deque
+from contextlib import closing
 from lxml import etree
 
 import settings
 
 from framework.base_worker import BaseWorker
+from downloader import DOWNLOAD_CHUNK_SIZE, DOWNLOAD_TIMEOUT, FeedDownloader, build_session
+from record_cleaner import get_fields
+from redis_access import TaskConstants
+from feed_schedule import record_feed_values, record_feed_time
+from perf import timed_iter
+from utils.exceptions import UnsupportedFeed
 
 
 LOG_INTERVAL = 10000
 
+GZIP_MAGIC = b'\x1f\x8b'
+
+# byte-range parallel parsing of large staged feeds, 0 or 1 disables it
+PARALLEL_PARSE_PROCESSES = getattr(settings, 'PARALLEL_PARSE_PROCESSES', 0)
+# only feeds larger than this are split
+PARALLEL_PARSE_MIN_SIZE = getattr(settings, 'PARALLEL_PARSE_MIN_SIZE', 256 * 1024 * 1024)
+# size of a byte range handed to one parse process
+PARALLEL_PARSE_CHUNK_SIZE = getattr(settings, 'PARALLEL_PARSE_CHUNK_SIZE', 64 * 1024 * 1024)
+
+SCAN_BLOCK_SIZE = 1024 * 1024
+
 
 DEFAULT_FEED_TAG = 'job'
 
@@ -38,6 +61,82 @@ def extract_data_common(elem):
     return {c.tag: c.text for c in elem.getchildren()}
 
 
+def _clarktag(tag, namespaces):
+    if ':' in tag:
+        prefix, local = tag.split(':', 1)
+        return '{%s}%s' % (namespaces[prefix], local)
+    return tag
+
+
+class FieldExtractor(object):
+    """
+    Flat record extractor compiled from a feed's field declaration.
+
+    Direct children are picked up in one pass over the record element,
+    attributes are read with `get` and deeper paths are precompiled XPath,
+    so no intermediate dict is built for the fields the feed ignores.
+    """
+
+    def __init__(self, fields, namespaces=None):
+        if not isinstance(fields, dict):
+            fields = {f: f for f in fields}
+        namespaces = namespaces or {}
+
+        self.keys = tuple(fields.keys())
+        self.children = {}
+        self.attrs = []
+        self.xpaths = []
+        for key, path in fields.items():
+            if path.startswith('@'):
+                self.attrs.append((key, path[1:]))
+            elif '/' not in path:
+                self.children[_clarktag(path, namespaces)] = key
+            else:
+                xpath = etree.XPath(path + '/text()', namespaces=namespaces, smart_strings=False)
+                self.xpaths.append((key, xpath))
+
+    def __call__(self, elem):
+        data = dict.fromkeys(self.keys)
+
+        children = self.children
+        if children:
+            for c in elem:
+                key = children.get(c.tag)
+                if key is not None:
+                    data[key] = c.text
+
+        for key, attr in self.attrs:
+            data[key] = elem.get(attr)
+
+        for key, xpath in self.xpaths:
+            texts = xpath(elem)
+            if texts:
+                data[key] = texts[0]
+        return data
+
+
+name2extractor = dict()
+
+
+def get_extract_meth(feed_name):
+    if feed_name in name2extractor:
+        return name2extractor[feed_name]
+
+    try:
+        fields, namespaces = get_fields(feed_name)
+    except UnsupportedFeed:
+        fields, namespaces = None, None
+
+    if fields:
+        extract_meth = FieldExtractor(fields, namespaces)
+    elif feed_name == 'DIRECT_EMPLOYERS':
+        extract_meth = extract_data_de
+    else:
+        extract_meth = extract_data_common
+    name2extractor[feed_name] = extract_meth
+    return extract_meth
+
+
 def get_feed_tag(feed_name):
     for feed in settings.JOB_SOURCES:
         if feed['name'].upper() == feed_name.upper():
@@ -46,47 +145,255 @@ def get_feed_tag(feed_name):
     return DEFAULT_FEED_TAG
 
 
+def _release(elem):
+    # free memory of parsed elements
+    elem.clear()
+    while elem.getprevious() is not None:
+        del elem.getparent()[0]
+
+
+def iter_file(filename, tag_name):
+    context = etree.iterparse(filename, events=('end',), tag=tag_name, recover=True)
+    for event, elem in context:
+        yield elem
+        _release(elem)
+    del context
+
+
+def iter_stream(chunks, tag_name):
+    """
+    incremental parsing of an iterable of bytes, elements are yielded
+    as soon as their end tag is fed. gzip payloads are inflated on the fly.
+    """
+    parser = etree.XMLPullParser(events=('end',), tag=tag_name, recover=True)
+    inflate = None
+    first = True
+
+    for chunk in chunks:
+        if not chunk:
+            continue
+        if first:
+            first = False
+            if chunk[:2] == GZIP_MAGIC:
+                inflate = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        if inflate is not None:
+            chunk = inflate.decompress(chunk)
+        parser.feed(chunk)
+        for event, elem in parser.read_events():
+            yield elem
+            _release(elem)
+
+    if inflate is not None:
+        parser.feed(inflate.flush())
+    parser.close()
+    for event, elem in parser.read_events():
+        yield elem
+        _release(elem)
+
+
+def _record_start_pattern(tag_name):
+    # start tag of a record, with any namespace prefix, right after the end of
+    # the previous markup so text inside descriptions is unlikely to match
+    local = re.escape(_plaintag(tag_name).encode('utf-8'))
+    return re.compile(br'>\s*(<(?:[\w.-]+:)?' + local + br'[\s/>])')
+
+
+def _find_record_start(f, offset, pattern):
+    """
+    position of the first record start tag at or after `offset`, None if none
+    """
+    # the match must begin with the '>' ending the previous markup, step back one byte
+    pos = max(offset - 1, 0)
+    overlap = b''
+    while True:
+        f.seek(pos)
+        block = f.read(SCAN_BLOCK_SIZE)
+        if not block:
+            return None
+        buf = overlap + block
+        m = pattern.search(buf)
+        if m:
+            return pos - len(overlap) + m.start(1)
+        # keep the tail in case the tag is cut by the block boundary
+        overlap = buf[-256:]
+        pos += len(block)
+
+
+def split_ranges(filename, tag_name, chunk_size=PARALLEL_PARSE_CHUNK_SIZE):
+    """
+    split a staged feed into byte ranges which start at record boundaries
+    returns (header_end, [(start, end), ...]), bytes before header_end hold
+    the xml declaration and the opening tags (with namespaces) of the root
+    """
+    size = os.path.getsize(filename)
+    pattern = _record_start_pattern(tag_name)
+    with open(filename, 'rb') as f:
+        header_end = _find_record_start(f, 0, pattern)
+        if header_end is None:
+            return 0, [(0, size)]
+
+        starts = [header_end]
+        offset = header_end + chunk_size
+        while offset < size:
+            start = _find_record_start(f, offset, pattern)
+            if start is None:
+                break
+            starts.append(start)
+            offset = start + chunk_size
+
+    ends = starts[1:] + [size]
+    ranges = list(zip(starts, ends))
+    ranges[0] = (0, ranges[0][1])
+    return header_end, ranges
+
+
+def _parse_range(args):
+    """
+    parse one byte range in a pool process, returns the records in file order
+    """
+    filename, feed_name, tag_name, header_end, start, end = args
+    with open(filename, 'rb') as f:
+        header = b''
+        if start > 0:
+            header = f.read(header_end)
+        f.seek(start)
+        data = header + f.read(end - start)
+
+    # closing tags of the root are missing except for the last range, recover handles it
+    context = etree.iterparse(io.BytesIO(data), events=('end',), tag=tag_name, recover=True)
+    extract_meth = get_extract_meth(feed_name)
+    records = []
+    for event, elem in context:
+        records.append(extract_meth(elem))
+        _release(elem)
+    del context
+    return records
+
+
+def iter_file_parallel(filename, feed_name, tag_name, processes=PARALLEL_PARSE_PROCESSES):
+    """
+    records of a staged feed parsed by a process pool, in file order
+    at most `processes` ranges are submitted ahead of the one being yielded,
+    so a slow range holds back a bounded number of parsed ones in memory
+    """
+    header_end, ranges = split_ranges(filename, tag_name)
+    tasks = deque((filename, feed_name, tag_name, header_end, start, end) for start, end in ranges)
+
+    n_processes = min(processes, len(tasks))
+    pool = multiprocessing.Pool(n_processes)
+    try:
+        pending = deque()
+        while tasks and len(pending) < n_processes:
+            pending.append(pool.apply_async(_parse_range, (tasks.popleft(),)))
+        # ranges are consumed in submit order so seq numbers are the same as a serial parse
+        while pending:
+            records = pending.popleft().get()
+            if tasks:
+                pending.append(pool.apply_async(_parse_range, (tasks.popleft(),)))
+            for record in records:
+                yield record
+            del records
+    finally:
+        pool.terminate()
+        pool.join()
+
+
 class ParserWorker(BaseWorker):
 
     def __init__(self, PreTopic, NextTopic):
         super(ParserWorker, self).__init__(__name__, PreTopic, NextTopic)
+        self._session = None
+        self._downloader = None
+        self.task_constants = TaskConstants()
 
-    def build_msg_key(self, order, feed_name, filename):
+    def build_msg_key(self, order, feed_name, filename, *args, **kwargs):
         return feed_name
 
-    def process(self, order, feed_name, filename):
+    def process(self, order, feed_name, filename, url=None):
+        tag_name = get_feed_tag(feed_name)
+
+        if url:
+            cnt, error = self.process_stream(order, feed_name, url, tag_name)
+            if error is None:
+                return
+            # records already produced are parsed again from the file, so the
+            # feed is complete downstream and clean_es keeps all of its jobs
+            self.logger.warning('stream parsing %s failed after %s records, parse it again from file' %
+                                (feed_name, cnt))
+            if self._downloader is None:
+                self._downloader = FeedDownloader(concurrency=1)
+            if not self._downloader.fetch(feed_name, url, filename):
+                if cnt:
+                    # never let a truncated feed pass for a complete one
+                    raise IOError('%s truncated after %s records: %s' % (feed_name, cnt, error))
+                return
+
         if not os.path.exists(filename):
             self.logger.error('file not exists: %s.' % filename)
             return
 
-        tag_name = get_feed_tag(feed_name)
-        start_time = time.time()
-
         self.logger.info('start parsing %2d-%s. tag=%s. MAX_JOBS_PER_FEED: %s' % (order, filename, tag_name, settings.MAX_JOBS_PER_FEED))
-
-        context = etree.iterparse(filename, events=('end',), tag=tag_name, recover=True)
-
-        extract_meth = extract_data_de if feed_name == 'DIRECT_EMPLOYERS' else extract_data_common
+        if PARALLEL_PARSE_PROCESSES > 1 and os.path.getsize(filename) >= PARALLEL_PARSE_MIN_SIZE:
+            self.logger.info('parsing %s with %s processes' % (feed_name, PARALLEL_PARSE_PROCESSES))
+            self.produce_records(feed_name, iter_file_parallel(filename, feed_name, tag_name))
+        else:
+            self.parse_elements(feed_name, iter_file(filename, tag_name))
+
+    def process_stream(self, order, feed_name, url, tag_name):
+        """
+        parse the feed while it is being downloaded
+        returns (records produced, None) once the whole feed is parsed, or
+        (records produced before the failure, exception)
+        """
+        if self._session is None:
+            self._session = build_session(1)
+
+        self.logger.info('start stream parsing %2d-%s. tag=%s. MAX_JOBS_PER_FEED: %s' % (order, url, tag_name, settings.MAX_JOBS_PER_FEED))
+        seen = [0]
+
+        def counted(elements):
+            for elem in elements:
+                seen[0] += 1
+                yield elem
+
+        try:
+            with closing(self._session.get(url, stream=True, timeout=DOWNLOAD_TIMEOUT)) as r:
+                r.raise_for_status()
+                chunks = r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE)
+                return self.parse_elements(feed_name, counted(iter_stream(chunks, tag_name))), None
+        except Exception as e:
+            self.logger.exception(e)
+            return seen[0], e
+
+    def parse_elements(self, feed_name, elements):
+        extract_meth = get_extract_meth(feed_name)
+        return self.produce_records(feed_name, (extract_meth(elem) for elem in elements))
+
+    def produce_records(self, feed_name, records):
+        start_time = time.time()
         cnt = 0
 
-        for event, elem in context:
+        # time to read and extract each record
+        for data in timed_iter('parse', records):
 
             cnt += 1
 
-            data = extract_meth(elem)
             self.produce_msg(record=data, feed_name=feed_name, seq=cnt)
 
-            elem.clear()
-            while elem.getprevious() is not None:
-                del elem.getparent()[0]
-
             if settings.MAX_JOBS_PER_FEED and cnt > settings.MAX_JOBS_PER_FEED:
                 break
 
             if cnt and cnt % LOG_INTERVAL == 0:
                 self.logger.info('%s parsed in %s' % (cnt, feed_name))
 
-        del context
-
         feed_timecost = time.time() - start_time
         self.logger.warning('%s jobs in %s, timecost: %s' % (cnt, feed_name, feed_timecost))
+
+        # feed history for the master scheduling
+        try:
+            process_seq = self.task_constants.get(settings.KEY_PROCESS_SEQ)
+            record_feed_values(process_seq, feed_name, records=cnt, finished=time.time())
+            record_feed_time(process_seq, feed_name, 'parse_time', feed_timecost)
+        except Exception as e:
+            self.logger.exception(e)
+        return cnt
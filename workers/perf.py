@@ -0,0 +1,259 @@
+import os
+import time
+import logging
+import threading
+from functools import wraps
+from contextlib import contextmanager
+
+from settings import r_db
+
+import settings
+
+
+logger = logging.getLogger(__name__)
+
+# initial state, switched at runtime through KEY_PERF_ENABLED
+PERF_ENABLED = getattr(settings, 'PERF_ENABLED', False)
+# seconds between two pushes of the local histograms to redis
+PERF_FLUSH_INTERVAL = getattr(settings, 'PERF_FLUSH_INTERVAL', 10)
+# seconds the runtime switch is cached by a worker
+PERF_SWITCH_TTL = getattr(settings, 'PERF_SWITCH_TTL', 30)
+
+# '1' / '0', read by every worker at most every PERF_SWITCH_TTL
+KEY_PERF_ENABLED = 'perf:enabled'
+# per task and stage histogram, {bucket: count, 'n': samples, 'sum': microseconds}
+KEY_PERF_STAGE = 'perf:%s:%s'
+# stages measured in a task
+KEY_PERF_STAGES = 'perf:%s:stages'
+PERF_TTL = 3 * 24 * 3600
+
+# bucket i holds durations in [2^(i-1), 2^i) microseconds
+N_BUCKETS = 40
+
+
+class _State(object):
+    enabled = PERF_ENABLED
+    # monotonic time the switch was last read
+    checked = None
+
+
+_state = _State()
+_lock = threading.Lock()
+# stage -> [bucket counts, samples, total microseconds]
+_local = {}
+_flusher = None
+
+
+def _read_switch(now):
+    _state.checked = now
+    try:
+        switch = r_db.get(KEY_PERF_ENABLED)
+    except Exception as e:
+        logger.exception(e)
+        return
+    if switch is not None:
+        _state.enabled = switch in (b'1', '1')
+
+
+def enabled():
+    """
+    the runtime switch, read from redis by the calling thread once its
+    cached value is PERF_SWITCH_TTL old, so no thread runs while disabled
+    """
+    now = time.monotonic()
+    if _state.checked is None or now - _state.checked > PERF_SWITCH_TTL:
+        _read_switch(now)
+    return _state.enabled
+
+
+def set_enabled(value):
+    """switch the instrumentation of every worker, through redis"""
+    r_db.set(KEY_PERF_ENABLED, '1' if value else '0')
+    _state.enabled = bool(value)
+    _state.checked = time.monotonic()
+
+
+def observe(stage, seconds, n=1):
+    """
+    `n` samples of `seconds` / n each, e.g. a batch of n records
+    the first sample recorded starts the flusher
+    """
+    if n <= 0 or not enabled():
+        return
+    us = int(seconds * 1e6 / n)
+    bucket = min(us.bit_length(), N_BUCKETS - 1)
+    with _lock:
+        hist = _local.get(stage)
+        if hist is None:
+            hist = _local[stage] = [[0] * N_BUCKETS, 0, 0]
+        hist[0][bucket] += n
+        hist[1] += n
+        hist[2] += us * n
+    if _flusher is None:
+        _start_flusher()
+
+
+@contextmanager
+def timed(stage, n=1):
+    if not enabled():
+        yield
+        return
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, time.perf_counter() - start_time, n)
+
+
+def timeperf(stage):
+    """
+    decorator recording the duration of every call into the `stage` histogram
+    """
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            if not enabled():
+                return f(*args, **kwargs)
+            start_time = time.perf_counter()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                observe(stage, time.perf_counter() - start_time)
+        return wrapper
+    return decorator
+
+
+def timed_iter(stage, iterable):
+    """
+    `iterable`, recording the time spent producing each item
+    """
+    if not enabled():
+        return iterable
+    return _timed_iter(stage, iterable)
+
+
+def _timed_iter(stage, iterable):
+    it = iter(iterable)
+    while True:
+        start_time = time.perf_counter()
+        try:
+            item = next(it)
+        except StopIteration:
+            return
+        observe(stage, time.perf_counter() - start_time)
+        yield item
+
+
+def _start_flusher():
+    global _flusher
+    with _lock:
+        if _flusher is not None:
+            return
+        _flusher = threading.Thread(target=_flush_loop, name='perf-flusher')
+        _flusher.daemon = True
+        _flusher.start()
+
+
+def _flush_loop():
+    global _flusher
+    while True:
+        time.sleep(PERF_FLUSH_INTERVAL)
+        try:
+            flush()
+        except Exception as e:
+            logger.exception(e)
+        # switched off and nothing left to push, the next sample starts it again
+        with _lock:
+            if not _state.enabled and not _local:
+                _flusher = None
+                return
+
+
+def flush():
+    """
+    add the local histograms to the ones of the current task in redis,
+    then pick up the runtime switch
+    """
+    global _local
+    with _lock:
+        local, _local = _local, {}
+
+    pipe = r_db.pipeline(transaction=False)
+    pipe.get(settings.KEY_PROCESS_SEQ)
+    pipe.get(KEY_PERF_ENABLED)
+    process_seq, switch = pipe.execute()
+    _state.checked = time.monotonic()
+    if switch is not None:
+        _state.enabled = switch in (b'1', '1')
+    if not local or not process_seq:
+        return
+    process_seq = process_seq.decode('utf-8') if isinstance(process_seq, bytes) else process_seq
+
+    pipe = r_db.pipeline(transaction=False)
+    for stage, (buckets, n, total) in local.items():
+        key = KEY_PERF_STAGE % (process_seq, stage)
+        for i, count in enumerate(buckets):
+            if count:
+                pipe.hincrby(key, i, count)
+        pipe.hincrby(key, 'n', n)
+        pipe.hincrby(key, 'sum', total)
+        pipe.expire(key, PERF_TTL)
+        pipe.sadd(KEY_PERF_STAGES % process_seq, stage)
+    pipe.expire(KEY_PERF_STAGES % process_seq, PERF_TTL)
+    pipe.execute()
+
+
+def _percentile(buckets, n, q):
+    # upper bound of the bucket holding the q-th sample, seconds
+    target = q * n
+    seen = 0
+    for i, count in enumerate(buckets):
+        seen += count
+        if seen >= target:
+            return (1 << i) / 1e6
+    return (1 << (len(buckets) - 1)) / 1e6
+
+
+def load_report(process_seq):
+    """
+    {stage: {n, mean, p50, p90, p99}} of task `process_seq`, all workers included
+    """
+    stages = sorted(s.decode('utf-8') if isinstance(s, bytes) else s
+                    for s in r_db.smembers(KEY_PERF_STAGES % process_seq))
+    pipe = r_db.pipeline(transaction=False)
+    for stage in stages:
+        pipe.hgetall(KEY_PERF_STAGE % (process_seq, stage))
+    report = {}
+    for stage, raw in zip(stages, pipe.execute()):
+        values = {(k.decode('utf-8') if isinstance(k, bytes) else k): int(v) for k, v in raw.items()}
+        n = values.pop('n', 0)
+        total = values.pop('sum', 0)
+        if not n:
+            continue
+        buckets = [values.get(str(i), 0) for i in range(N_BUCKETS)]
+        report[stage] = {
+            'n': n,
+            'mean': total / 1e6 / n,
+            'p50': _percentile(buckets, n, 0.5),
+            'p90': _percentile(buckets, n, 0.9),
+            'p99': _percentile(buckets, n, 0.99),
+        }
+    return report
+
+
+def log_report(process_seq, log=logger):
+    for stage, stats in sorted(load_report(process_seq).items()):
+        log.info('perf %s. n: %s, mean: %.6fs, p50 < %.6fs, p90 < %.6fs, p99 < %.6fs' %
+                 (stage, stats['n'], stats['mean'], stats['p50'], stats['p90'], stats['p99']))
+
+
+def _after_fork():
+    # threads do not survive a fork, e.g. parse pool processes start their own
+    global _flusher, _local, _lock
+    _flusher = None
+    _local = {}
+    _lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
@@ -0,0 +1,156 @@
+import os
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from downloader import (DOWNLOAD_CONCURRENCY, DOWNLOAD_CHUNK_SIZE, build_session, feed_filename,
+                        load_sidecar, _request, _sidecar_path)
+
+import settings
+
+
+logger = logging.getLogger(__name__)
+
+# revalidate and download changed feeds while master idles between tasks
+FEED_PREFETCH = getattr(settings, 'FEED_PREFETCH', False)
+# under XML_PATH, so staged files are renamed into place on the same filesystem
+FEED_STAGING_PATH = getattr(settings, 'FEED_STAGING_PATH', os.path.join(settings.XML_PATH, 'staging'))
+# no new feed download is started this many seconds before the idle window ends
+FEED_PREFETCH_MARGIN = getattr(settings, 'FEED_PREFETCH_MARGIN', 60)
+
+NOT_MODIFIED = 'not_modified'
+
+
+class FeedPrefetcher(object):
+    """
+    Downloads changed feeds into a staging directory ahead of the next task.
+
+    Every feed is revalidated against the validators of its live copy in
+    XML_PATH: unchanged feeds stay where they are, changed ones are
+    downloaded to FEED_STAGING_PATH. `swap_in` then renames the complete
+    staged files over the live ones when the next task starts.
+
+    `prefetch` returns at its deadline. Downloads still running then finish
+    in the background, their results are left out of the next `swap_in`.
+    """
+
+    def __init__(self, staging=FEED_STAGING_PATH, concurrency=DOWNLOAD_CONCURRENCY):
+        self.staging = staging
+        self.concurrency = concurrency
+        # feed name -> status of its last prefetch
+        self.results = {}
+        # feeds being downloaded, maybe by an earlier prefetch past its deadline
+        self._in_flight = set()
+        # bumped by swap_in, results of an earlier generation are dropped
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def prefetch(self, feeds, deadline):
+        """
+        revalidate / download `feeds`, none is started after `deadline`
+        returns {name: status} of the feeds handled by `deadline`
+        """
+        if not os.path.isdir(self.staging):
+            os.makedirs(self.staging, exist_ok=True)
+        session = build_session(self.concurrency)
+        start_time = time.time()
+        executor = ThreadPoolExecutor(self.concurrency)
+        futures = [executor.submit(self._prefetch_one, feed, session, deadline, self._generation)
+                   for feed in feeds]
+        _, not_done = wait(futures, timeout=max(0.0, deadline - time.time()))
+        for future in not_done:
+            future.cancel()
+        executor.shutdown(wait=False)
+        _close_when_done(futures, session)
+        if not_done:
+            logger.warning('prefetch deadline reached, %s feeds not done' % len(not_done))
+
+        with self._lock:
+            results = dict(self.results)
+        n_changed = sum(1 for status in results.values() if status != NOT_MODIFIED)
+        logger.info('prefetched %s feeds, %s changed, timecost: %.2fs' %
+                    (len(results), n_changed, time.time() - start_time))
+        return results
+
+    def _prefetch_one(self, feed, session, deadline, generation):
+        name, url = feed['name'], feed['url']
+        with self._lock:
+            if time.time() > deadline or name in self._in_flight:
+                return
+            self._in_flight.add(name)
+        try:
+            self._fetch(name, url, session, generation)
+        finally:
+            with self._lock:
+                self._in_flight.discard(name)
+
+    def _fetch(self, name, url, session, generation):
+        staged = feed_filename(name, self.staging)
+        live = feed_filename(name)
+        try:
+            if os.path.exists(staged) and load_sidecar(staged).get('url') == url:
+                # resume or revalidate an earlier staged download
+                size, status = _request(url, staged, session, DOWNLOAD_CHUNK_SIZE)
+                if status == NOT_MODIFIED:
+                    status = 'staged'
+            else:
+                size, status = _request(url, staged, session, DOWNLOAD_CHUNK_SIZE, validators_from=live)
+        except Exception as e:
+            # the downloader fetches it during the task
+            logger.warning('prefetch %s failed: %s' % (name, e))
+            return
+        with self._lock:
+            if generation == self._generation:
+                self.results[name] = status
+        logger.info('prefetch %s %s, %s bytes' % (name, status, size))
+
+    def swap_in(self):
+        """
+        rename the complete staged feeds over the live ones
+        returns the names of the feeds swapped in. Feeds found not modified
+        are left out, they may have changed since, so the downloader
+        revalidates them
+        """
+        with self._lock:
+            results, self.results = self.results, {}
+            self._generation += 1
+
+        current = set()
+        for name, status in results.items():
+            if status == NOT_MODIFIED:
+                continue
+            staged = feed_filename(name, self.staging)
+            if not load_sidecar(staged).get('complete'):
+                continue
+            live = feed_filename(name)
+            try:
+                # file first: a crash in between leaves old validators, which
+                # only cost a download, never a stale feed marked current
+                os.replace(staged, live)
+                os.replace(_sidecar_path(staged), _sidecar_path(live))
+            except OSError as e:
+                logger.warning('swap in %s failed: %s' % (name, e))
+                continue
+            current.add(name)
+        logger.info('swapped in %s prefetched feeds' % len(current))
+        return current
+
+
+def _close_when_done(futures, session):
+    """close `session` once every future is done or cancelled"""
+    if not futures:
+        session.close()
+        return
+    left = [len(futures)]
+    lock = threading.Lock()
+
+    def done(_):
+        with lock:
+            left[0] -= 1
+            last = not left[0]
+        if last:
+            session.close()
+
+    for future in futures:
+        future.add_done_callback(done)
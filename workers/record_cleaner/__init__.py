@@ -1,14 +1,16 @@
 import logging
 import importlib
 from utils.exceptions import UnsupportedFeed
+from .base_record_parser import desc_clean
 
 
 logger = logging.getLogger('workers.cleaner')
 
 name2module = dict()
+name2parser = dict()
 
 
-def parse_record(record, feed_name, cnt):
+def get_module(feed_name):
     if feed_name in name2module:
         module = name2module[feed_name]
     else:
@@ -22,5 +24,56 @@ def parse_record(record, feed_name, cnt):
 
     if module is None:
         raise UnsupportedFeed(feed_name)
-    else:
-        return module.Parser(record).run()
+    return module
+
+
+def get_fields(feed_name):
+    """
+    raw fields declared by the feed's Parser, (fields, namespaces)
+    fields is None if the feed needs every child of the record
+    """
+    parser_cls = get_module(feed_name).Parser
+    return parser_cls.fields, parser_cls.namespaces
+
+
+def get_parser(feed_name):
+    """
+    Parser instance of the feed, created once and reset for every record
+    """
+    if feed_name in name2parser:
+        return name2parser[feed_name]
+    parser = get_module(feed_name).Parser()
+    name2parser[feed_name] = parser
+    return parser
+
+
+def parse_record(record, feed_name, cnt):
+    parser = get_parser(feed_name)
+    parser.reset(record)
+    return parser.run()
+
+
+def parse_batch(records, feed_name):
+    """
+    clean a list of records of one feed
+    returns (errors, data), both aligned with records
+    """
+    parser = get_parser(feed_name)
+
+    if desc_clean.processes > 1:
+        # clean the descriptions of the whole batch in the pool first,
+        # build_desc then finds them in the cache
+        raws = []
+        for record in records:
+            parser.reset(record)
+            raws.append(parser.get_desc_raw())
+        desc_clean.clean_many(raws)
+
+    errors = []
+    data = []
+    for record in records:
+        parser.reset(record)
+        error, d = parser.run()
+        errors.append(error)
+        data.append(d)
+    return errors, data
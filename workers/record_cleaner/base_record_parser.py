@@ -1,11 +1,17 @@
 import settings
 
 from utils.text import build_desc_cleaner
+from .desc_cleaner import CachedDescCleaner
 
-desc_clean = build_desc_cleaner(settings.JOB_DESC_MAX_LEN,
+desc_clean = CachedDescCleaner(build_desc_cleaner,
+                               (settings.JOB_DESC_MAX_LEN,
                                 settings.FAST_MODE,
                                 settings.JOB_DESC_ALLOWED_TAGS,
-                                settings.JOB_DESC_ALLOWED_ATTRS)
+                                settings.JOB_DESC_ALLOWED_ATTRS),
+                               settings.JOB_DESC_MAX_LEN,
+                               maxsize=getattr(settings, 'DESC_CACHE_SIZE', 50000),
+                               processes=getattr(settings, 'DESC_CLEAN_PROCESSES', 0),
+                               fast_path=getattr(settings, 'DESC_FAST_PATH', True))
 
 
 class BaseParser(object):
@@ -13,6 +19,12 @@ class BaseParser(object):
     source_name = None
     desc_tag_name = 'description'
 
+    # raw fields the parser reads, extracted by the ParserWorker
+    # a tuple of child tags, or {key: path} with paths relative to the record
+    # element ('@attr' for attributes). None keeps every child of the record.
+    fields = None
+    namespaces = None
+
     target_attrs = (
         'source',
         'id',
@@ -39,13 +51,25 @@ class BaseParser(object):
         # 'state',
     )
 
-    def __init__(self, record):
-        self.orig_data = record
-        self.error = []
-
+    def __init__(self, record=None):
         if not self.source_name:
             raise "source_name field is required for a RecordParser."
 
+        # dispatch table of bound builders, resolved once per parser instance
+        # a builder of None means the value is copied from the raw record
+        self.builders = tuple(
+            (tag, getattr(self, 'build_%s' % tag, None)) for tag in self.target_attrs
+        )
+        self.reset(record)
+
+    def reset(self, record):
+        """
+        prepare the parser for a new record, so one instance serves a whole feed
+        subclasses with per-record state override it
+        """
+        self.orig_data = record if record is not None else {}
+        self.error = []
+
     def build_source(self):
         return self.source_name
 
@@ -64,10 +88,6 @@ class BaseParser(object):
     def build_postingDate(self):
         return self.orig_data.get('posted_at')
 
-    def build_value(self, tag):
-        meth = getattr(self, 'build_%s' % tag, None)  # slow here
-        return meth() if meth else self.orig_data.get(tag)
-
     def validate_data(self, data):
         for field in self.required_fields:
             if not data[field]:
@@ -81,7 +101,8 @@ class BaseParser(object):
         return True
 
     def run(self):
-        data = {t: self.build_value(t) for t in self.target_attrs}
+        get = self.orig_data.get
+        data = {t: meth() if meth else get(t) for t, meth in self.builders}
         self.validate_data(data)
         if self.error:
             return self.error, data
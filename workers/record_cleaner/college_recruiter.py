@@ -4,6 +4,10 @@ from .base_record_parser import BaseParser
 class Parser(BaseParser):
     source_name = 'CR'
     desc_tag_name = 'body'
+    fields = (
+        'job_reference', 'title', 'body', 'company', 'city', 'state', 'zip',
+        'posted_at', 'url', 'category',
+    )
 
     def build_id(self):
         return self.orig_data.get('job_reference')
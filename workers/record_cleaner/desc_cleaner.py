@@ -0,0 +1,169 @@
+import time
+import logging
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+from record_fingerprint import text_hash
+from perf import observe
+
+
+logger = logging.getLogger('workers.cleaner')
+
+LOG_INTERVAL = 100000
+
+# characters the html cleaner may rewrite, a description without any of them
+# and within the max length is returned unchanged
+MARKUP_CHARS = ('<', '>', '&', '\r', '\x00')
+# plain descriptions still cleaned to check the fast path returns the same,
+# the fast path is turned off at the first difference
+FAST_PATH_VERIFY = 1000
+
+_pool_clean = None
+
+
+def _init_pool(factory, args):
+    global _pool_clean
+    _pool_clean = factory(*args)
+
+
+def _clean_in_pool(raw):
+    return _pool_clean(raw)
+
+
+def _digest(raw):
+    return text_hash(raw)
+
+
+class CachedDescCleaner(object):
+    """
+    Description cleaner with a content-hash keyed LRU cache in front of it.
+
+    `factory(*args)` builds the wrapped cleaner, e.g. build_desc_cleaner.
+    With `fast_path`, plain text descriptions skip the cleaner, once the first
+    `verify` of them came out of the cleaner unchanged. With `processes` > 1,
+    `clean_many` cleans the cache misses of a batch in a process pool, started
+    on first use.
+    """
+
+    def __init__(self, factory, args, max_len, maxsize=50000, processes=0, fast_path=True,
+                 verify=FAST_PATH_VERIFY):
+        self.factory = factory
+        self.args = args
+        self.clean = factory(*args)
+        self.max_len = max_len
+        self.maxsize = maxsize
+        self.fast_path = fast_path
+        self.verify = verify
+        self.processes = processes
+
+        self._cache = OrderedDict()
+        self._pool = None
+
+        self.calls = 0
+        self.hits = 0
+        self.fast = 0
+        self.clean_time = 0.0
+        self.cleaned = 0
+
+    def is_plain(self, raw):
+        if not self.fast_path or len(raw) > self.max_len:
+            return False
+        for c in MARKUP_CHARS:
+            if c in raw:
+                return False
+        return True
+
+    def __call__(self, raw):
+        self.calls += 1
+        if self.calls % LOG_INTERVAL == 0:
+            self.log_stats()
+
+        if self.is_plain(raw):
+            if self.verify > 0:
+                return self._verify_plain(raw)
+            self.fast += 1
+            return raw
+
+        key = _digest(raw)
+        cache = self._cache
+        if key in cache:
+            self.hits += 1
+            cache.move_to_end(key)
+            return cache[key]
+
+        start_time = time.time()
+        desc = self.clean(raw)
+        timecost = time.time() - start_time
+        self.clean_time += timecost
+        observe('desc_clean', timecost)
+        self.cleaned += 1
+        self._put(key, desc)
+        return desc
+
+    def _verify_plain(self, raw):
+        self.verify -= 1
+        desc = self.clean(raw)
+        if desc != raw:
+            self.fast_path = False
+            self.verify = 0
+            logger.warning('desc fast path off, the cleaner rewrote a plain description: %r -> %r' %
+                           (raw[:200], desc[:200]))
+        return desc
+
+    def _get_pool(self):
+        if self._pool is None and self.processes > 1:
+            self._pool = ProcessPoolExecutor(self.processes, initializer=_init_pool,
+                                             initargs=(self.factory, self.args))
+        return self._pool
+
+    def clean_many(self, raws):
+        """
+        warm the cache with a batch of descriptions
+        misses are cleaned in the process pool if there is one
+        """
+        pool = self._get_pool()
+        if pool is None:
+            return
+
+        misses = {}
+        for raw in raws:
+            if raw and not self.is_plain(raw):
+                key = _digest(raw)
+                if key not in self._cache:
+                    misses[key] = raw
+        if not misses:
+            return
+
+        start_time = time.time()
+        keys = list(misses.keys())
+        chunksize = max(1, len(keys) // 64)
+        for key, desc in zip(keys, pool.map(_clean_in_pool, [misses[k] for k in keys], chunksize=chunksize)):
+            self._put(key, desc)
+        timecost = time.time() - start_time
+        self.clean_time += timecost
+        self.cleaned += len(keys)
+        observe('desc_clean', timecost, len(keys))
+
+    def _put(self, key, desc):
+        cache = self._cache
+        cache[key] = desc
+        if len(cache) > self.maxsize:
+            cache.popitem(last=False)
+
+    def stats(self):
+        avg = self.clean_time / self.cleaned if self.cleaned else 0.0
+        return {
+            'calls': self.calls,
+            'hits': self.hits,
+            'fast': self.fast,
+            'hit_rate': float(self.hits + self.fast) / self.calls if self.calls else 0.0,
+            'size': len(self._cache),
+            'clean_time': self.clean_time,
+            'saved_time': (self.hits + self.fast) * avg,
+        }
+
+    def log_stats(self):
+        stats = self.stats()
+        logger.info('desc cache. calls: %(calls)s, hits: %(hits)s, fast: %(fast)s, '
+                    'hit rate: %(hit_rate).3f, size: %(size)s, '
+                    'clean time: %(clean_time).1fs, saved time: %(saved_time).1fs' % stats)
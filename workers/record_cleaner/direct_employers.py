@@ -5,18 +5,6 @@ from .base_record_parser import BaseParser
 import settings
 
 
-def getin(path, d):
-    path = path[::-1]
-
-    while len(path) != 0:
-        k = path.pop()
-        if not isinstance(d, dict):
-            return None
-        d = d.get(k)
-
-    return d
-
-
 def parse_location(location):
     city = None
     state = None
@@ -39,20 +27,38 @@ def parse_location(location):
 
 class Parser(BaseParser):
     source_name = 'DE'
+    desc_tag_name = 'desc'
     _city_state = None
 
+    namespaces = {
+        'hr': 'http://www.hr-xml.org/3',
+        'oa': 'http://www.openapplications.org/oagis/9',
+    }
+    fields = {
+        'id': 'hr:AlternateDocumentID',
+        'title': 'hr:PositionProfile/hr:PositionTitle',
+        'company': 'hr:PositionProfile/hr:PositionOrganization/hr:OrganizationIdentifiers/hr:OrganizationName',
+        'location': 'hr:PositionProfile/hr:PositionLocation/hr:LocationName',
+        'country': 'hr:PositionProfile/hr:PositionLocation/hr:ReferenceLocation/hr:CountryCode',
+        'zipcode': 'hr:PositionProfile/hr:PositionLocation/hr:ReferenceLocation/oa:PostalCode',
+        'desc': 'hr:PositionProfile/hr:PositionFormattedDescription/hr:Content',
+        'industry': 'hr:PositionProfile/hr:JobCategoryCode',
+        'url': 'hr:PositionProfile/hr:PostingInstruction/hr:ApplicationMethod/hr:Communication/oa:URI',
+        'attr_validFrom': '@validFrom',
+    }
+
     def build_id(self):
-        return self.orig_data.get('{http://www.hr-xml.org/3}AlternateDocumentID') or ''
+        return self.orig_data.get('id') or ''
 
     def build_title(self):
-        return getin(['{http://www.hr-xml.org/3}PositionProfile',
-                      '{http://www.hr-xml.org/3}PositionTitle'], self.orig_data) or ''
+        return self.orig_data.get('title') or ''
 
     def build_company(self):
-        return getin(['{http://www.hr-xml.org/3}PositionProfile',
-                      '{http://www.hr-xml.org/3}PositionOrganization',
-                      '{http://www.hr-xml.org/3}OrganizationIdentifiers',
-                      '{http://www.hr-xml.org/3}OrganizationName'], self.orig_data)
+        return self.orig_data.get('company')
+
+    def reset(self, record):
+        super(Parser, self).reset(record)
+        self._city_state = None
 
     def _get_city_state(self, location):
         if not self._city_state:
@@ -60,54 +66,33 @@ class Parser(BaseParser):
         return self._city_state
 
     def build_city(self):
-        names = getin(['{http://www.hr-xml.org/3}PositionProfile',
-                       '{http://www.hr-xml.org/3}PositionLocation',
-                       '{http://www.hr-xml.org/3}LocationName'], self.orig_data)
+        names = self.orig_data.get('location')
         city = None
         if names:
             (city, state) = self._get_city_state(names)
         return city
 
     def build_state(self):
-        names = getin(['{http://www.hr-xml.org/3}PositionProfile',
-                       '{http://www.hr-xml.org/3}PositionLocation',
-                       '{http://www.hr-xml.org/3}LocationName'], self.orig_data)
+        names = self.orig_data.get('location')
         state = None
         if names:
             (city, state) = self._get_city_state(names)
         return state
 
     def build_country(self):
-        return getin(['{http://www.hr-xml.org/3}PositionProfile',
-                      '{http://www.hr-xml.org/3}PositionLocation',
-                      '{http://www.hr-xml.org/3}ReferenceLocation',
-                      '{http://www.hr-xml.org/3}CountryCode'], self.orig_data) or 'USA'
+        return self.orig_data.get('country') or 'USA'
 
     def build_zipcode(self):
-        return getin(['{http://www.hr-xml.org/3}PositionProfile',
-                      '{http://www.hr-xml.org/3}PositionLocation',
-                      '{http://www.hr-xml.org/3}ReferenceLocation',
-                      '{http://www.openapplications.org/oagis/9}PostalCode'], self.orig_data) or '';
-
-    def get_desc_raw(self):
-        return (getin([
-            '{http://www.hr-xml.org/3}PositionProfile',
-            '{http://www.hr-xml.org/3}PositionFormattedDescription',
-            '{http://www.hr-xml.org/3}Content'], self.orig_data) or '')
+        return self.orig_data.get('zipcode') or ''
 
     def build_industry(self):
-        return [getin(['{http://www.hr-xml.org/3}PositionProfile',
-                      '{http://www.hr-xml.org/3}JobCategoryCode'], self.orig_data) or '']
+        return [self.orig_data.get('industry') or '']
 
     def build_postingDate(self):
         return self.orig_data.get('attr_validFrom', None) or time.time()
 
     def build_url(self):
-        return getin(['{http://www.hr-xml.org/3}PositionProfile',
-                      '{http://www.hr-xml.org/3}PostingInstruction',
-                      '{http://www.hr-xml.org/3}ApplicationMethod',
-                      '{http://www.hr-xml.org/3}Communication',
-                      '{http://www.openapplications.org/oagis/9}URI'], self.orig_data) or ''
+        return self.orig_data.get('url') or ''
 
     def build_price(self):
         return 'PAY_SCALE_7'
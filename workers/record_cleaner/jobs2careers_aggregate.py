@@ -4,6 +4,10 @@ from .base_record_parser import BaseParser
 class Parser(BaseParser):
     source_name = 'J2C_AGG'
     desc_tag_name = 'description'
+    fields = (
+        'referencenumber', 'title', 'description', 'company', 'city', 'state', 'zip',
+        'date', 'url', 'industry0',
+    )
 
     def build_id(self):
         return self.orig_data.get('referencenumber')
@@ -4,9 +4,13 @@ from .base_record_parser import BaseParser
 class Parser(BaseParser):
     source_name = 'JJ'
     desc_tag_name = 'description'
+    fields = (
+        'id', 'title', 'description', 'employer', 'location', 'postingdate', 'joburl',
+        'category',
+    )
 
-    def __init__(self, record):
-        super(Parser, self).__init__(record)
+    def reset(self, record):
+        super(Parser, self).reset(record)
 
         self.city, self.state = '', ''
         locations = (self.orig_data.get('location') or '').split(',')
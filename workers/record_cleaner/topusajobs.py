@@ -6,6 +6,10 @@ from .base_record_parser import BaseParser
 class Parser(BaseParser):
     source_name = 'TUJ'
     desc_tag_name = 'JobDescription'
+    fields = (
+        'JobID', 'JobTitle', 'JobDescription', 'JobCompany', 'JobCity', 'JobState',
+        'JobZip', 'JobUrl', 'JobCategory',
+    )
 
     def build_id(self):
         return self.orig_data.get('JobID')
@@ -0,0 +1,43 @@
+import hashlib
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+
+def fast_hash(data):
+    """
+    64 bit non-cryptographic hash of bytes, hex encoded
+    only for content addressing where a rare collision is acceptable
+    """
+    if xxhash is not None:
+        return xxhash.xxh64(data).hexdigest()
+    return hashlib.blake2b(data, digest_size=8).hexdigest()
+
+
+def text_hash(text):
+    return fast_hash(text.encode('utf-8'))
+
+
+def fingerprint_record(data, build_listing_hash):
+    """
+    per-record hashes computed once in the cleaner and attached to the record
+    * descHash: fast hash of the cleaned description, the only pass over it,
+      later stages hash it instead of the full description
+    * listingHash: built by dup_detect from the title, company, city, state
+      and the descHash
+    """
+    if "descHash" not in data:
+        data["descHash"] = text_hash(data.get("desc") or '')
+    # using 'undefined' to be compatible with the origin js version
+    undefined = "undefined"
+    if "listingHash" not in data:
+        data["listingHash"] = build_listing_hash(
+            data.get("title", None) or undefined,
+            data.get("company", None) or undefined,
+            data.get("city", None) or undefined,
+            data.get("state", None) or undefined,
+            data["descHash"] if data.get("desc") else undefined,
+        )
+    return data
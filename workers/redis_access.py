@@ -0,0 +1,170 @@
+import os
+import time
+import socket
+import logging
+import threading
+
+from settings import r_db
+
+
+logger = logging.getLogger(__name__)
+
+# master publishes here when it rewrites task constant keys, e.g. KEY_PROCESS_SEQ
+CHANNEL_TASK_CHANGED = 'task:changed'
+# master publishes here once every topic is drained, batching workers then
+# write what they hold instead of waiting for their batch deadline
+CHANNEL_FLUSH = 'task:flush'
+# safety net if an invalidation message is lost, seconds
+TASK_CONSTANT_TTL = 60
+
+# workers holding acked messages not handed downstream yet, {worker: last refresh time}
+KEY_PENDING_WORKERS = 'pending:workers'
+# seconds between two refreshes of a held mark
+PENDING_REFRESH_INTERVAL = 30
+# a mark not refreshed for this long is left by a dead worker, seconds
+PENDING_STALE_TIME = 300
+
+
+def publish_task_changed():
+    r_db.publish(CHANNEL_TASK_CHANGED, time.time())
+
+
+def publish_flush():
+    r_db.publish(CHANNEL_FLUSH, time.time())
+
+
+def on_flush(callback):
+    """
+    call `callback()` from a daemon thread whenever master publishes on CHANNEL_FLUSH
+    """
+    def listen():
+        while True:
+            try:
+                pubsub = r_db.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(CHANNEL_FLUSH)
+                for msg in pubsub.listen():
+                    if msg.get('type') == 'message':
+                        try:
+                            callback()
+                        except Exception as e:
+                            logger.exception(e)
+            except Exception as e:
+                logger.exception(e)
+                time.sleep(1)
+
+    thread = threading.Thread(target=listen, name='flush-listener')
+    thread.daemon = True
+    thread.start()
+
+
+class TaskConstants(object):
+    """
+    Local cache of redis keys which are constant during a task.
+
+    Values are read once and kept until master publishes on
+    CHANNEL_TASK_CHANGED, or `ttl` seconds passed.
+    """
+
+    def __init__(self, ttl=TASK_CONSTANT_TTL):
+        self.ttl = ttl
+        self._values = {}
+        self._lock = threading.Lock()
+
+        thread = threading.Thread(target=self._listen, name='task-constants')
+        thread.daemon = True
+        thread.start()
+
+    def get(self, key):
+        now = time.time()
+        cached = self._values.get(key)
+        if cached is not None and now - cached[1] < self.ttl:
+            return cached[0]
+
+        value = r_db.get(key)
+        with self._lock:
+            self._values[key] = (value, now)
+        return value
+
+    def invalidate(self):
+        with self._lock:
+            self._values.clear()
+
+    def _listen(self):
+        while True:
+            try:
+                pubsub = r_db.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(CHANNEL_TASK_CHANGED)
+                # drop whatever was read before the subscription was active
+                self.invalidate()
+                for msg in pubsub.listen():
+                    if msg.get('type') == 'message':
+                        logger.info('task changed, invalidate task constants')
+                        self.invalidate()
+            except Exception as e:
+                logger.exception(e)
+                self.invalidate()
+                time.sleep(1)
+
+
+class PendingMarker(object):
+    """
+    Counts the messages a worker acked but did not produce downstream yet.
+
+    While the count is not 0 the worker is listed in KEY_PENDING_WORKERS and
+    master does not consider the task finished. Redis is only written when
+    the count leaves or reaches 0, and every PENDING_REFRESH_INTERVAL while
+    it is held, so a crashed worker is ignored after PENDING_STALE_TIME.
+    """
+
+    def __init__(self, name):
+        self.field = '%s:%s:%s' % (name, socket.gethostname(), os.getpid())
+        self._count = 0
+        self._lock = threading.Lock()
+        self._held = threading.Event()
+
+        thread = threading.Thread(target=self._refresh, name='pending-marker')
+        thread.daemon = True
+        thread.start()
+
+    def __len__(self):
+        return self._count
+
+    def add(self, n=1):
+        with self._lock:
+            if not self._count:
+                r_db.hset(KEY_PENDING_WORKERS, self.field, time.time())
+                self._held.set()
+            self._count += n
+
+    def done(self, n=1):
+        with self._lock:
+            self._count = max(0, self._count - n)
+            if not self._count:
+                self._held.clear()
+                r_db.hdel(KEY_PENDING_WORKERS, self.field)
+
+    def _refresh(self):
+        while True:
+            self._held.wait()
+            time.sleep(PENDING_REFRESH_INTERVAL)
+            try:
+                with self._lock:
+                    if self._count:
+                        r_db.hset(KEY_PENDING_WORKERS, self.field, time.time())
+            except Exception as e:
+                logger.exception(e)
+
+
+def pending_workers(now=None):
+    """
+    workers holding messages they acked but did not produce downstream yet
+    """
+    now = time.time() if now is None else now
+    workers = []
+    for field, refreshed in r_db.hgetall(KEY_PENDING_WORKERS).items():
+        field = field.decode('utf-8') if isinstance(field, bytes) else field
+        if now - float(refreshed) < PENDING_STALE_TIME:
+            workers.append(field)
+        else:
+            logger.warning('pending mark of %s is stale, ignored' % field)
+    return sorted(workers)
@@ -0,0 +1,225 @@
+import os
+import glob
+import json
+import mmap
+import stat
+import fcntl
+import struct
+import bisect
+import hashlib
+import logging
+
+from mongo_enrich import lookup_key, snapshot_table
+
+import settings
+
+
+logger = logging.getLogger(__name__)
+
+# build the reference tables of the filler once per task and host, and map
+# them read-only in every filler. the cleaner state (desc_clean, name2module)
+# is code and compiled regexes, not table data, it stays per process
+REF_SNAPSHOT_ENABLED = getattr(settings, 'REF_SNAPSHOT_ENABLED', False)
+# must be private to the workers user, snapshots are not read from a shared dir
+REF_SNAPSHOT_DIR = getattr(settings, 'REF_SNAPSHOT_DIR',
+                           os.path.join(os.path.expanduser('~'), '.cache', 'ref_snapshots'))
+
+SNAPSHOT_MAGIC = b'RSN2'
+# magic, number of tables
+HEADER = struct.Struct('<4sI')
+# name, entries, hashes offset, entry offsets offset, blob offset
+TABLE_ENTRY = struct.Struct('<32sQQQQ')
+
+DOCS_CHUNK_SIZE = 10000
+
+
+def key_hash(value):
+    """
+    stable 64 bit hash of a table key, the same in every process
+    """
+    raw = value if isinstance(value, bytes) else str(value).encode('utf-8')
+    return int.from_bytes(hashlib.blake2b(raw, digest_size=8).digest(), 'little')
+
+
+def _align(f):
+    pad = -f.tell() % 8
+    if pad:
+        f.write(b'\0' * pad)
+    return f.tell()
+
+
+def _pack_table(f, table):
+    """
+    write one table, (entries, hashes offset, entry offsets offset, blob offset)
+    """
+    is_map = isinstance(table, dict)
+    keys = sorted(table, key=key_hash)
+    hashes = [key_hash(key) for key in keys]
+    # a set entry is [key], a mapping entry [key, value], the key is kept
+    # to tell colliding hashes apart
+    entries = [json.dumps([key, table[key]] if is_map else [key], sort_keys=True).encode('utf-8')
+               for key in keys]
+    offsets = [0]
+    for entry in entries:
+        offsets.append(offsets[-1] + len(entry))
+
+    hashes_offset = _align(f)
+    f.write(struct.pack('<%dQ' % len(hashes), *hashes))
+    offsets_offset = _align(f)
+    f.write(struct.pack('<%dQ' % len(offsets), *offsets))
+    blob_offset = f.tell()
+    f.write(b''.join(entries))
+    return len(keys), hashes_offset, offsets_offset, blob_offset
+
+
+def build_snapshot(path, tables):
+    """
+    write `tables` to `path`, {name: set of keys or {key: json value}}
+
+    every table is a sorted array of 64 bit key hashes and an offset index
+    into a blob of json encoded entries. Written then renamed, readers never
+    see a partial snapshot.
+    """
+    names = sorted(tables)
+    with open(path + '.tmp', 'wb') as f:
+        f.write(HEADER.pack(SNAPSHOT_MAGIC, len(names)))
+        dir_offset = f.tell()
+        f.write(b'\0' * TABLE_ENTRY.size * len(names))
+        entries = [TABLE_ENTRY.pack(name.encode('utf-8')[:32], *_pack_table(f, tables[name])) for name in names]
+        f.seek(dir_offset)
+        f.write(b''.join(entries))
+    os.rename(path + '.tmp', path)
+
+
+class RefSnapshot(object):
+    """
+    Read-only, memory-mapped view of a snapshot written by build_snapshot.
+
+    Lookups binary search the mapped hash arrays in place and decode only
+    the matching entry, the tables are never loaded into the process, so
+    every filler on a host shares the same pages.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._mmap)
+
+        magic, n_tables = HEADER.unpack_from(self._mmap, 0)
+        if magic != SNAPSHOT_MAGIC:
+            raise ValueError('%s is not a reference snapshot' % path)
+        self.tables = {}
+        for i in range(n_tables):
+            name, count, hashes_offset, offsets_offset, blob_offset = \
+                TABLE_ENTRY.unpack_from(self._mmap, HEADER.size + i * TABLE_ENTRY.size)
+            hashes = self._view[hashes_offset:hashes_offset + count * 8].cast('Q')
+            offsets = self._view[offsets_offset:offsets_offset + (count + 1) * 8].cast('Q')
+            self.tables[name.rstrip(b'\0').decode('utf-8')] = (hashes, offsets, blob_offset)
+
+    def _find(self, table, key):
+        """
+        the decoded entry of `key` in `table`, None if it has none
+        """
+        hashes, offsets, blob_offset = self.tables[table]
+        h = key_hash(key)
+        i = bisect.bisect_left(hashes, h)
+        while i < len(hashes) and hashes[i] == h:
+            entry = json.loads(self._mmap[blob_offset + offsets[i]:blob_offset + offsets[i + 1]].decode('utf-8'))
+            if entry[0] == key:
+                return entry
+            i += 1
+        return None
+
+    def contains(self, table, value):
+        """
+        whether `value` is a key of `table`, None if the table is not in the snapshot
+        """
+        if table not in self.tables:
+            return None
+        return self._find(table, value) is not None
+
+    def get(self, table, key, default=None):
+        """
+        the value of `key` in the mapping `table`
+        """
+        if table not in self.tables:
+            return default
+        entry = self._find(table, key)
+        if entry is None or len(entry) < 2:
+            return default
+        return entry[1]
+
+    def close(self):
+        for hashes, offsets, _ in self.tables.values():
+            hashes.release()
+            offsets.release()
+        self.tables = {}
+        self._view.release()
+        self._mmap.close()
+
+
+def load_reference_tables(db, validate_specs, fill_specs):
+    """
+    the reference tables of the filler, read from mongo
+    * one set of known values per validated field, named after the collection
+    * one {key: projected document} mapping per fill spec, see snapshot_table
+    """
+    tables = {}
+    for _, collection, field in validate_specs:
+        cursor = db[collection].find({}, {field: 1, '_id': 0}, batch_size=DOCS_CHUNK_SIZE)
+        tables[collection] = {doc[field] for doc in cursor if lookup_key(doc.get(field)) is not None}
+    for spec in fill_specs:
+        projection = dict.fromkeys(spec['fill'], 1)
+        projection[spec['field']] = 1
+        projection['_id'] = 0
+        mapping = {}
+        for doc in db[spec['collection']].find({}, projection, batch_size=DOCS_CHUNK_SIZE):
+            if lookup_key(doc.get(spec['field'])) is not None:
+                mapping.setdefault(doc[spec['field']], doc)
+        tables[snapshot_table(spec)] = mapping
+    return tables
+
+
+def private_dir(directory=REF_SNAPSHOT_DIR):
+    """
+    `directory`, created 0700 if missing. Refused unless it is a directory
+    of the current user that nobody else can write to or read from
+    """
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    st = os.lstat(directory)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0o077:
+        raise PermissionError('reference snapshot dir %s must be a 0700 directory of uid %s' %
+                              (directory, os.getuid()))
+    return directory
+
+
+def snapshot_path(process_seq, directory=REF_SNAPSHOT_DIR):
+    return os.path.join(directory, 'ref-%s.snap' % process_seq)
+
+
+def open_task_snapshot(process_seq, load_tables, directory=REF_SNAPSHOT_DIR):
+    """
+    the snapshot of task `process_seq`, built by the first process of the host
+    to ask for it while the others wait on the lock, then opened by all
+
+    `load_tables()` returns the tables to build it from. Snapshots of other
+    tasks are removed once the new one is written. Meant for a background
+    thread, never for the message path
+    """
+    directory = private_dir(directory)
+    path = snapshot_path(process_seq, directory)
+    if not os.path.exists(path):
+        with open(os.path.join(directory, '.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                if not os.path.exists(path):
+                    logger.info('build reference snapshot %s' % path)
+                    build_snapshot(path, load_tables())
+                    for old in glob.glob(os.path.join(directory, 'ref-*.snap')):
+                        if old != path:
+                            # processes still mapping it keep their pages
+                            os.remove(old)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+    return RefSnapshot(path)
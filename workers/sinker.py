@@ -1,13 +1,46 @@
 from elasticsearch_dsl.connections import connections
-from elasticsearch.helpers import bulk
+from elasticsearch.helpers import parallel_bulk, streaming_bulk
 
 from framework.base_worker import BaseWorker
+from framework import reports
 from models.joblisting import JobPosting
+from batching import MicroBatcher
+from perf import timeperf
+from redis_access import PendingMarker, on_flush
+from doc_fingerprint import (ES_SKIP_UNCHANGED, FINGERPRINT_FIELD, INTERNAL_FIELDS,
+                             build_meta, fingerprint, find_unchanged, mark_seen)
 
 import settings
 
 
-_jobs_es_batch = []
+# a partial batch is written once its oldest document waited this long (seconds)
+ES_BATCH_MAX_LATENCY = getattr(settings, 'ES_BATCH_MAX_LATENCY', 5.0)
+# approximate bytes of document source per bulk request
+ES_BATCH_MAX_BYTES = getattr(settings, 'ES_BATCH_MAX_BYTES', 10 * 1024 * 1024)
+# parallel_bulk threads, 1 uses streaming_bulk
+ES_BULK_THREADS = getattr(settings, 'ES_BULK_THREADS', 4)
+# documents per bulk request inside a batch
+ES_BULK_CHUNK_SIZE = getattr(settings, 'ES_BULK_CHUNK_SIZE', 500)
+
+# failed items logged per batch
+MAX_LOGGED_ERRORS = 5
+
+
+def build_action(job_id, job_data):
+    """
+    bulk action of a job, serialized by JobPosting as the documents always were
+    (mapped field types, empty values skipped), minus the internal record fields
+    """
+    source = {k: v for k, v in job_data.items() if k not in INTERNAL_FIELDS}
+    return JobPosting(meta={'id': job_id}, **source).to_dict(True)
+
+
+def sizeof_action(action):
+    # cheap estimate, descriptions dominate the size of a document
+    size = 0
+    for v in action['_source'].values():
+        size += len(v) if isinstance(v, str) else 16
+    return size
 
 
 class SinkerWorker(BaseWorker):
@@ -15,15 +48,65 @@ class SinkerWorker(BaseWorker):
     def __init__(self, PreTopic, NextTopic):
         super(SinkerWorker, self).__init__(__name__, PreTopic, NextTopic)
         JobPosting.init()
+        self.meta = build_meta()
+        # documents acked but not written yet keep master waiting, and so
+        # the stale document clean up at finish
+        self.pending = PendingMarker(__name__)
+        self.batcher = MicroBatcher(self.save_batch, settings.ES_BATCH_SIZE, ES_BATCH_MAX_LATENCY,
+                                    max_bytes=ES_BATCH_MAX_BYTES, sizeof=sizeof_action)
+        # master asks for the last partial batch once the stage is drained
+        on_flush(self.flush)
 
     def build_msg_key(self, job_id, seq, *args, **kwargs):
         return "%s-%s" % (job_id, str(seq))
 
     def process(self, job_id, job_data, seq):
-        _jobs_es_batch.append(JobPosting(meta={'id': job_id}, **job_data))
-        es_jobs_number = len(_jobs_es_batch)
+        action = build_action(job_id, job_data)
+        if ES_SKIP_UNCHANGED:
+            action['_source'][FINGERPRINT_FIELD] = fingerprint(job_data)
+        self.pending.add()
+        self.batcher.add(action)
+
+    def flush(self):
+        """write the documents left in the current batch, e.g. when the stage finishes"""
+        self.batcher.flush()
+
+    def save_batch(self, actions):
+        """
+        write a batch, an error other than a failed item makes the batcher retry it whole
+        """
+        self.write_batch(actions)
+        self.pending.done(len(actions))
+
+    @timeperf('es_bulk')
+    def write_batch(self, actions):
+        client = connections.get_connection()
+
+        if ES_SKIP_UNCHANGED:
+            # every id is recorded for the stale document clean up,
+            # only the changed documents are written
+            mark_seen(actions[0]['_source'].get('processSeq'), [a['_id'] for a in actions])
+            unchanged = find_unchanged(client, self.meta, actions)
+            if unchanged:
+                reports.incr_by(len(unchanged), 'es-unchanged')
+                actions = [a for a in actions if a['_id'] not in unchanged]
+            if not actions:
+                return
+
+        self.logger.info('saving to ES. %s jobs, last job_id: %s' % (len(actions), actions[-1]['_id']))
+        if ES_BULK_THREADS > 1:
+            results = parallel_bulk(client, actions, thread_count=ES_BULK_THREADS,
+                                    chunk_size=ES_BULK_CHUNK_SIZE, raise_on_error=False)
+        else:
+            results = streaming_bulk(client, actions, chunk_size=ES_BULK_CHUNK_SIZE, raise_on_error=False)
+
+        n_failed = 0
+        for ok, item in results:
+            if not ok:
+                n_failed += 1
+                if n_failed <= MAX_LOGGED_ERRORS:
+                    self.logger.error('ES index error: %s' % item)
 
-        if es_jobs_number >= settings.ES_BATCH_SIZE:
-            self.logger.info('saving to ES. job_id: %s' % job_id)
-            bulk(connections.get_connection(), (d.to_dict(True) for d in _jobs_es_batch))
-            del _jobs_es_batch[:]
+        if n_failed:
+            reports.incr_by(n_failed, 'es-error')
+            self.logger.error('%s of %s jobs failed to index' % (n_failed, len(actions)))
@@ -0,0 +1,129 @@
+import logging
+from collections import OrderedDict
+
+from mongo_enrich import build_mongo_db, LRUCache, MONGO_IN_CHUNK_SIZE
+
+import settings
+
+
+logger = logging.getLogger(__name__)
+
+# known / unknown answers kept per validated field
+VALIDATOR_CACHE_SIZE = getattr(settings, 'VALIDATOR_CACHE_SIZE', 200000)
+
+# (job field, reference collection, document field), a job is discarded
+# if the value of any job field is empty or not in its collection
+VALIDATE_SPECS = getattr(settings, 'VALIDATE_SPECS', (
+    ('title1', 'titles', 'title'),
+    ('city1', 'cities', 'name'),
+    ('state', 'states', 'name'),
+))
+
+LOG_INTERVAL = 100000
+
+
+def field_values(value):
+    """
+    the values of a job field to look up, None if the field is empty or
+    can not be looked up. the norm api answers some fields as lists, every
+    element of those is looked up
+    """
+    values = value if isinstance(value, (list, tuple)) else [value]
+    if not values:
+        return None
+    for v in values:
+        if v is None or v == '' or isinstance(v, (list, tuple, dict, set)):
+            return None
+    return values
+
+
+class LazyValidator(object):
+    """
+    Validates jobs a batch at a time, loading nothing up front.
+
+    Whether a value is known is asked on first use, for the distinct values
+    of a batch at once: first the bounded LRU cache of the field, then
+    `snapshot` if given, then one `$in` query (chunked by
+    MONGO_IN_CHUNK_SIZE) for the rest. Known and unknown answers are both
+    cached. A list-valued field is valid when all its elements are known.
+
+    `snapshot`, a RefSnapshot or any object with `contains(table, value)`
+    returning True, False or None when the table is not in the snapshot,
+    may be swapped while the worker runs. Query errors reach the caller,
+    the batcher retries the batch.
+    """
+
+    def __init__(self, db=None, specs=VALIDATE_SPECS, cache_size=VALIDATOR_CACHE_SIZE, snapshot=None):
+        self._db = db
+        self.specs = specs
+        self.snapshot = snapshot
+        self.caches = [LRUCache(cache_size) for _ in specs]
+        self.queried = 0
+        self.validated = 0
+
+    @property
+    def db(self):
+        if self._db is None:
+            self._db = build_mongo_db()
+        return self._db
+
+    def fetch(self, collection, field, values):
+        found = set()
+        for i in range(0, len(values), MONGO_IN_CHUNK_SIZE):
+            chunk = values[i:i + MONGO_IN_CHUNK_SIZE]
+            for doc in self.db[collection].find({field: {'$in': chunk}}, {field: 1, '_id': 0}):
+                found.add(doc.get(field))
+        self.queried += len(values)
+        return found
+
+    def known_many(self, spec, cache, values):
+        """
+        {value: is known} for the distinct `values`
+        """
+        _, collection, field = spec
+        snapshot = self.snapshot
+        known, missing = cache.get_many(values)
+        if missing and snapshot is not None:
+            rest = []
+            for value in missing:
+                answer = snapshot.contains(collection, value)
+                if answer is None:
+                    rest.append(value)
+                else:
+                    known[value] = answer
+            missing = rest
+        if missing:
+            found = self.fetch(collection, field, missing)
+            for value in missing:
+                known[value] = value in found
+                cache.put(value, known[value])
+        return known
+
+    def validate_many(self, job_datas):
+        """
+        (ok, unknown fields) for every job, aligned with job_datas
+        """
+        unknown = [[] for _ in job_datas]
+        for spec, cache in zip(self.specs, self.caches):
+            key = spec[0]
+            job_values = [field_values(j.get(key)) for j in job_datas]
+            # in batch order, so the cache evicts in a predictable order
+            distinct = list(OrderedDict.fromkeys(v for values in job_values if values for v in values))
+            known = self.known_many(spec, cache, distinct) if distinct else {}
+            for fields, values in zip(unknown, job_values):
+                if not values or not all(known.get(v) for v in values):
+                    fields.append(key)
+
+        before = self.validated
+        self.validated += len(job_datas)
+        if self.validated // LOG_INTERVAL != before // LOG_INTERVAL:
+            self.log_stats()
+        return [(not fields, fields) for fields in unknown]
+
+    def __call__(self, job_data):
+        return self.validate_many([job_data])[0]
+
+    def log_stats(self):
+        for spec, cache in zip(self.specs, self.caches):
+            logger.info('validator %s. cached: %s, hit rate: %.2f%%, queried values: %s' %
+                        (spec[0], len(cache), cache.hit_rate() * 100, self.queried))